@@ -14,20 +14,106 @@
 #       c. clearing the destination and the writing the source to it.
 #   4. Delete a batch of legislators from a DB
 
-import pymongo, datetime, sys, unicodecsv, re
-from pymongo import MongoClient
+import pymongo, datetime, sys, unicodecsv, re, threading, time, shelve
+import os, sqlite3, calendar, multiprocessing, itertools, binascii, cPickle
+import copy, contextlib, functools, cProfile, pstats, StringIO, Queue, hashlib
+import unicodedata, random
+from collections import OrderedDict, deque
+from pymongo import MongoClient, UpdateOne, DeleteMany, ReplaceOne, InsertOne
+from pymongo import DeleteOne
+from pymongo.errors import OperationFailure, PyMongoError, DuplicateKeyError
+from pymongo.errors import BulkWriteError, AutoReconnect
+from bson import BSON, json_util
 from bson.objectid import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from configobj import ConfigObj
 from string import whitespace
-from fuzzywuzzy import fuzz, process
+from fuzzywuzzy import fuzz
+
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from metaphone import doublemetaphone
+except ImportError:
+    doublemetaphone = None
 
 # Global Variables
 config          = ConfigObj('config')
 merge_floor     = 60
+fanout_timeout  = 30
+write_batch     = 1000
+near_dup_floor  = 75
+near_dup_grams  = 2
+cdn_prefix      = 'http://cdn.ledgezeppelin.com/'
+db_clients      = {}
+district_index  = {}
+score_cache     = OrderedDict()
+score_cache_max = 100000
+score_stats     = {'hits': 0, 'store_hits': 0, 'misses': 0}
+score_stats_shown = [0]
+score_store     = None
+score_lock      = threading.RLock()
+local_mode      = False
+mirrors         = {}
+mirror_ready    = {}
+mirror_lock     = threading.RLock()
+write_hooks     = []
+hook_lock       = threading.RLock()
+query_cache     = OrderedDict()
+query_cache_max = 500
+query_cache_docs = 200000
+query_cache_ttl = None
+query_cache_stats = {'hits': 0, 'misses': 0, 'docs': 0}
+query_cache_lock = threading.RLock()
+prefetch_depth  = 5
+seat_states     = {}
+seat_lock       = threading.RLock()
+audit_states    = {}
+audit_dirty     = {}
+ref_versions    = {}
+name_keys_ready = set()
+name_suffixes   = set(['jr', 'sr', 'ii', 'iii', 'iv', 'v'])
+name_key_version = 2
+sandbox_mode    = False
+memory_dbs      = {}
+memory_indexes  = ['level', 'state', 'district', 'name']
+memory_missing  = object()
+memory_unhashable = object()
+profile_mode    = None
+profile_run     = None
+profile_top     = 25
+bitmap_indexes  = {}
+bitmap_fields   = {'level': 1, 'state': 1, 
+                    'audio': {'$eq': ['$audio_path', '']},
+                    'emails': {'$eq': ['$emails', []]},
+                    'phones': {'$eq': ['$phones', []]},
+                    'networks': {'$eq': ['$networks', []]}}
+db_lock         = threading.Lock()
 level_list      = ['fed-upper', 'fed-lower', 'state-upper', 'state-lower']
+level_set       = set(level_list)
 filters_list    = ['Level', 'State']
 targets_list    = ['Audio', 'Phones', 'Emails', 'Networks']
+has_audio_expr  = {'$or': [{'$gt': [{'$ifNull': ['$audio_path', '']}, '']},
+                            {'$gt': [{'$ifNull': ['$filename', '']}, '']}]}
 field_list      = ['__v', '_id', 'active', 'audio_path', 'country', 'date_added', 'date_modified', 'district', 'emails', 'level', 'name', 'needs_audio', 'needs_review', 'networks', 'pending_audio_path', 'pending_filename', 'phones', 'pronunciation', 'state', 'title']
+filter_fields   = ['level', 'state', 'district', 'title', 'name', 'pronunciation']
+filter_extra    = ['filename', 'name_key', 'last_key', 'name_codes', 
+                    'key_version']
+filter_flags    = {'has_audio': {'$or': [{'audio_path': {'$nin': ['', None]}},
+                                        {'filename': {'$nin': ['', None]}}]},
+                    'has_emails': {'emails.0': {'$exists': True}},
+                    'has_phones': {'phones.0': {'$exists': True}},
+                    'has_networks': {'networks.0': {'$exists': True}}}
+filter_token    = re.compile(r'''\s*(\(|\)|,|!=|=|'[^']*'|"[^"]*"|[^\s(),=!'"]+)\s*''')
 
 template                    = {
                             	u'active': True,
@@ -42,6 +128,24 @@ template                    = {
                             	u'phones': [],
                             	u'pronunciation': u''}
 update_fields   = {}
+ingest_chunk    = 5000
+ingest_depth    = 2
+export_row_group = 50000
+job_chunk       = 1000
+move_workers    = 4
+job_lock        = threading.RLock()
+write_workers   = 8
+write_start     = 2
+write_min_batch = 50
+write_max_batch = 5000
+write_latency   = 1.0
+write_retries   = 6
+write_backoff   = 0.25
+write_backoff_max = 30
+write_retry_codes = set([6, 7, 50, 89, 91, 189, 262, 9001, 10107, 11600, 
+                        11602, 13435, 13436, 16500])
+write_stats     = {}
+write_controls  = {}
 states          = {
                     'AK': 'Alaska',
                     'AL': 'Alabama',
@@ -94,7 +198,142 @@ states          = {
                     'WV': 'West Virginia',
                     'WY': 'Wyoming'
                 }
+state_set       = set(states)
+
+#### profiled(workflow) ######################################################
+# This decorator times a menu workflow when profiling is on (--profile, or   #
+# --profile=cprofile to also run cProfile). The workflow becomes a run whose #
+# phases (see phase) are timed, and a report is written to profile_path      #
+# when it finishes. A workflow called from inside another one is timed as a  #
+# phase of the outer run.                                                    #
+# Return: function                                                           #
+##############################################################################
+def profiled(workflow):
+    @functools.wraps(workflow)
+    def wrapper(*args, **kwargs):
+        global profile_run
+        if profile_mode is None:
+            return workflow(*args, **kwargs)
+        if profile_run is not None:
+            with phase(workflow.__name__):
+                return workflow(*args, **kwargs)
+        
+        profile_run         = {'name': workflow.__name__, 'phases': OrderedDict(),
+                                'stack': [], 'profilers': [],
+                                'thread': threading.current_thread().ident,
+                                'started': datetime.datetime.now()}
+        try:
+            with phase(workflow.__name__):
+                return workflow(*args, **kwargs)
+        finally:
+            run             = profile_run
+            profile_run     = None
+            write_profile_report(run)
+    return wrapper
+
+#### phase(name) #############################################################
+# This context manager times one phase of the running workflow: wall clock,  #
+# CPU time and growth of the process's peak memory (from getrusage, since    #
+# Python 2 has no tracemalloc), plus a cProfile of the phase in cprofile     #
+# mode. Phases nest and repeat; a phase's totals add up over every entry     #
+# under the same path. Outside a profiled run, or on another thread, it does #
+# nothing.                                                                   #
+# Return: context manager                                                    #
+##############################################################################
+@contextlib.contextmanager
+def phase(name):
+    run             = profile_run
+    if run is None or run['thread'] != threading.current_thread().ident:
+        yield
+        return
+    
+    run['stack'].append(name)
+    path            = '/'.join(run['stack'])
+    stats           = run['phases'].setdefault(path, {'calls': 0, 'wall': 0.0, 
+                                    'cpu': 0.0, 'rss': 0, 'profile': None})
+    profiler        = None
+    if profile_mode == 'cprofile':
+        if len(run['profilers']) > 0:
+            run['profilers'][-1].disable()
+        if stats['profile'] is None:
+            stats['profile']    = cProfile.Profile()
+        profiler    = stats['profile']
+        run['profilers'].append(profiler)
+        profiler.enable()
+    usage           = process_usage()
+    start           = time.time()
+    try:
+        yield
+    finally:
+        wall        = time.time() - start
+        if profiler is not None:
+            profiler.disable()
+            run['profilers'].pop()
+            if len(run['profilers']) > 0:
+                run['profilers'][-1].enable()
+        after       = process_usage()
+        stats['calls']  += 1
+        stats['wall']   += wall
+        stats['cpu']    += after[0] - usage[0]
+        stats['rss']    += after[1] - usage[1]
+        run['stack'].pop()
+
+#### process_usage() #########################################################
+# This function reads the process's CPU seconds and peak resident memory     #
+# (KB on Linux), or zeros where the resource module is unavailable.          #
+# Return: tuple (cpu seconds, peak memory)                                   #
+##############################################################################
+def process_usage():
+    if resource is None:
+        return (time.clock(), 0)
+    usage           = resource.getrusage(resource.RUSAGE_SELF)
+    return (usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
 
+#### write_profile_report(run) ###############################################
+# This function prints a run's phase timings and writes them, with the top   #
+# cProfile entries of each phase in cprofile mode, to a report file in       #
+# profile_path.                                                              #
+# Return: string (report file name)                                          #
+##############################################################################
+def write_profile_report(run):
+    total           = 0.0
+    for path in run['phases']:
+        if '/' not in path:
+            total   += run['phases'][path]['wall']
+    lines           = []
+    lines.append('Profile of %s started %s' % (run['name'], \
+                                        run['started'].strftime('%Y-%m-%d %H:%M:%S')))
+    lines.append('')
+    lines.append('%-50s %6s %10s %10s %6s %10s' % ('Phase', 'Calls', 'Wall (s)', 
+                                            'CPU (s)', 'Wall%', 'Peak+ (KB)'))
+    for path in run['phases']:
+        stats       = run['phases'][path]
+        share       = 100.0 * stats['wall'] / total if total > 0 else 0.0
+        label       = '  ' * path.count('/') + path.split('/')[-1]
+        lines.append('%-50s %6i %10.3f %10.3f %6.1f %10i' % (label[:50], \
+                stats['calls'], stats['wall'], stats['cpu'], share, stats['rss']))
+    print '\n'.join(lines)
+    
+    for path in run['phases']:
+        if run['phases'][path]['profile'] is None:
+            continue
+        out         = StringIO.StringIO()
+        report      = pstats.Stats(run['phases'][path]['profile'], stream = out)
+        report.sort_stats('cumulative').print_stats(profile_top)
+        lines.append('')
+        lines.append('==== %s ====' % path)
+        lines.append(out.getvalue())
+    
+    folder          = config.get('profile_path', './profiles/')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    outfile         = os.path.join(folder, '%s-%s.txt' % (run['name'], \
+                                    run['started'].strftime('%Y%m%d-%H%M%S')))
+    with open(outfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print 'Profile written to %s' % outfile
+    return outfile
+    
 #### list_menu(my_list, prompt) ##############################################
 # This function creates a menu from a list. It then prompts for the user to  #
 # choose one of the options.                                                 #
@@ -125,60 +364,1486 @@ def list_menu(my_list, prompt):
     return menu[selection]
     
 
-#### pull_entries(table, criteria) ###########################################
+#### pull_entries(table, criteria, single = False, fields = None) ############
 # This function queries a mongodb table for all documents matching the       #
-# criteria.                                                                  #
+# criteria, limited to fields when that projection is given. In local mode   #
+# the documents come from the table's local mirror (see use_mirror);         #
+# otherwise repeated queries are answered from the session's query cache     #
+# (see cached_find).                                                         #
 # Return: list of dictionaries                                               #
 ##############################################################################
-def pull_entries(table, criteria, single = False):
+def pull_entries(table, criteria, single = False, fields = None):
     result_list = []
     
     if len(criteria) < 1:
         return result_list
-    elif type(criteria) is dict:
-        try:
+    elif local_mode and use_mirror(table):
+        if type(criteria) is dict:
+            criteria    = [criteria]
+        for crit in criteria:
+            items       = [project_doc(x, fields) for x in mirror_find(table, crit)]
             if single:
-                items   = table.find_one(criteria)
+                result_list += items[:1]
             else:
-                items   = list(table.find(criteria))
-        except:
-            items = []
-        if items is None:
-            pass
-        elif type(items) is dict:
-            result_list.append(items)
-        elif len(items) >= 1:
-            result_list += items        
+                result_list += items
     else:
-        for i in range(0,len(criteria)):
+        if type(criteria) is dict:
+            criteria    = [criteria]
+        for crit in criteria:
+            result_list += cached_find(table, crit, single, fields)
+    
+    return result_list      
+    
+#### cached_find(table, criteria, single = False, fields = None) #############
+# This function runs a find (or find_one when single) through the session's  #
+# query cache, keyed by collection, filter and projection. Entries expire    #
+# after query_cache_ttl seconds when that is set and the least recently used #
+# are evicted past query_cache_max entries or query_cache_docs documents.    #
+# cache_hook drops entries that writes made through this module touch.       #
+# Callers get their own copies of the documents. Failed queries return an    #
+# empty list and are not cached.                                             #
+# Return: list of dictionaries                                               #
+##############################################################################
+def cached_find(table, criteria, single = False, fields = None):
+    key             = (table.full_name, json_util.dumps(criteria, sort_keys = True),
+                        json_util.dumps(fields, sort_keys = True), single)
+    ttl             = config.get('query_cache_ttl', query_cache_ttl)
+    with query_cache_lock:
+        entry       = query_cache.pop(key, None)
+        if entry is not None and ttl is not None and \
+                                        time.time() - entry[2] > float(ttl):
+            query_cache_stats['docs']   -= len(entry[1])
+            entry   = None
+        if entry is not None:
+            query_cache[key]    = entry
+            query_cache_stats['hits']   += 1
+            return copy.deepcopy(entry[1])
+        query_cache_stats['misses'] += 1
+    
+    try:
+        if single:
+            items   = table.find_one(criteria, fields)
+            items   = [] if items is None else [items]
+        else:
+            items   = list(table.find(criteria, fields))
+    except:
+        return []
+    
+    with query_cache_lock:
+        query_cache[key]                = [criteria, items, time.time()]
+        query_cache_stats['docs']       += len(items)
+        while len(query_cache) > query_cache_max or \
+                (query_cache_stats['docs'] > query_cache_docs and \
+                                                    len(query_cache) > 1):
+            old                         = query_cache.popitem(last = False)[1]
+            query_cache_stats['docs']   -= len(old[1])
+    return copy.deepcopy(items)
+
+#### cache_hook(table, action, items) ########################################
+# This write hook drops the query cache entries a write could have changed:  #
+# entries whose filter matches an inserted document, entries holding a       #
+# document that was updated or deleted, and entries whose filter matches an  #
+# updated document afterwards. Updates that do not name their documents by   #
+# _id drop every entry of the collection.                                    #
+# Return: none                                                               #
+##############################################################################
+def cache_hook(table, action, items):
+    with query_cache_lock:
+        keys        = [x for x in query_cache if x[0] == table.full_name]
+    if len(keys) < 1:
+        return
+    
+    ids             = []
+    for query in ([] if action == 'insert' else items):
+        found       = query_ids(query)
+        if found is None:
+            ids     = None
+            break
+        ids         += found
+    docs            = items if action == 'insert' else []
+    if action == 'update' and ids is not None:
+        docs        = list(table.find({'_id': {'$in': ids}}))
+    if ids is not None:
+        ids         = set(ids)
+    
+    with query_cache_lock:
+        for key in keys:
+            entry   = query_cache.get(key)
+            if entry is None:
+                continue
             try:
-                if single:
-                    items   = table.find_one(criteria[i])
+                if action == 'update' and ids is None:
+                    stale   = True
+                elif ids is not None:
+                    stale   = any(x.get('_id') in ids for x in entry[1])
                 else:
-                    items   = list(table.find(criteria[i]))
-            except:
-                items = []
-            if items is None:
-                pass
-            elif type(items) is dict:
-                result_list.append(items)
-            elif len(items) >= 1:
-                result_list += items
+                    stale   = any(match_doc(x, y) for x in entry[1] for y in items)
+                stale       = stale or any(match_doc(x, entry[0]) for x in docs)
+            except ValueError:
+                stale       = True
+            if stale:
+                del query_cache[key]
+                query_cache_stats['docs']   -= len(entry[1])
+
+#### open_mirror(table) ######################################################
+# This function opens (creating if needed) the sqlite mirror of a table's    #
+# database (see mirror_file). Each row keeps the seat fields in columns for  #
+# indexed lookups and the whole document as BSON.                            #
+# Return: sqlite3 connection                                                 #
+##############################################################################
+def open_mirror(table):
+    name            = table.database.name
+    if name not in mirrors:
+        filename    = mirror_file(table)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        conn        = sqlite3.connect(filename, check_same_thread = False)
+        conn.execute('CREATE TABLE IF NOT EXISTS legislators (_id TEXT PRIMARY '
+                    'KEY, level TEXT, state TEXT, district TEXT, doc BLOB)')
+        conn.execute('CREATE INDEX IF NOT EXISTS seat ON legislators '
+                    '(level, state, district)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, '
+                    'value INTEGER)')
+        conn.commit()
+        mirrors[name]   = conn
+    return mirrors[name]
+
+#### use_mirror(table) #######################################################
+# This function refreshes a table's local mirror the first time it is used   #
+# in a session. When the refresh fails the last snapshot is used, unless the #
+# table has never been mirrored; then it is queried remotely instead.        #
+# Return: boolean, whether the mirror answers the table's queries            #
+##############################################################################
+def use_mirror(table):
+    name            = table.database.name
+    if name in mirror_ready:
+        return mirror_ready[name]
+    try:
+        refresh_mirror(table)
+        mirror_ready[name]  = True
+    except PyMongoError as e:
+        conn        = open_mirror(table)
+        with mirror_lock:
+            row     = conn.execute('SELECT 1 FROM legislators LIMIT 1').fetchone()
+        mirror_ready[name]  = row is not None
+        if row is None:
+            print 'Could not mirror %s, querying it remotely (%s)' % (name, e)
+        else:
+            print 'Could not refresh mirror, using last snapshot (%s)' % e
+    return mirror_ready[name]
+
+#### mirror_file(table) ######################################################
+# This function names the mirror file of a table's database in mirror_path.  #
+# Dry runs get their own mirror, filled from the in-memory copy.             #
+# Return: string                                                             #
+##############################################################################
+def mirror_file(table):
+    name            = table.database.name + ('.dry-run' if sandbox_mode else '')
+    return os.path.join(config.get('mirror_path', './mirror/'), name + '.sqlite')
+
+#### refresh_mirror(table) ###################################################
+# This function brings a table's local mirror up to date. Documents with a   #
+# date_modified at or after the newest one already mirrored are pulled; an   #
+# _id-only scan then finds the documents deleted remotely and pulls those    #
+# the mirror lacks (copied in with older or no date_modified). Writes made   #
+# through this module reach the mirror through mirror_hook.                  #
+# Return: number of documents pulled                                         #
+##############################################################################
+def refresh_mirror(table):
+    conn            = open_mirror(table)
+    with mirror_lock:
+        row         = conn.execute('SELECT value FROM meta WHERE key = ?', \
+                                    ('last_modified',)).fetchone()
+    criteria        = {}
+    newest          = None
+    if row is not None:
+        newest      = datetime.datetime.utcfromtimestamp(row[0] / 1000.0)
+        criteria['date_modified']   = {'$gte': newest}
     
-    return result_list      
+    rows            = []
+    pulled          = 0
+    for doc in table.find(criteria):
+        rows.append(mirror_row(doc))
+        stamp       = doc.get('date_modified')
+        if isinstance(stamp, datetime.datetime):
+            if newest is None or stamp > newest:
+                newest  = stamp
+        if len(rows) >= write_batch:
+            pulled  += mirror_write(conn, rows)
+            rows    = []
+    pulled          += mirror_write(conn, rows)
+    
+    remote_ids      = dict((str(x['_id']), x['_id']) \
+                                        for x in table.find({}, {'_id': 1}))
+    with mirror_lock:
+        local_ids   = [x[0] for x in conn.execute('SELECT _id FROM legislators')]
+        gone        = [[x] for x in local_ids if x not in remote_ids]
+        conn.executemany('DELETE FROM legislators WHERE _id = ?', gone)
+    missing         = set(remote_ids) - set(local_ids)
+    pulled          += mirror_pull(table, [remote_ids[x] for x in missing])
+    with mirror_lock:
+        if newest is not None:
+            stamp   = calendar.timegm(newest.utctimetuple()) * 1000 + \
+                                                    newest.microsecond / 1000
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', \
+                                                    ('last_modified', stamp))
+        conn.commit()
+    print 'Mirror of %s: %i pulled, %i removed' % (table.database.name, \
+                                                    pulled, len(gone))
+    return pulled
+
+#### mirror_row(doc) #########################################################
+# This function makes the mirror row of a legislator document.               #
+# Return: list                                                               #
+##############################################################################
+def mirror_row(doc):
+    return [str(doc['_id']), doc.get('level'), doc.get('state'), 
+            doc.get('district'), sqlite3.Binary(BSON.encode(doc))]
+
+#### mirror_pull(table, ids) #################################################
+# This function re-pulls documents into a table's mirror by _id, write_batch #
+# at a time, and drops those that no longer exist remotely.                  #
+# Return: number of documents pulled                                         #
+##############################################################################
+def mirror_pull(table, ids):
+    conn            = open_mirror(table)
+    ids             = list(set(ids))
+    pulled          = 0
+    for i in range(0, len(ids), write_batch):
+        chunk       = ids[i:i+write_batch]
+        docs        = list(table.find({'_id': {'$in': chunk}}))
+        found       = set(str(x['_id']) for x in docs)
+        pulled      += mirror_write(conn, [mirror_row(x) for x in docs])
+        with mirror_lock:
+            conn.executemany('DELETE FROM legislators WHERE _id = ?', \
+                            [[str(x)] for x in chunk if str(x) not in found])
+    with mirror_lock:
+        conn.commit()
+    return pulled
+
+#### mirror_hook(table, action, items) #######################################
+# This write hook keeps a table's local mirror, when there is one, in step   #
+# with the writes made through this module, which do not always move         #
+# date_modified. Inserted documents are stored as written; documents an      #
+# update or delete touched are pulled again by _id (see mirror_pull).        #
+# Queries that do not name their documents by _id are resolved against the   #
+# mirror and, for updates, the remote table.                                 #
+# Return: none                                                               #
+##############################################################################
+def mirror_hook(table, action, items):
+    if table.name != 'legislators':
+        return
+    if table.database.name not in mirrors and \
+                                    not os.path.isfile(mirror_file(table)):
+        return
+    
+    if action == 'insert':
+        conn        = open_mirror(table)
+        mirror_write(conn, [mirror_row(x) for x in items if '_id' in x])
+        with mirror_lock:
+            conn.commit()
+        return
+    ids             = []
+    for query in items:
+        found       = query_ids(query)
+        if found is None:
+            try:
+                found   = [x['_id'] for x in mirror_find(table, query)]
+            except ValueError:
+                found   = []
+            if action == 'update':
+                found   += [x['_id'] for x in table.find(query, {'_id': 1})]
+        ids         += found
+    mirror_pull(table, ids)
+
+#### mirror_write(conn, rows) ################################################
+# This function upserts a batch of rows into a mirror.                       #
+# Return: number of rows                                                     #
+##############################################################################
+def mirror_write(conn, rows):
+    with mirror_lock:
+        conn.executemany('INSERT OR REPLACE INTO legislators VALUES '
+                        '(?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+#### mirror_find(table, criteria) ############################################
+# This function answers a query from a table's local mirror. Equality on     #
+# level, state and district is done by sqlite; everything else is checked    #
+# with match_doc.                                                            #
+# Return: list of dictionaries                                               #
+##############################################################################
+def mirror_find(table, criteria):
+    conn            = open_mirror(table)
+    sql             = 'SELECT doc FROM legislators'
+    where           = []
+    args            = []
+    for field in ['level', 'state', 'district']:
+        if isinstance(criteria.get(field), basestring):
+            where.append('%s = ?' % field)
+            args.append(criteria[field])
+    if len(where) > 0:
+        sql         += ' WHERE ' + ' AND '.join(where)
+    
+    with mirror_lock:
+        rows        = conn.execute(sql, args).fetchall()
+    result_list     = []
+    for row in rows:
+        doc         = BSON(row[0]).decode()
+        if match_doc(doc, criteria):
+            result_list.append(doc)
+    return result_list
+
+#### match_doc(doc, criteria) ################################################
+# This function checks a document against a mongo query locally. It covers   #
+# the query subset this module uses: equality (including array membership),  #
+# dotted fields, $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $exists, $regex, #
+# $size, $not, $and, $or, $nor and $expr.                                    #
+# Return: boolean                                                            #
+##############################################################################
+def match_doc(doc, criteria):
+    for key in criteria:
+        cond        = criteria[key]
+        if key == '$and':
+            if not all(match_doc(doc, x) for x in cond):
+                return False
+        elif key == '$or':
+            if not any(match_doc(doc, x) for x in cond):
+                return False
+        elif key == '$nor':
+            if any(match_doc(doc, x) for x in cond):
+                return False
+        elif key == '$expr':
+            if not expr_true(eval_expr(cond, doc)):
+                return False
+        else:
+            found, value    = doc_value(doc, key)
+            if not match_value(found, value, cond):
+                return False
+    return True
+
+#### doc_value(doc, key) #####################################################
+# This function looks up a possibly dotted field in a document. A dotted     #
+# path through an array of subdocuments collects the field from each one.    #
+# Return: list [found, value]                                                #
+##############################################################################
+def doc_value(doc, key):
+    value           = doc
+    for part in key.split('.'):
+        if isinstance(value, dict) and part in value:
+            value   = value[part]
+        elif type(value) is list and part.isdigit() and int(part) < len(value):
+            value   = value[int(part)]
+        elif type(value) is list:
+            value   = [x[part] for x in value \
+                                    if isinstance(x, dict) and part in x]
+            if len(value) < 1:
+                return [False, None]
+        else:
+            return [False, None]
+    return [True, value]
+
+#### match_value(found, value, cond) #########################################
+# This function checks one field value against a query condition for         #
+# match_doc.                                                                 #
+# Return: boolean                                                            #
+##############################################################################
+def match_value(found, value, cond):
+    if not (isinstance(cond, dict) and len(cond) > 0 and \
+                                    all(k.startswith('$') for k in cond)):
+        return value_equals(value, cond)
+    
+    for op in cond:
+        arg         = cond[op]
+        if op == '$eq':
+            ok      = value_equals(value, arg)
+        elif op == '$ne':
+            ok      = not value_equals(value, arg)
+        elif op == '$in':
+            ok      = any(value_equals(value, x) for x in arg)
+        elif op == '$nin':
+            ok      = not any(value_equals(value, x) for x in arg)
+        elif op == '$exists':
+            ok      = found == bool(arg)
+        elif op in ['$gt', '$gte', '$lt', '$lte']:
+            values  = value if type(value) is list else [value]
+            ok      = any(compare_values(op, x, arg) for x in values)
+        elif op == '$regex':
+            flags   = 0
+            if 'i' in cond.get('$options', ''):
+                flags   = re.I
+            ok      = value_equals(value, re.compile(arg, flags))
+        elif op == '$options':
+            ok      = True
+        elif op == '$size':
+            ok      = type(value) is list and len(value) == arg
+        elif op == '$not':
+            ok      = not match_value(found, value, arg)
+        else:
+            raise ValueError('Unsupported query operator %s' % op)
+        if not ok:
+            return False
+    return True
+
+#### value_equals(value, target) #############################################
+# This function compares a field value to a query value the way mongo does:  #
+# an array matches when it equals the target or contains it, and a compiled  #
+# regex target matches strings.                                              #
+# Return: boolean                                                            #
+##############################################################################
+def value_equals(value, target):
+    if hasattr(target, 'search'):
+        values      = value if type(value) is list else [value]
+        return any(isinstance(x, basestring) and target.search(x) is not None \
+                                                            for x in values)
+    if value == target:
+        return True
+    if type(value) is list:
+        return target in value
+    return False
+
+#### compare_values(op, value, target) #######################################
+# This function applies a range operator, only between values of comparable  #
+# types.                                                                     #
+# Return: boolean                                                            #
+##############################################################################
+def compare_values(op, value, target):
+    if value is None or target is None:
+        return False
+    numbers         = (int, long, float)
+    if not (isinstance(value, numbers) and isinstance(target, numbers)) and \
+            not (isinstance(value, basestring) and \
+                                        isinstance(target, basestring)) and \
+            type(value) is not type(target):
+        return False
+    if op == '$gt':
+        return value > target
+    if op == '$gte':
+        return value >= target
+    if op == '$lt':
+        return value < target
+    return value <= target
+
+#### MemoryDatabase(name, source = None) #####################################
+# This class is the in-memory storage backend's database. Collections are    #
+# created on first use; with a pymongo source database each collection is    #
+# seeded with a copy of the source collection, which makes it a dry-run      #
+# sandbox whose writes never reach the server.                               #
+##############################################################################
+class MemoryDatabase(object):
+    def __init__(self, name, source = None):
+        self.name           = name
+        self.source         = source
+        self.collections    = {}
+        self.lock           = threading.RLock()
+        
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                table                   = MemoryCollection(self, name)
+                if self.source is not None:
+                    table.insert_many(list(self.source[name].find()))
+                self.collections[name]  = table
+            return self.collections[name]
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+    
+    def collection_names(self):
+        return self.collections.keys()
+    
+    list_collection_names   = collection_names
+
+#### MemoryCollection(database, name) ########################################
+# This class is the in-memory storage backend's collection. It implements    #
+# the part of the pymongo collection interface this module uses (find,       #
+# count, insert, update, replace, remove/delete, bulk writes, aggregate and  #
+# create_index) over a dict of documents keyed by _id, with hash indexes on  #
+# level, state, district and name (plus any created with create_index) for   #
+# equality lookups. Documents are copied in and out, as with a server.       #
+##############################################################################
+class MemoryCollection(object):
+    def __init__(self, database, name):
+        self.database       = database
+        self.name           = name
+        self.full_name      = '%s.%s' % (database.name, name)
+        self.docs           = OrderedDict()
+        self.indexes        = {}
+        self.lock           = threading.RLock()
+        for field in memory_indexes:
+            self.indexes[field] = {}
+    
+    def with_options(self, **kwargs):
+        return self
+    
+    # Indexes
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, basestring):
+            keys        = [(keys, 1)]
+        field           = keys[0][0]
+        with self.lock:
+            if field not in self.indexes:
+                self.indexes[field] = {}
+                for doc in self.docs.values():
+                    self.index_doc(doc, field)
+        return '%s_1' % field
+    
+    def index_doc(self, doc, field, remove = False):
+        found, value    = doc_value(doc, field)
+        values          = value if type(value) is list else [value]
+        for each in values:
+            try:
+                bucket  = self.indexes[field].setdefault(each, set())
+            except TypeError:
+                bucket  = self.indexes[field].setdefault(memory_unhashable, set())
+            if remove:
+                bucket.discard(doc['_id'])
+            else:
+                bucket.add(doc['_id'])
+    
+    def store(self, doc):
+        with self.lock:
+            if doc['_id'] in self.docs:
+                self.unstore(doc['_id'])
+            self.docs[doc['_id']]   = doc
+            for field in self.indexes:
+                self.index_doc(doc, field)
+    
+    def unstore(self, _id):
+        with self.lock:
+            doc         = self.docs.pop(_id)
+            for field in self.indexes:
+                self.index_doc(doc, field, True)
     
+    # Queries
+    def candidates(self, query):
+        # Narrow a query with the equality indexes before running match_doc
+        ids             = None
+        for field in query:
+            cond        = query[field]
+            if field == '_id' and not isinstance(cond, dict):
+                found   = set([cond]) if cond in self.docs else set()
+            elif field == '_id' and cond.keys() == ['$in']:
+                found   = set(x for x in cond['$in'] if x in self.docs)
+            elif field not in self.indexes or cond is None:
+                continue
+            elif isinstance(cond, (basestring, int, long, float, bool)):
+                found   = self.indexes[field].get(cond, set()) | \
+                            self.indexes[field].get(memory_unhashable, set())
+            elif isinstance(cond, dict) and cond.keys() == ['$in'] and \
+                                            None not in cond['$in']:
+                found   = set(self.indexes[field].get(memory_unhashable, set()))
+                for each in cond['$in']:
+                    try:
+                        found   |= self.indexes[field].get(each, set())
+                    except TypeError:
+                        found   = None
+                        break
+                if found is None:
+                    continue
+            else:
+                continue
+            ids         = found if ids is None else ids & found
+        if ids is None:
+            return self.docs.values()
+        if len(ids) * 8 > len(self.docs):
+            return [x for x in self.docs.values() if x['_id'] in ids]
+        return sorted((self.docs[x] for x in ids), key = lambda x: \
+                                                        bson_order(x['_id']))
+    
+    def matching(self, query):
+        query           = query or {}
+        with self.lock:
+            return [x for x in self.candidates(query) if match_doc(x, query)]
+    
+    def find(self, query = None, projection = None, **kwargs):
+        docs            = [project_doc(x, projection) for x in self.matching(query)]
+        return MemoryCursor(docs)
+    
+    def find_one(self, query = None, projection = None, **kwargs):
+        if query is not None and not isinstance(query, dict):
+            query       = {'_id': query}
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+    
+    def count_documents(self, query, **kwargs):
+        return len(self.matching(query))
+    
+    def count(self, query = None, **kwargs):
+        return len(self.matching(query))
+    
+    def aggregate(self, pipeline, **kwargs):
+        with self.lock:
+            docs        = [copy.deepcopy(x) for x in self.docs.values()]
+        return MemoryCursor(run_pipeline(self.database, docs, pipeline))
+    
+    # Inserts
+    def insert_one(self, doc, **kwargs):
+        if '_id' not in doc:
+            doc['_id']  = ObjectId()
+        with self.lock:
+            if doc['_id'] in self.docs:
+                raise DuplicateKeyError('E11000 duplicate key error _id: %s' \
+                                                    % doc['_id'], 11000)
+            self.store(copy.deepcopy(dict(doc)))
+        return MemoryResult(inserted_id = doc['_id'], inserted_count = 1)
+    
+    def insert_many(self, docs, ordered = True, **kwargs):
+        ids             = []
+        for doc in docs:
+            ids.append(self.insert_one(doc).inserted_id)
+        return MemoryResult(inserted_ids = ids, inserted_count = len(ids))
+    
+    def insert(self, docs, **kwargs):
+        if isinstance(docs, list):
+            return self.insert_many(docs).inserted_ids
+        return self.insert_one(docs).inserted_id
+    
+    # Updates
+    def update_docs(self, query, update, upsert, multi, replace = False):
+        result          = MemoryResult()
+        with self.lock:
+            docs        = self.matching(query)
+            if not multi:
+                docs    = docs[:1]
+            for doc in docs:
+                new     = apply_update(doc, update, replace)
+                result.matched_count    += 1
+                if new != doc:
+                    result.modified_count   += 1
+                    self.store(new)
+            if len(docs) == 0 and upsert:
+                seed    = {}
+                for key in query:
+                    if not key.startswith('$') and not (isinstance(query[key], \
+                            dict) and any(k.startswith('$') for k in query[key])):
+                        set_path(seed, key, copy.deepcopy(query[key]))
+                new     = apply_update(seed, update, replace)
+                if replace and '_id' in seed:
+                    new['_id']  = seed['_id']
+                if '_id' not in new:
+                    new['_id']  = ObjectId()
+                self.store(new)
+                result.upserted_id      = new['_id']
+                result.upserted_count   = 1
+        return result
+    
+    def update_one(self, query, update, upsert = False, **kwargs):
+        return self.update_docs(query, update, upsert, False)
+    
+    def update_many(self, query, update, upsert = False, **kwargs):
+        return self.update_docs(query, update, upsert, True)
+    
+    def replace_one(self, query, doc, upsert = False, **kwargs):
+        return self.update_docs(query, doc, upsert, False, True)
+    
+    def update(self, query, update, upsert = False, multi = False, **kwargs):
+        replace         = not any(k.startswith('$') for k in update)
+        result          = self.update_docs(query, update, upsert, multi, replace)
+        return {'n': result.matched_count + result.upserted_count, 
+                'nModified': result.modified_count, 'ok': 1.0,
+                'updatedExisting': result.matched_count > 0}
+    
+    # Deletes
+    def delete_docs(self, query, multi):
+        with self.lock:
+            docs        = self.matching(query)
+            if not multi:
+                docs    = docs[:1]
+            for doc in docs:
+                self.unstore(doc['_id'])
+        return MemoryResult(deleted_count = len(docs))
+    
+    def delete_one(self, query, **kwargs):
+        return self.delete_docs(query, False)
+    
+    def delete_many(self, query, **kwargs):
+        return self.delete_docs(query, True)
+    
+    def remove(self, query = None, multi = True, **kwargs):
+        result          = self.delete_docs(query or {}, multi)
+        return {'n': result.deleted_count, 'ok': 1.0}
+    
+    # Bulk writes
+    def bulk_write(self, requests, ordered = True, **kwargs):
+        bulk            = MemoryBulk(self, ordered)
+        for request in requests:
+            request._add_to_bulk(bulk)
+        return bulk.run()
+    
+    def initialize_ordered_bulk_op(self):
+        return MemoryLegacyBulk(self, True)
+    
+    def initialize_unordered_bulk_op(self):
+        return MemoryLegacyBulk(self, False)
+
+#### MemoryCursor(docs) ######################################################
+# This class is the cursor returned by the in-memory backend's find and      #
+# aggregate.                                                                 #
+##############################################################################
+class MemoryCursor(object):
+    def __init__(self, docs):
+        self.docs           = list(docs)
+        self.skipped        = 0
+        self.limited        = 0
+    
+    def sort(self, key, direction = 1):
+        if isinstance(key, basestring):
+            key         = [(key, direction)]
+        for field, way in reversed(key):
+            self.docs.sort(key = lambda x: bson_order(doc_value(x, field)[1]), \
+                            reverse = way < 0)
+        return self
+    
+    def skip(self, count):
+        self.skipped        = count
+        return self
+    
+    def limit(self, count):
+        self.limited        = count
+        return self
+    
+    def max_time_ms(self, ms):
+        return self
+    
+    def batch_size(self, size):
+        return self
+    
+    def __iter__(self):
+        docs                = self.docs[self.skipped:]
+        if self.limited > 0:
+            docs            = docs[:self.limited]
+        return iter(docs)
+    
+    def next(self):
+        if not hasattr(self, 'iterator'):
+            self.iterator   = iter(self)
+        return self.iterator.next()
+    
+    __next__                = next
+
+#### MemoryResult(**counts) ##################################################
+# This class stands in for pymongo's write result classes.                   #
+##############################################################################
+class MemoryResult(object):
+    def __init__(self, **counts):
+        self.acknowledged   = True
+        self.inserted_id    = None
+        self.inserted_ids   = []
+        self.upserted_id    = None
+        self.upserted_ids   = {}
+        for name in ['inserted_count', 'matched_count', 'modified_count', 
+                    'deleted_count', 'upserted_count']:
+            setattr(self, name, 0)
+        for name in counts:
+            setattr(self, name, counts[name])
+    
+    def add(self, other, index = 0):
+        for name in ['inserted_count', 'matched_count', 'modified_count', 
+                    'deleted_count', 'upserted_count']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if other.upserted_id is not None:
+            self.upserted_ids[index]    = other.upserted_id
+    
+    @property
+    def bulk_api_result(self):
+        return {'nInserted': self.inserted_count, 'nMatched': self.matched_count,
+                'nModified': self.modified_count, 'nRemoved': self.deleted_count,
+                'nUpserted': self.upserted_count, 'writeErrors': [], 
+                'writeConcernErrors': [], 'upserted': 
+                [{'index': x, '_id': self.upserted_ids[x]} for x in self.upserted_ids]}
+
+#### MemoryBulk(table, ordered) ##############################################
+# This class collects the operations of a bulk_write. pymongo's request      #
+# classes (InsertOne, UpdateOne, ReplaceOne, DeleteMany, ...) add            #
+# themselves to it through add_insert, add_update, add_replace and           #
+# add_delete, exactly as they do to pymongo's own bulk object.               #
+##############################################################################
+class MemoryBulk(object):
+    def __init__(self, table, ordered):
+        self.table          = table
+        self.ordered        = ordered
+        self.ops            = []
+    
+    def add_insert(self, doc):
+        self.ops.append(['insert', doc])
+    
+    def add_update(self, selector, update, multi = False, upsert = False, \
+                                                        *args, **kwargs):
+        self.ops.append(['update', selector, update, multi, upsert])
+    
+    def add_replace(self, selector, replacement, upsert = False, \
+                                                        *args, **kwargs):
+        self.ops.append(['replace', selector, replacement, upsert])
+    
+    def add_delete(self, selector, limit, *args, **kwargs):
+        self.ops.append(['delete', selector, limit])
+    
+    def run(self):
+        result              = MemoryResult()
+        errors              = []
+        for i in range(0, len(self.ops)):
+            op              = self.ops[i]
+            try:
+                if op[0] == 'insert':
+                    done    = self.table.insert_one(op[1])
+                elif op[0] == 'update':
+                    done    = self.table.update_docs(op[1], op[2], op[4], op[3])
+                elif op[0] == 'replace':
+                    done    = self.table.update_docs(op[1], op[2], op[3], \
+                                                                False, True)
+                else:
+                    done    = self.table.delete_docs(op[1], op[2] != 1)
+            except DuplicateKeyError as e:
+                errors.append({'index': i, 'code': 11000, 'errmsg': str(e), 
+                                'op': op[1]})
+                if self.ordered:
+                    break
+                continue
+            result.add(done, i)
+        if len(errors) > 0:
+            details                 = result.bulk_api_result
+            details['writeErrors']  = errors
+            raise BulkWriteError(details)
+        return result
+
+#### MemoryLegacyBulk(table, ordered) ########################################
+# This class stands in for the bulk object of initialize_ordered_bulk_op.    #
+##############################################################################
+class MemoryLegacyBulk(MemoryBulk):
+    def insert(self, doc):
+        if '_id' not in doc:
+            doc['_id']      = ObjectId()
+        self.add_insert(doc)
+    
+    def find(self, selector):
+        bulk                = self
+        class Selection(object):
+            def __init__(self):
+                self.upserting  = False
+            def upsert(self):
+                self.upserting  = True
+                return self
+            def remove(self):
+                bulk.add_delete(selector, 0)
+            def remove_one(self):
+                bulk.add_delete(selector, 1)
+            def update(self, update):
+                bulk.add_update(selector, update, True, self.upserting)
+            def update_one(self, update):
+                bulk.add_update(selector, update, False, self.upserting)
+            def replace_one(self, doc):
+                bulk.add_replace(selector, doc, self.upserting)
+        return Selection()
+    
+    def execute(self):
+        return self.run().bulk_api_result
+
+#### memory_db(name, docs = []) ##############################################
+# This function makes an in-memory database whose legislators collection     #
+# holds a copy of docs, for benchmarks and tests of the workflows.           #
+# Return: MemoryDatabase                                                     #
+##############################################################################
+def memory_db(name, docs = []):
+    database        = MemoryDatabase(name)
+    database['legislators'].insert_many(copy.deepcopy(list(docs)))
+    return database
+
+#### project_doc(doc, projection) ############################################
+# This function copies a document keeping only the fields a find projection  #
+# asks for (or dropping the excluded ones).                                  #
+# Return: dictionary                                                         #
+##############################################################################
+def project_doc(doc, projection):
+    doc             = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if isinstance(projection, list):
+        projection  = dict((x, 1) for x in projection)
+    include         = [x for x in projection if projection[x] and x != '_id']
+    if len(include) > 0:
+        result      = {}
+        for field in include:
+            found, value    = doc_value(doc, field)
+            if found:
+                set_path(result, field, value)
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id']   = doc['_id']
+        return result
+    for field in projection:
+        if not projection[field]:
+            doc.pop(field, None)
+    return doc
+
+#### set_path(doc, key, value) ###############################################
+# This function sets a possibly dotted field, creating subdocuments.         #
+# Return: none                                                               #
+##############################################################################
+def set_path(doc, key, value):
+    parts           = key.split('.')
+    for part in parts[:-1]:
+        doc         = doc.setdefault(part, {})
+    doc[parts[-1]]  = value
+
+#### unset_path(doc, key) ####################################################
+# This function removes a possibly dotted field if it is there.              #
+# Return: none                                                               #
+##############################################################################
+def unset_path(doc, key):
+    parts           = key.split('.')
+    for part in parts[:-1]:
+        doc         = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+#### apply_update(doc, update, replace = False) ##############################
+# This function applies an update document ($set, $unset, $inc, $push,       #
+# $addToSet, $pull), an aggregation-pipeline update ($set/$addFields,        #
+# $unset, $project) or a replacement to a copy of doc.                       #
+# Return: dictionary                                                         #
+##############################################################################
+def apply_update(doc, update, replace = False):
+    new             = copy.deepcopy(doc)
+    if isinstance(update, list):
+        docs        = run_pipeline(None, [new], update)
+        return docs[0]
+    if replace or not any(k.startswith('$') for k in update):
+        new         = copy.deepcopy(dict(update))
+        if '_id' in doc:
+            new['_id']  = doc['_id']
+        return new
+    
+    for op in update:
+        for key in update[op]:
+            arg     = copy.deepcopy(update[op][key])
+            found, value    = doc_value(new, key)
+            if op == '$set':
+                set_path(new, key, arg)
+            elif op == '$unset':
+                unset_path(new, key)
+            elif op == '$inc':
+                set_path(new, key, (value or 0) + arg)
+            elif op in ['$push', '$addToSet']:
+                items   = arg['$each'] if isinstance(arg, dict) and \
+                                                '$each' in arg else [arg]
+                current = list(value) if found else []
+                for each in items:
+                    if op == '$push' or each not in current:
+                        current.append(each)
+                set_path(new, key, current)
+            elif op == '$pull':
+                if found and type(value) is list:
+                    if isinstance(arg, dict) and any(k.startswith('$') for k in arg):
+                        kept    = [x for x in value if not match_value(True, x, arg)]
+                    elif isinstance(arg, dict):
+                        kept    = [x for x in value if not (isinstance(x, dict) \
+                                                    and match_doc(x, arg))]
+                    else:
+                        kept    = [x for x in value if x != arg]
+                    set_path(new, key, kept)
+            else:
+                raise ValueError('Unsupported update operator %s' % op)
+    return new
+
+#### run_pipeline(database, docs, pipeline) ##################################
+# This function runs an aggregation pipeline over a list of documents. It    #
+# covers $match, $project, $addFields/$set, $unset, $group, $sort, $skip,    #
+# $limit, $unwind, $count, $replaceRoot, $lookup and $unionWith.             #
+# Return: list of dictionaries                                               #
+##############################################################################
+def run_pipeline(database, docs, pipeline):
+    for stage in pipeline:
+        op          = stage.keys()[0]
+        arg         = stage[op]
+        if op == '$match':
+            docs    = [x for x in docs if match_doc(x, arg)]
+        elif op == '$project':
+            docs    = [project_stage(x, arg) for x in docs]
+        elif op in ['$addFields', '$set']:
+            for doc in docs:
+                for key in arg:
+                    value   = eval_expr(arg[key], doc)
+                    if value is memory_missing:
+                        unset_path(doc, key)
+                    else:
+                        set_path(doc, key, value)
+        elif op == '$unset':
+            for doc in docs:
+                for key in ([arg] if isinstance(arg, basestring) else arg):
+                    unset_path(doc, key)
+        elif op == '$group':
+            docs    = group_stage(docs, arg)
+        elif op == '$sort':
+            for field in reversed(arg.keys()):
+                docs.sort(key = lambda x: bson_order(doc_value(x, field)[1]), \
+                            reverse = arg[field] < 0)
+        elif op == '$skip':
+            docs    = docs[arg:]
+        elif op == '$limit':
+            docs    = docs[:arg]
+        elif op == '$unwind':
+            docs    = unwind_stage(docs, arg)
+        elif op == '$count':
+            docs    = [{arg: len(docs)}] if len(docs) > 0 else []
+        elif op == '$replaceRoot':
+            docs    = [eval_expr(arg['newRoot'], x) for x in docs]
+        elif op == '$lookup':
+            other   = database[arg['from']].find()
+            for doc in docs:
+                found, value    = doc_value(doc, arg['localField'])
+                doc[arg['as']]  = [x for x in other if value_equals( \
+                                    doc_value(x, arg['foreignField'])[1], value)]
+        elif op == '$unionWith':
+            if isinstance(arg, basestring):
+                arg = {'coll': arg}
+            other   = database[arg['coll']].aggregate(arg.get('pipeline', []))
+            docs    = docs + list(other)
+        else:
+            raise ValueError('Unsupported aggregation stage %s' % op)
+    return docs
+
+#### project_stage(doc, spec) ################################################
+# This function runs a $project stage on one document.                       #
+# Return: dictionary                                                         #
+##############################################################################
+def project_stage(doc, spec):
+    exclude         = [x for x in spec if spec[x] in [0, False]]
+    if len(exclude) > 0 and len(exclude) == len(spec):
+        result      = copy.deepcopy(doc)
+        for key in exclude:
+            unset_path(result, key)
+        return result
+    
+    result          = {}
+    if spec.get('_id', 1) not in [0, False] and '_id' in doc:
+        result['_id']   = doc['_id']
+    for key in spec:
+        if key == '_id' and spec[key] in [0, 1, True, False]:
+            continue
+        if spec[key] in [1, True]:
+            found, value    = doc_value(doc, key)
+            if found:
+                set_path(result, key, value)
+        else:
+            value   = eval_expr(spec[key], doc)
+            if value is not memory_missing:
+                set_path(result, key, value)
+    return result
+
+#### group_stage(docs, spec) #################################################
+# This function runs a $group stage with the $sum, $avg, $min, $max,         #
+# $first, $last, $push and $addToSet accumulators.                           #
+# Return: list of dictionaries                                               #
+##############################################################################
+def group_stage(docs, spec):
+    groups          = OrderedDict()
+    for doc in docs:
+        key         = eval_expr(spec['_id'], doc)
+        if key is memory_missing:
+            key     = None
+        hashed      = json_util.dumps(key, sort_keys = True)
+        if hashed not in groups:
+            groups[hashed]  = [key, []]
+        groups[hashed][1].append(doc)
+    
+    result          = []
+    for hashed in groups:
+        key, members    = groups[hashed]
+        out         = {'_id': key}
+        for field in spec:
+            if field == '_id':
+                continue
+            op      = spec[field].keys()[0]
+            values  = [eval_expr(spec[field][op], x) for x in members]
+            present = [x for x in values if x is not memory_missing]
+            numbers = [x for x in present if isinstance(x, (int, long, float)) \
+                                                and not isinstance(x, bool)]
+            if op == '$sum':
+                out[field]  = sum(numbers)
+            elif op == '$avg':
+                out[field]  = float(sum(numbers)) / len(numbers) \
+                                                if len(numbers) > 0 else None
+            elif op == '$min':
+                out[field]  = min(present, key = bson_order) if present else None
+            elif op == '$max':
+                out[field]  = max(present, key = bson_order) if present else None
+            elif op == '$first':
+                out[field]  = values[0] if present else None
+            elif op == '$last':
+                out[field]  = values[-1] if present else None
+            elif op == '$push':
+                out[field]  = present
+            elif op == '$addToSet':
+                out[field]  = []
+                for each in present:
+                    if each not in out[field]:
+                        out[field].append(each)
+            else:
+                raise ValueError('Unsupported accumulator %s' % op)
+        result.append(out)
+    return result
+
+#### unwind_stage(docs, spec) ################################################
+# This function runs an $unwind stage.                                       #
+# Return: list of dictionaries                                               #
+##############################################################################
+def unwind_stage(docs, spec):
+    if isinstance(spec, basestring):
+        spec        = {'path': spec}
+    field           = spec['path'][1:]
+    keep            = spec.get('preserveNullAndEmptyArrays', False)
+    result          = []
+    for doc in docs:
+        found, value    = doc_value(doc, field)
+        if type(value) is list and len(value) > 0:
+            for each in value:
+                out = copy.deepcopy(doc)
+                set_path(out, field, each)
+                result.append(out)
+        elif type(value) is not list and found and value is not None:
+            result.append(doc)
+        elif keep:
+            result.append(doc)
+    return result
+
+#### eval_expr(expr, doc, variables = None) ##################################
+# This function evaluates an aggregation expression against a document:      #
+# field paths ($field), variables ($$ROOT, $$REMOVE, $$name), literals and   #
+# the operators this module's pipelines use.                                 #
+# Return: value, or memory_missing for a missing field                       #
+##############################################################################
+def eval_expr(expr, doc, variables = None):
+    if variables is None:
+        variables   = {}
+    if isinstance(expr, basestring) and expr.startswith('$$'):
+        parts       = expr[2:].split('.', 1)
+        if parts[0] == 'ROOT' or parts[0] == 'CURRENT':
+            value   = doc
+        elif parts[0] == 'REMOVE':
+            return memory_missing
+        else:
+            value   = variables[parts[0]]
+        if len(parts) > 1:
+            found, value    = doc_value(value, parts[1])
+            if not found:
+                return memory_missing
+        return value
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        found, value    = doc_value(doc, expr[1:])
+        return value if found else memory_missing
+    if type(expr) is list:
+        return [eval_expr(x, doc, variables) for x in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1 and expr.keys()[0].startswith('$'):
+        return eval_operator(expr.keys()[0], expr.values()[0], doc, variables)
+    result          = {}
+    for key in expr:
+        value       = eval_expr(expr[key], doc, variables)
+        if value is not memory_missing:
+            result[key] = value
+    return result
+
+#### eval_operator(op, arg, doc, variables) ##################################
+# This function evaluates one aggregation expression operator for eval_expr. #
+# Return: value                                                              #
+##############################################################################
+def eval_operator(op, arg, doc, variables):
+    if op == '$literal':
+        return arg
+    if op in ['$filter', '$map']:
+        items       = eval_expr(arg['input'], doc, variables)
+        if items is memory_missing or items is None:
+            return None
+        name        = arg.get('as', 'this')
+        result      = []
+        for each in items:
+            scope           = dict(variables)
+            scope[name]     = each
+            if op == '$filter':
+                if expr_true(eval_expr(arg['cond'], doc, scope)):
+                    result.append(each)
+            else:
+                result.append(eval_expr(arg['in'], doc, scope))
+        return result
+    if op == '$trim':
+        value       = eval_expr(arg['input'], doc, variables)
+        return value.strip() if isinstance(value, basestring) else None
+    if op == '$cond' and isinstance(arg, dict):
+        arg         = [arg['if'], arg['then'], arg['else']]
+    if op == '$cond':
+        if expr_true(eval_expr(arg[0], doc, variables)):
+            return eval_expr(arg[1], doc, variables)
+        return eval_expr(arg[2], doc, variables)
+    if op == '$and':
+        return all(expr_true(eval_expr(x, doc, variables)) for x in arg)
+    if op == '$or':
+        return any(expr_true(eval_expr(x, doc, variables)) for x in arg)
+    
+    args            = eval_expr(arg if type(arg) is list else [arg], doc, variables)
+    values          = [None if x is memory_missing else x for x in args]
+    if op == '$ifNull':
+        for each in values:
+            if each is not None:
+                return each
+        return None
+    if op == '$not':
+        return not expr_true(args[0])
+    if op in ['$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$cmp']:
+        a, b        = bson_order(values[0]), bson_order(values[1])
+        return {'$eq': a == b, '$ne': a != b, '$gt': a > b, '$gte': a >= b,
+                '$lt': a < b, '$lte': a <= b, '$cmp': cmp(a, b)}[op]
+    if op == '$in':
+        return values[0] in (values[1] or [])
+    if op == '$concat':
+        if any(x is None for x in values):
+            return None
+        return u''.join(values)
+    if op == '$toLower':
+        return (values[0] or u'').lower()
+    if op == '$toUpper':
+        return (values[0] or u'').upper()
+    if op == '$split':
+        if values[0] is None:
+            return None
+        return values[0].split(values[1])
+    if op == '$arrayElemAt':
+        items, i    = values
+        if items is None or i >= len(items) or -i > len(items):
+            return memory_missing
+        return items[i]
+    if op == '$size':
+        return len(values[0])
+    if op == '$sum':
+        items       = values[0] if len(values) == 1 and type(values[0]) is list \
+                                                                    else values
+        return sum(x for x in items if isinstance(x, (int, long, float)))
+    if op == '$add':
+        return sum(values)
+    if op == '$subtract':
+        return values[0] - values[1]
+    if op == '$max':
+        return max(values, key = bson_order)
+    if op == '$min':
+        return min(values, key = bson_order)
+    if op == '$setUnion':
+        result      = []
+        for items in values:
+            for each in items or []:
+                if each not in result:
+                    result.append(each)
+        return result
+    raise ValueError('Unsupported expression operator %s' % op)
+
+#### expr_true(value) ########################################################
+# This function applies aggregation truthiness (only false, null, 0 and      #
+# missing are false).                                                        #
+# Return: boolean                                                            #
+##############################################################################
+def expr_true(value):
+    if value is memory_missing or value is None or value is False:
+        return False
+    if isinstance(value, (int, long, float)) and value == 0:
+        return False
+    return True
+
+#### bson_order(value) #######################################################
+# This function gives a sort key that orders mixed values the way mongo      #
+# does across types (null, numbers, strings, objects, arrays, ObjectIds,     #
+# booleans, dates).                                                          #
+# Return: tuple                                                              #
+##############################################################################
+def bson_order(value):
+    if value is None or value is memory_missing:
+        return (0, None)
+    if isinstance(value, bool):
+        return (6, value)
+    if isinstance(value, (int, long, float)):
+        return (1, value)
+    if isinstance(value, basestring):
+        return (2, value)
+    if isinstance(value, dict):
+        return (3, [(k, bson_order(value[k])) for k in value])
+    if type(value) is list:
+        return (4, [bson_order(x) for x in value])
+    if isinstance(value, ObjectId):
+        return (5, value)
+    if isinstance(value, datetime.datetime):
+        return (7, value)
+    return (8, value)
+
 #### pick_db()  ##############################################################
 # This function uses a menu to select between databases from config          #
 # Return: pymongo table                                                      #
 ##############################################################################
 def pick_db():
     # Pick database and form connection to legislator table
-    dbList      = config['db'].keys()
-    database    = list_menu(config['db'], 'Choose database to work in: ')
-    DBclient    = MongoClient(config['db'][database]['url'])
+    database    = pick_db_name()
+    return open_db(database)
+
+#### pick_db_name()  #########################################################
+# This function uses a menu to select between databases from config          #
+# Return: string (database name in config)                                   #
+##############################################################################
+def pick_db_name():
+    return list_menu(config['db'], 'Choose database to work in: ')
+
+#### open_db(database)  ######################################################
+# This function connects to a database from config, refreshing its local     #
+# mirror first when running in local mode (see use_mirror).                  #
+# Return: pymongo table                                                      #
+##############################################################################
+def open_db(database):
+    legTable    = connect_db(database)
+    if local_mode:
+        use_mirror(legTable)
+    return legTable
+
+#### connect_db(database)  ###################################################
+# This function returns the legislator table for a database named in config. #
+# Clients are kept in db_clients so repeated lookups reuse one connection    #
+# pool per database.                                                         #
+# Return: pymongo table                                                      #
+##############################################################################
+def connect_db(database):
+    if sandbox_mode:
+        return sandbox_db(database)
+    with db_lock:
+        if database not in db_clients:
+            db_clients[database]    = MongoClient(config['db'][database]['url'])
+        DBclient    = db_clients[database]
     activeDB    = DBclient[config['db'][database]['name']]
     legTable    = activeDB['legislators']
     return legTable
+
+#### sandbox_db(database)  ###################################################
+# This function returns an in-memory copy of a database's legislator table   #
+# for dry runs. The copy is taken on first use and kept in memory_dbs, so    #
+# every workflow in the session sees the earlier (simulated) writes.         #
+# Return: MemoryCollection                                                   #
+##############################################################################
+def sandbox_db(database):
+    with db_lock:
+        if database not in memory_dbs:
+            DBclient    = MongoClient(config['db'][database]['url'])
+            source      = DBclient[config['db'][database]['name']]
+            memory_dbs[database]    = MemoryDatabase(source.name, source)
+        activeDB    = memory_dbs[database]
+    return activeDB['legislators']
+
+#### federated_query(criteria, databases = None, timeout = fanout_timeout) ###
+# This function runs the same filter against several configured databases at #
+# once. Every returned document is tagged with its source database under the #
+# '_db' key (pop it before writing the document anywhere). timeout is either #
+# seconds for every database or a dict of seconds per database; databases    #
+# that fail or run past their timeout are left out of the results and        #
+# reported in failed.                                                        #
+# Return: list of dictionaries, dict of {database: reason}                   #
+##############################################################################
+def federated_query(criteria, databases = None, timeout = fanout_timeout):
+    if databases is None:
+        databases       = config['db'].keys()
+    results             = {}
+    failed              = {}
+    threads             = []
+    limits              = {}
+    
+    for db in databases:
+        if type(timeout) is dict:
+            limits[db]  = timeout.get(db, fanout_timeout)
+        else:
+            limits[db]  = timeout
+        t               = threading.Thread(target = fanout_worker, \
+                            args = (db, criteria, limits[db], results, failed))
+        t.daemon        = True
+        t.start()
+        threads.append([db, t])
+    
+    start               = time.time()
+    for db, t in threads:
+        t.join(max(0, start + limits[db] - time.time()))
+        if t.is_alive():
+            failed[db]  = 'timed out after %ss' % limits[db]
+            
+    result_list         = []
+    for db in databases:
+        if db in results and db not in failed:
+            result_list += results[db]
+    for db in failed:
+        print 'Partial results: skipped %s (%s)' % (db, failed[db])
+        
+    return result_list, failed
+
+#### fanout_worker(db, criteria, limit, results, failed)  ####################
+# This function is the per-database thread body for federated_query. It      #
+# stores the tagged documents in results, or the error in failed.            #
+# Return: none                                                               #
+##############################################################################
+def fanout_worker(db, criteria, limit, results, failed):
+    if type(criteria) is dict:
+        criteria    = [criteria]
+    items           = []
+    try:
+        table       = connect_db(db)
+        for crit in criteria:
+            items   += list(table.find(crit).max_time_ms(int(limit * 1000)))
+    except Exception as e:
+        failed[db]  = str(e)
+        return
+    for each in items:
+        each['_db'] = db
+    results[db]     = items
+
+#### season_diff(criteria, databases = None) #################################
+# This function compares the legislators matching criteria across the        #
+# configured databases and reports who moved districts and who gained audio  #
+# between them.                                                              #
+# Return: list of strings                                                    #
+##############################################################################
+def season_diff(criteria, databases = None):
+    legs, failed        = federated_query(criteria, databases)
+    people              = {}
+    for each in legs:
+        key             = (each['level'], each['state'], each['name'])
+        people.setdefault(key, []).append(each)
+    
+    output              = []
+    for key in sorted(people):
+        found           = people[key]
+        if len(set(x['_db'] for x in found)) < 2:
+            continue
+        level, state, name  = key
+        districts       = {}
+        audio           = []
+        for each in found:
+            districts[each['_db']]  = each.get('district', '')
+            if has_audio(each):
+                audio.append(each['_db'])
+        if len(set(districts.values())) > 1:
+            moves       = ', '.join('%s: %s' % (db, districts[db]) \
+                                                for db in sorted(districts))
+            output.append('%s %s %s moved districts (%s)' % (level, state, \
+                                                            name, moves))
+        if audio and len(audio) < len(districts):
+            output.append('%s %s %s has audio only in %s' % (level, state, \
+                                                name, ', '.join(sorted(audio))))
+    return output
+
+#### season_task() ###########################################################
+# This function prompts for a filter and prints the cross-season differences #
+# found by season_diff across every configured database.                     #
+# Return: none                                                               #
+##############################################################################
+def season_task():
+    filters         = create_filters()
+    output          = season_diff(filters)
+    if len(output) < 1:
+        print 'No differences between databases.'
+    for line in output:
+        print line
     
 #### create_filters()  #######################################################
 # This function uses a menus to create an lz filter                          #
@@ -264,6 +1929,7 @@ def create_filters():
 # output_list function.                                                      #
 # Return: none                                                               #
 ##############################################################################
+@profiled
 def create_list_auto():
     legTable        = pick_db()    
     filters         = create_filters()
@@ -276,60 +1942,526 @@ def create_list_auto():
         for each in filters:
             each[null_filter] = []
         
-    legislators     = []
-    for criteria in filters:
-        legislators += pull_entries(legTable, criteria)
-    
-    if len(legislators) < 1:
-        print 'This list is empty.'
-        return
+    if not local_mode:
+        with phase('bitmap select'):
+            index   = get_bitmap_index(legTable)
+            ids     = bitmap_ids(index, bitmap_select(index, filters, null_filter))
+        print '%i legislators are missing %s.' % (len(ids), null_filter)
+        if len(ids) < 1:
+            return
         
     description     = 'This is a list of legislators missing %s.' % null_filter
+    
+    with phase('fetch'):
+        if local_mode:
+            legislators = []
+            for criteria in filters:
+                legislators += pull_entries(legTable, criteria)
+        else:
+            # Streamed to the file by output_list; the filter is re-applied
+            # in case the index is behind the collection
+            legislators = legTable.find({'$and': [{'_id': {'$in': ids}}, 
+                                                criteria_query(filters)]})
+        
     desc            = []
     desc.append(description)
     
     audio = null_filter == 'audio'
-    output_list(legislators, desc, audio)
+    with phase('export'):
+        output_list(legislators, desc, audio)
     
 
 
-#### create_list_man() #######################################################
-# This function creates a list of legislators missing data using by          #
-# the user to directly type a filter. It then sends this list to the         #
-# output_list function.                                                      #
+#### get_bitmap_index(table) #################################################
+# This function returns the bitmap index of a table's database, loading it   #
+# from bitmap_path or building it when there is no usable copy. On every use #
+# the index is checked against the collection's fingerprint, so writes made  #
+# outside this process are caught up (see bitmap_refresh) or the index is    #
+# rebuilt. An index that changed is saved again.                             #
+# Return: dictionary                                                         #
+##############################################################################
+def get_bitmap_index(table):
+    name            = table.database.name
+    index           = bitmap_indexes.get(name)
+    if index is None:
+        index       = load_bitmap_index(table)
+    if index is not None and not index['stale']:
+        fingerprint = bitmap_fingerprint(table)
+        if index.get('fingerprint') != fingerprint and \
+                            not bitmap_refresh(table, index, fingerprint):
+            index   = None
+    if index is None or index['stale']:
+        index       = build_bitmap_index(table)
+    elif index.get('dirty'):
+        save_bitmap_index(table, index)
+    bitmap_indexes[name]    = index
+    return index
+
+#### build_bitmap_index(table) ###############################################
+# This function builds the bitmap index of a table. Every legislator gets a  #
+# small integer position, and each bitset (a python long) has the bits of    #
+# the legislators in one level, one state, or missing audio, emails, phones  #
+# or networks set. Only those flags are sent by the server.                  #
+# Return: dictionary                                                         #
+##############################################################################
+def build_bitmap_index(table):
+    index           = {'ids': [], 'pos': {}, 'bits': {}, 'stale': False, 
+                        'fingerprint': bitmap_fingerprint(table)}
+    positions       = {}
+    for doc in table.aggregate([{'$project': bitmap_fields}]):
+        pos                     = len(index['ids'])
+        index['ids'].append(doc['_id'])
+        index['pos'][doc['_id']]    = pos
+        for key in bitmap_keys(doc):
+            positions.setdefault(key, []).append(pos)
+    
+    size            = len(index['ids'])
+    for key in positions:
+        buf         = bytearray((size + 7) / 8)
+        for pos in positions[key]:
+            buf[pos >> 3]   |= 1 << (pos & 7)
+        buf.reverse()
+        index['bits'][key]  = long(binascii.hexlify(buf), 16)
+    save_bitmap_index(table, index)
+    return index
+
+#### bitmap_refresh(table, index, fingerprint) ###############################
+# This function catches an index up with the collection's fingerprint: the   #
+# legislators modified at or since the index's newest date_modified are      #
+# added again, and the index is kept only if it then holds as many           #
+# legislators as the collection (deletes cannot be caught up this way).      #
+# Return: boolean, whether the index is current                              #
+##############################################################################
+def bitmap_refresh(table, index, fingerprint):
+    stamp           = (index.get('fingerprint') or [0, None])[1]
+    if stamp is None:
+        return False
+    pipeline        = [{'$match': {'date_modified': {'$gte': stamp}}}, 
+                        {'$project': bitmap_fields}]
+    for doc in table.aggregate(pipeline):
+        bitmap_add(index, doc)
+    live            = bin(index['bits'].get(('live',), 0)).count('1')
+    if live != fingerprint[0]:
+        return False
+    index['fingerprint']    = fingerprint
+    index['dirty']  = True
+    return True
+
+#### bitmap_keys(doc) ########################################################
+# This function lists the bitsets a projected legislator belongs in.         #
+# Return: list of tuples                                                     #
+##############################################################################
+def bitmap_keys(doc):
+    keys            = [('live',), ('level', doc.get('level')), 
+                        ('state', doc.get('state'))]
+    for target in ['audio', 'emails', 'phones', 'networks']:
+        if doc.get(target):
+            keys.append(('missing', target))
+    return keys
+
+#### bitmap_project(doc) #####################################################
+# This function turns a full legislator into the flags bitmap_fields has the #
+# server compute.                                                            #
+# Return: dictionary                                                         #
+##############################################################################
+def bitmap_project(doc):
+    flags               = {}
+    flags['_id']        = doc['_id']
+    flags['level']      = doc.get('level')
+    flags['state']      = doc.get('state')
+    flags['audio']      = doc.get('audio_path') == ''
+    for target in ['emails', 'phones', 'networks']:
+        flags[target]   = doc.get(target) == []
+    return flags
+
+#### bitmap_add(index, doc) ##################################################
+# This function adds a projected legislator to the index, replacing its old  #
+# bits if it is already there.                                               #
+# Return: none                                                               #
+##############################################################################
+def bitmap_add(index, doc):
+    if doc['_id'] in index['pos']:
+        bitmap_remove(index, doc['_id'])
+        pos         = index['pos'][doc['_id']]
+    else:
+        pos         = len(index['ids'])
+        index['ids'].append(doc['_id'])
+        index['pos'][doc['_id']]    = pos
+    for key in bitmap_keys(doc):
+        index['bits'][key]  = index['bits'].get(key, 0) | (1 << pos)
+
+#### bitmap_remove(index, _id) ###############################################
+# This function clears a legislator's bits. Its position is kept, so it is   #
+# reused if the legislator comes back.                                       #
+# Return: none                                                               #
+##############################################################################
+def bitmap_remove(index, _id):
+    if _id not in index['pos']:
+        return
+    mask            = ~(1 << index['pos'][_id])
+    for key in index['bits']:
+        index['bits'][key]  &= mask
+
+#### bitmap_hook(table, action, items) #######################################
+# This write hook keeps loaded bitmap indexes current. Writes that do not    #
+# name their documents by _id mark the index stale, so it is rebuilt on its  #
+# next use. The index then takes the collection's new fingerprint. The saved #
+# copy is deleted, since this module's writes do not always change its       #
+# fingerprint; get_bitmap_index saves the index again.                       #
+# Return: none                                                               #
+##############################################################################
+def bitmap_hook(table, action, items):
+    if table.name != 'legislators':
+        return
+    filename        = bitmap_file(table)
+    if filename is not None and os.path.isfile(filename):
+        os.remove(filename)
+    index           = bitmap_indexes.get(table.database.name)
+    if index is None or index['stale']:
+        return
+    index['dirty']  = True
+    if action == 'insert':
+        for doc in items:
+            bitmap_add(index, bitmap_project(doc))
+        index['fingerprint']    = bitmap_fingerprint(table)
+        return
+    
+    ids             = []
+    for query in items:
+        found       = query_ids(query)
+        if found is None:
+            index['stale']  = True
+            return
+        ids         += found
+    for each in ids:
+        bitmap_remove(index, each)
+    if action == 'update':
+        pipeline    = [{'$match': {'_id': {'$in': ids}}}, 
+                        {'$project': bitmap_fields}]
+        for doc in table.aggregate(pipeline):
+            bitmap_add(index, doc)
+    index['fingerprint']    = bitmap_fingerprint(table)
+
+#### bitmap_select(index, filters, target) ###################################
+# This function answers a create_filters filter list plus a missing field    #
+# (audio, emails, phones or networks) with bitwise operations.               #
+# Return: long (bitset)                                                      #
+##############################################################################
+def bitmap_select(index, filters, target):
+    bits            = 0
+    for crit in filters:
+        match       = index['bits'].get(('live',), 0)
+        for field in ['level', 'state']:
+            if field in crit:
+                match   &= index['bits'].get((field, crit[field]), 0)
+        bits        |= match
+    return bits & index['bits'].get(('missing', target), 0)
+
+#### bitmap_ids(index, bits) #################################################
+# This function lists the _ids of the legislators whose bits are set.        #
+# Return: list of _ids                                                       #
+##############################################################################
+def bitmap_ids(index, bits):
+    digits          = bin(bits)[:1:-1]
+    return [index['ids'][i] for i in range(0, len(digits)) if digits[i] == '1']
+
+#### save_bitmap_index(table, index) #########################################
+# This function writes a bitmap index to bitmap_path, with the fingerprint   #
+# (collection count and newest date_modified) it was last current at.        #
+# Return: none                                                               #
+##############################################################################
+def save_bitmap_index(table, index):
+    filename        = bitmap_file(table)
+    if filename is None:
+        return
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    index['dirty']  = False
+    f               = open(filename, 'wb')
+    cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+#### bitmap_file(table) ######################################################
+# This function names the saved bitmap index of a table's database. Dry runs #
+# keep their indexes in memory only.                                         #
+# Return: string, or None when bitmap_path is not set or in a dry run        #
+##############################################################################
+def bitmap_file(table):
+    if config.get('bitmap_path', '') == '' or sandbox_mode:
+        return None
+    return os.path.join(config['bitmap_path'], table.database.name + '.bitmap')
+
+#### load_bitmap_index(table) ################################################
+# This function loads a saved bitmap index; get_bitmap_index checks it       #
+# against the collection.                                                    #
+# Return: dictionary or None                                                 #
+##############################################################################
+def load_bitmap_index(table):
+    filename        = bitmap_file(table)
+    if filename is None or not os.path.isfile(filename):
+        return None
+    f               = open(filename, 'rb')
+    index           = cPickle.load(f)
+    f.close()
+    return index
+
+#### bitmap_fingerprint(table) ###############################################
+# This function summarizes a collection by count and newest date_modified.   #
+# Return: list                                                               #
+##############################################################################
+def bitmap_fingerprint(table):
+    newest          = list(table.find({}, {'date_modified': 1}).sort( \
+                                            'date_modified', -1).limit(1))
+    stamp           = None
+    if len(newest) > 0:
+        stamp       = newest[0].get('date_modified')
+    return [table.count_documents({}), stamp]
+
+#### create_list_man(filters = '') ###########################################
+# This function creates a list of legislators from a filter typed by the     #
+# user (see compile_filter), pulled with one server-side query. A filter     #
+# ending in --explain (or the --explain flag) prints the compiled query and  #
+# the server's plan first. It then sends this list to the output_list        #
+# function.                                                                  #
 # Return: none                                                               #
 ##############################################################################
 def create_list_man(filters = ''):
     legTable        = pick_db() 
 
-    if filters == '':
-        finished        = False
-        while not finished:
-            criteria        = raw_input('Enter custom filter: ')
-            if len(filters) > 0:
-                finished    = True
-            else:
-                print 'Bad filter.'
+    finished        = False
+    while not finished:
+        if filters == '':
+            filters     = raw_input('Enter custom filter: ')
+        text            = filters.strip()
+        explain         = '--explain' in sys.argv or text.endswith('--explain')
+        if text.endswith('--explain'):
+            text        = text[:-len('--explain')].strip()
+        try:
+            query, fields   = compile_filter(text)
+            finished        = True
+        except ValueError as e:
+            print 'Bad filter: %s' % e
+            filters         = ''
     
-    legislators     = pull_entries(legTable, criteria)
+    # Columnar exports carry every field, so only CSV is projected
+    fmt             = pick_format()
+    if fmt != 'CSV':
+        fields      = None
+    if explain:
+        explain_filter(legTable, query, fields)
+    legislators     = pull_entries(legTable, query, fields = fields)
     
     if len(legislators) < 1:
         print 'This list is empty.'
         return
         
-    description     = 'This is a list of legislators matching the criteria: %s.' % criteria
+    description     = 'This is a list of legislators matching the criteria: %s.' % text
     desc            = []
     desc.append(description)
     
-    output_list(legislators, desc)
+    output_list(legislators, desc, fmt = fmt)
+
+#### compile_filter(text) ####################################################
+# This function compiles a filter expression into one mongo query and the    #
+# projection of the fields output_list writes. Terms are field = value,      #
+# field != value, field in (a, b), field not in (a, b), field is empty,      #
+# field is not empty and the flags in filter_flags (has_audio, ...); they    #
+# combine with and, or, not and parentheses. Values with spaces or commas    #
+# are quoted. Example:                                                       #
+#   level in (state-upper,state-lower) and state=CA and emails is empty and  #
+#   not has_audio                                                            #
+# Raises ValueError on a filter it cannot read.                              #
+# Return: list (query dictionary, projection dictionary)                     #
+##############################################################################
+def compile_filter(text):
+    tokens          = filter_tokens(text)
+    if len(tokens) == 0:
+        raise ValueError('the filter is empty')
+    query           = filter_expr(tokens)
+    if len(tokens) > 0:
+        raise ValueError('unexpected %s' % tokens[0])
+    fields          = dict((x, 1) for x in filter_fields)
+    return [query, fields]
+
+#### filter_tokens(text) #####################################################
+# This function splits a filter expression into words, quoted values,        #
+# parentheses, commas and the = and != operators.                            #
+# Return: list of strings                                                    #
+##############################################################################
+def filter_tokens(text):
+    tokens          = []
+    pos             = 0
+    text            = text.strip()
+    while pos < len(text):
+        match       = filter_token.match(text, pos)
+        if match is None:
+            raise ValueError('cannot read %s' % text[pos:])
+        tokens.append(match.group(1))
+        pos         = match.end()
+    return tokens
+
+#### filter_expr(tokens, joiner = 'or') ######################################
+# This function reads terms joined by joiner from the front of tokens: or    #
+# joins and-groups, and joins single terms (see filter_term). And-groups     #
+# with distinct fields are merged into one query dictionary.                 #
+# Return: dictionary                                                         #
+##############################################################################
+def filter_expr(tokens, joiner = 'or'):
+    parts           = []
+    while True:
+        if joiner == 'or':
+            parts.append(filter_expr(tokens, 'and'))
+        else:
+            parts.append(filter_term(tokens))
+        if len(tokens) == 0 or tokens[0].lower() != joiner:
+            break
+        tokens.pop(0)
+    
+    if len(parts) == 1:
+        return parts[0]
+    if joiner == 'and':
+        keys        = [x for part in parts for x in part]
+        if len(keys) == len(set(keys)):
+            query   = {}
+            for part in parts:
+                query.update(part)
+            return query
+    return {'$' + joiner: parts}
+
+#### filter_term(tokens) #####################################################
+# This function reads one term from the front of tokens: a negated term      #
+# ($nor), a parenthesized expression, a flag or a field comparison.          #
+# Return: dictionary                                                         #
+##############################################################################
+def filter_term(tokens):
+    if len(tokens) == 0:
+        raise ValueError('the filter ends early')
+    token           = tokens.pop(0)
+    if token.lower() == 'not':
+        return {'$nor': [filter_term(tokens)]}
+    if token == '(':
+        query       = filter_expr(tokens)
+        if len(tokens) == 0 or tokens.pop(0) != ')':
+            raise ValueError('missing )')
+        return query
+    if token.lower() in filter_flags:
+        return copy.deepcopy(filter_flags[token.lower()])
+    
+    field           = filter_field(token)
+    op              = tokens.pop(0).lower() if len(tokens) > 0 else ''
+    if op == '=':
+        return {field: filter_value(tokens)}
+    elif op == '!=':
+        return {field: {'$ne': filter_value(tokens)}}
+    elif op == 'is':
+        negate      = len(tokens) > 0 and tokens[0].lower() == 'not'
+        if negate:
+            tokens.pop(0)
+        if len(tokens) == 0 or tokens.pop(0).lower() != 'empty':
+            raise ValueError('expected empty after %s is' % field)
+        return {field: {'$nin' if negate else '$in': ['', [], None]}}
+    elif op in ['in', 'not']:
+        if op == 'not' and (len(tokens) == 0 or tokens.pop(0).lower() != 'in'):
+            raise ValueError('expected in after %s not' % field)
+        if len(tokens) == 0 or tokens.pop(0) != '(':
+            raise ValueError('expected ( after %s %s' % (field, op))
+        values      = [filter_value(tokens)]
+        while len(tokens) > 0 and tokens[0] == ',':
+            tokens.pop(0)
+            values.append(filter_value(tokens))
+        if len(tokens) == 0 or tokens.pop(0) != ')':
+            raise ValueError('missing ) after %s values' % field)
+        return {field: {'$nin' if op == 'not' else '$in': values}}
+    raise ValueError('expected =, !=, in or is after %s' % field)
+
+#### filter_field(token) #####################################################
+# This function checks that a (possibly dotted) field of a filter is one the #
+# legislators have.                                                          #
+# Return: string                                                             #
+##############################################################################
+def filter_field(token):
+    if token.split('.')[0] not in field_list + filter_extra:
+        raise ValueError('unknown field %s' % token)
+    return token
+
+#### filter_value(tokens) ####################################################
+# This function reads one value from the front of tokens, unquoting quoted   #
+# values. Bare true, false and null are the matching constants.              #
+# Return: string, boolean or none                                            #
+##############################################################################
+def filter_value(tokens):
+    if len(tokens) == 0 or tokens[0] in ['(', ')', ',', '=', '!=']:
+        raise ValueError('expected a value')
+    token           = tokens.pop(0)
+    if token[0] in '\'"':
+        return token[1:-1]
+    constants       = {'true': True, 'false': False, 'null': None}
+    if token.lower() in constants:
+        return constants[token.lower()]
+    return token
+
+#### explain_filter(table, query, fields) ####################################
+# This function prints a compiled filter and, on a live database, the        #
+# winning plan and execution counts the server reports for it.               #
+# Return: none                                                               #
+##############################################################################
+def explain_filter(table, query, fields):
+    print 'Query:      %s' % json_util.dumps(query, sort_keys = True)
+    print 'Projection: %s' % json_util.dumps(fields, sort_keys = True)
+    if local_mode or sandbox_mode:
+        print 'Plan:       none (not run on the server)'
+        return
+    try:
+        plan        = table.find(query, fields).explain()
+    except PyMongoError as e:
+        print 'Plan:       unavailable (%s)' % e
+        return
+    
+    winning         = plan.get('queryPlanner', {}).get('winningPlan', {})
+    print 'Plan:'
+    for line in plan_lines(winning.get('queryPlan', winning)):
+        print '    %s' % line
+    stats           = plan.get('executionStats')
+    if stats is not None:
+        print 'Returned %s documents; examined %s keys and %s documents in %s ms' % \
+                (stats.get('nReturned'), stats.get('totalKeysExamined'),
+                 stats.get('totalDocsExamined'), stats.get('executionTimeMillis'))
+
+#### plan_lines(stage, depth = 0) ############################################
+# This function lays out a query plan stage and its inputs, one indented     #
+# line per stage with the index it scans.                                    #
+# Return: list of strings                                                    #
+##############################################################################
+def plan_lines(stage, depth = 0):
+    line            = '  ' * depth + stage.get('stage', '?')
+    if 'indexName' in stage:
+        line        += ' %s' % stage['indexName']
+    lines           = [line]
+    children        = stage.get('inputStages', [])
+    if 'inputStage' in stage:
+        children    = [stage['inputStage']]
+    for child in children:
+        lines       += plan_lines(child, depth + 1)
+    return lines
 
-#### output_list(legislators, description, audio = True) #####################
-# This function outputs a list of legislators which are missing information  #
-# to a csv file. It prompts the user for the tile name, and puts the         #
-# description arg at the top of the file, above the headers                  #
+#### output_list(legislators, description, audio = True, fmt = None) #########
+# This function outputs a list of legislators (a list or a query cursor)     #
+# which are missing information to a csv file. It prompts the user for the   #
+# tile name, and puts the description arg at the top of the file, above the  #
+# headers. fmt (asked with pick_format when not given) can also send the     #
+# legislators to a Parquet or Arrow file (see output_columnar). Nothing is   #
+# written for an empty list.                                                 #
 # Return: none                                                               #
 ##############################################################################
-def output_list(legislators, description, audio = True):
+def output_list(legislators, description, audio = True, fmt = None):
+    if isinstance(legislators, list) and len(legislators) < 1:
+        print 'This list is empty.'
+        return
+    if fmt is None:
+        fmt         = pick_format()
+    if fmt != 'CSV':
+        output_columnar(legislators, ' '.join(description), fmt.lower())
+        return
     
     finished        = False
     while not finished:
@@ -351,6 +2483,7 @@ def output_list(legislators, description, audio = True):
     outwriter.writerow(description)
     outwriter.writerow(headers)
     
+    count           = 0
     for person in legislators:
         row         = []
         if 'district' not in person:
@@ -358,63 +2491,644 @@ def output_list(legislators, description, audio = True):
         for head in headers:
             row.append(person[head])
         outwriter.writerow(row)
+        count       += 1
 
     f.close()
+    if count < 1:
+        os.remove(outfile)
+        print 'This list is empty.'
     
+#### pick_format() ###########################################################
+# This function asks for the output format of a list: CSV, or Parquet and    #
+# Arrow when pyarrow is installed.                                           #
+# Return: string                                                             #
+##############################################################################
+def pick_format():
+    if pyarrow is None:
+        return 'CSV'
+    return list_menu(['CSV', 'Parquet', 'Arrow'], 'Choose the output format: ')
+
+
+#### output_columnar(legislators, description, fmt) ##########################
+# This function prompts for a file name and exports legislators (a list or   #
+# a query cursor) with export_columnar.                                      #
+# Return: none                                                               #
+##############################################################################
+def output_columnar(legislators, description, fmt):
+    finished        = False
+    while not finished:
+        outfile     = raw_input('Enter filename for output %s: ' % fmt)
+        if len(outfile) < 1:
+            print 'File name too short.'
+        else:
+            try:
+                count       = export_columnar(legislators, outfile, \
+                                                description, fmt)
+                finished    = True
+            except IOError:
+                print 'Bad file name.'
+    if count < 1:
+        os.remove(outfile)
+        print 'This list is empty.'
+    else:
+        print 'Wrote %i legislators to %s' % (count, outfile)
+
+#### export_columnar(legislators, outfile, description, fmt) #################
+# This function writes legislators with every field in field_list (plus      #
+# filename) to a Parquet file or an Arrow IPC (Feather) file, one record     #
+# batch of row_group_size rows at a time, so a query cursor is never fully   #
+# held in memory. emails, phones and networks become list columns with one   #
+# JSON string per entry. The description is stored in the file metadata.     #
+# Return: number of legislators written                                      #
+##############################################################################
+def export_columnar(legislators, outfile, description = '', fmt = 'parquet', 
+                    row_group_size = export_row_group):
+    schema          = columnar_schema().with_metadata({'description': 
+                                                description.encode('utf-8')})
+    if fmt == 'parquet':
+        writer      = pyarrow.parquet.ParquetWriter(outfile, schema)
+    else:
+        sink        = pyarrow.OSFile(outfile, 'wb')
+        writer      = pyarrow.RecordBatchFileWriter(sink, schema)
+    
+    count           = 0
+    rows            = []
+    try:
+        for person in legislators:
+            rows.append(person)
+            if len(rows) >= row_group_size:
+                write_batch_columnar(writer, schema, rows, fmt)
+                count   += len(rows)
+                rows    = []
+        if len(rows) > 0:
+            write_batch_columnar(writer, schema, rows, fmt)
+            count       += len(rows)
+    finally:
+        writer.close()
+        if fmt != 'parquet':
+            sink.close()
+    return count
+
+#### write_batch_columnar(writer, schema, rows, fmt) #########################
+# This function converts a list of legislators into one arrow record batch   #
+# and hands it to the open writer.                                           #
+# Return: none                                                               #
+##############################################################################
+def write_batch_columnar(writer, schema, rows, fmt):
+    arrays          = []
+    for field in schema:
+        column      = []
+        for person in rows:
+            value   = person.get(field.name)
+            if value is None:
+                pass
+            elif field.name == '_id':
+                value   = str(value)
+            elif field.name in ['emails', 'phones', 'networks']:
+                value   = [json_util.dumps(x, sort_keys = True) \
+                                                            for x in value]
+            elif field.type == pyarrow.string():
+                value   = unicode(value)
+            column.append(value)
+        arrays.append(pyarrow.array(column, type = field.type))
+    batch           = pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+    if fmt == 'parquet':
+        writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer.write_batch(batch)
+
+#### columnar_schema() #######################################################
+# This function builds the arrow schema used by export_columnar.             #
+# Return: pyarrow schema                                                     #
+##############################################################################
+def columnar_schema():
+    nested          = pyarrow.list_(pyarrow.string())
+    types           = {
+                        '__v': pyarrow.int64(),
+                        'active': pyarrow.bool_(),
+                        'needs_audio': pyarrow.bool_(),
+                        'needs_review': pyarrow.bool_(),
+                        'date_added': pyarrow.timestamp('ms'),
+                        'date_modified': pyarrow.timestamp('ms'),
+                        'emails': nested,
+                        'phones': nested,
+                        'networks': nested}
+    fields          = []
+    for name in field_list + ['filename']:
+        fields.append(pyarrow.field(name, types.get(name, pyarrow.string())))
+    return pyarrow.schema(fields)
+
+#### move_task() #############################################################
+# This function prompts the user for two databases and a filter. It then     #
+# moves all documents matching the filter from one database to the other.    #
+# Copies run as journaled jobs (see run_move_job) and an unfinished move can #
+# be resumed instead of started over. 'Add A when no B' only adds the        #
+# legislators whose seat (see seat_tuple) nobody in B holds.                 #
+# Return: none                                                               #
+##############################################################################
+@profiled
+def move_task():
+    job             = resume_job('move')
+    if job is not None:
+        run_move_job(job)
+        return
+    
+    print 'Pick the database to move files from (DB A).'
+    source          = pick_db_name()
+    print 'Pick the database to move files to (DB B)'
+    dest            = pick_db_name()
+    sourceTable     = connect_db(source)
+    destTable       = connect_db(dest)
+
+    filters     = create_filters()
+                
+    move_menu       = ['Add A to B', 'Add A when no B', 
+                        'Overwrite B when seats match', 'Clear B then add A']
+    finished        = False
+    while not finished:
+        task        = list_menu(move_menu, 'Choose your move type: ')
+        if task == 'Add A when no B':
+            legA    = pull_entries(sourceTable, filters)
+            fields  = {'level': 1, 'state': 1, 'district': 1}
+            seatsB  = set(seat_tuple(x) for x in \
+                                pull_entries(destTable, filters, fields = fields))
+            legislators = [x for x in legA if seat_tuple(x) not in seatsB]
+            bulk_insert(destTable, legislators)
+            finished = True
+        elif task in ['Add A to B', 'Overwrite B when seats match', 
+                                                    'Clear B then add A']:
+            job                 = new_job('move', filters)
+            job['source']       = source
+            job['dest']         = dest
+            job['mode']         = task
+            job['raw']          = task != 'Overwrite B when seats match'
+            job['cleared']      = False
+            job['last_id']      = None
+            job['copied']       = 0
+            save_job(job)
+            run_move_job(job)
+            finished = True
+
+#### run_move_job(job) #######################################################
+# This function runs (or resumes) a journaled move. The destination is       #
+# cleared first for 'Clear B then add A', then the source is read in _id     #
+# order, job_chunk documents at a time, and each chunk is written as         #
+# ReplaceOne upserts keyed on _id (or on the seat for 'Overwrite B when      #
+# seats match'). Jobs marked raw read RawBSONDocuments and pass the bytes    #
+# straight through (see copy_raw). The source is split by plan_partitions    #
+# and up to move_workers partitions are copied at once. The journal is saved #
+# after every committed step, so replaying a chunk after a failure is        #
+# harmless. Raw copies get their name keys in one backfill at the end.       #
+# Return: none                                                               #
+##############################################################################
+def run_move_job(job):
+    if not job_runnable(job):
+        return
+    sourceTable     = connect_db(job['source'])
+    destTable       = connect_db(job['dest'])
+    query           = criteria_query(job['filters'])
+    
+    if job['mode'] == 'Clear B then add A' and not job['cleared']:
+        with phase('clear'):
+            result      = destTable.delete_many(query)
+        notify_write(destTable, 'delete', [query])
+        print 'Cleared %i legislators from %s' % (result.deleted_count, \
+                                                                job['dest'])
+        job['cleared']  = True
+        save_job(job)
+    
+    overwrite       = job['mode'] == 'Overwrite B when seats match'
+    if overwrite:
+        shared      = shared_seats(sourceTable, query)
+    raw             = job.get('raw', False) and not overwrite
+    if raw:
+        sourceTable = sourceTable.with_options(codec_options = \
+                                CodecOptions(document_class = RawBSONDocument))
+    
+    if 'partitions' not in job:
+        job['partitions']   = plan_partitions(sourceTable, job, query)
+        save_job(job)
+    
+    todo            = [x for x in job['partitions'] if not x['done']]
+    workers         = min(int(config.get('move_workers', move_workers)), len(todo))
+    if workers > 1:
+        print 'Copying %i partitions with %i workers' % (len(todo), workers)
+    pending         = Queue.Queue()
+    for part in todo:
+        pending.put(part)
+    copier          = {'source': sourceTable, 'dest': destTable, 'raw': raw,
+                        'overwrite': overwrite, 'errors': [],
+                        'shared': shared if overwrite else None}
+    threads         = []
+    for i in range(1, workers):
+        thread      = threading.Thread(target = move_worker, \
+                                        args = (job, pending, copier))
+        thread.daemon   = True
+        thread.start()
+        threads.append(thread)
+    move_worker(job, pending, copier)
+    for thread in threads:
+        thread.join()
+    if len(copier['errors']) > 0:
+        raise copier['errors'][0]
+    if raw:
+        backfill_name_keys(destTable, {'$and': [query, name_keys_missing()]})
+    
+    job['done']     = True
+    save_job(job)
+
+#### plan_partitions(table, job, query) ######################################
+# This function splits a move into partitions that can be copied in          #
+# parallel: one per filter when the move has several (level/state) filters,  #
+# otherwise move_workers ranges of _id creation time between the oldest and  #
+# newest source ObjectId. Sources with other kinds of _id, and journals of   #
+# moves started before partitioning, stay a single partition.                #
+# Return: list of dictionaries (label, query, last_id, copied, done)         #
+##############################################################################
+def plan_partitions(table, job, query):
+    parts           = []
+    filters         = job['filters']
+    if isinstance(filters, list) and len(filters) > 1 and \
+                                            job.get('last_id') is None:
+        for each in filters:
+            label   = ' '.join(str(each[x]) for x in sorted(each))
+            parts.append([label, criteria_query(each)])
+    
+    count           = int(config.get('move_workers', move_workers))
+    if len(parts) < 1 and count > 1 and job.get('last_id') is None:
+        ids         = [list(table.find(query, {'_id': 1}).sort('_id', x) \
+                                                    .limit(1)) for x in [1, -1]]
+        if len(ids[0]) > 0 and isinstance(ids[0][0]['_id'], ObjectId) and \
+                                isinstance(ids[1][0]['_id'], ObjectId):
+            first   = calendar.timegm(ids[0][0]['_id'].generation_time.timetuple())
+            last    = calendar.timegm(ids[1][0]['_id'].generation_time.timetuple())
+            step    = max((last - first) / count + 1, 1)
+            bounds  = [ObjectId.from_datetime(datetime.datetime.utcfromtimestamp( \
+                        first + step * x)) for x in range(1, count)]
+            for i in range(0, len(bounds) + 1):
+                span        = {}
+                if i > 0:
+                    span['$gte']    = bounds[i - 1]
+                if i < len(bounds):
+                    span['$lt']     = bounds[i]
+                label       = '_id range %i' % (i + 1)
+                parts.append([label, {'$and': [query, {'_id': span}]}])
+    
+    if len(parts) < 1:
+        parts       = [['all', query]]
+    partitions      = []
+    for label, crit in parts:
+        partitions.append({'label': label, 'query': crit, 'last_id': None, 
+                            'copied': 0, 'done': False})
+    partitions[0]['last_id']    = job.get('last_id')
+    return partitions
+
+#### move_worker(job, pending, copier) #######################################
+# This function copies partitions from the pending queue until it is empty.  #
+# copier holds the source and destination tables, the write mode (raw,       #
+# overwrite and shared seats) and the list of errors; a failure is added to  #
+# errors and stops every worker after its current chunk.                     #
+# Return: none                                                               #
+##############################################################################
+def move_worker(job, pending, copier):
+    while len(copier['errors']) < 1:
+        try:
+            part    = pending.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            copy_partition(job, part, copier)
+        except Exception as e:
+            copier['errors'].append(e)
+
+#### copy_partition(job, part, copier) #######################################
+# This function copies one partition of a move, resuming after its last      #
+# copied _id. It is read in _id order, job_chunk documents at a time, and    #
+# each chunk goes out through scheduled_write; the partition's progress is   #
+# saved in the job after every chunk.                                        #
+# Return: none                                                               #
+##############################################################################
+def copy_partition(job, part, copier):
+    sourceTable     = copier['source']
+    destTable       = copier['dest']
+    while len(copier['errors']) < 1:
+        crit        = part['query']
+        if part['last_id'] is not None:
+            crit    = {'$and': [crit, {'_id': {'$gt': part['last_id']}}]}
+        with phase('read'):
+            legs    = list(sourceTable.find(crit).sort('_id', 1).limit(job_chunk))
+        if len(legs) < 1:
+            with job_lock:
+                part['done']    = True
+                save_job(job)
+            return
+        with phase('write'):
+            if copier['overwrite']:
+                upsert_seats(destTable, legs, copier['shared'])
+            elif copier['raw']:
+                copy_raw(destTable, legs)
+                notify_write(destTable, 'update', \
+                                    [{'_id': {'$in': [x['_id'] for x in legs]}}])
+            else:
+                requests    = [ReplaceOne({'_id': x['_id']}, add_name_keys(x), \
+                                                upsert = True) for x in legs]
+                scheduled_write(destTable, requests, quiet = True, \
+                                                            strict = True)
+                notify_write(destTable, 'update', \
+                                    [{'_id': {'$in': [x['_id'] for x in legs]}}])
+        with job_lock:
+            part['last_id'] = legs[-1]['_id']
+            part['copied']  += len(legs)
+            job['copied']   += len(legs)
+            save_job(job)
+            print '%s: copied %i (%i in all)' % (part['label'], part['copied'], \
+                                                                job['copied'])
+
+#### copy_raw(table, legs) ###################################################
+# This function copies a chunk of undecoded source documents                 #
+# (RawBSONDocuments or dicts) into a table by _id. The chunk goes out as     #
+# scheduled inserts so the BSON bytes are forwarded untouched; only the      #
+# documents whose _id is already in the table are decoded and written again  #
+# as ReplaceOne upserts. A duplicate key is never taken as an insert that    #
+# landed, since the _id may have been there before the copy. The copies get  #
+# their name keys in one pass once the move is done (see run_move_job).      #
+# Return: none                                                               #
+##############################################################################
+def copy_raw(table, legs):
+    result          = scheduled_write(table, [InsertOne(x) for x in legs], \
+                                        quiet = True, dups_landed = False)
+    errors          = result['writeErrors']
+    if any(x.get('code') != 11000 for x in errors):
+        raise BulkWriteError(result)
+    
+    requests        = []
+    for error in errors:
+        doc         = decode_doc(error['op'])
+        requests.append(ReplaceOne({'_id': doc['_id']}, doc, upsert = True))
+    scheduled_write(table, requests, quiet = True, strict = True)
+
+#### decode_doc(doc) #########################################################
+# This function turns a RawBSONDocument into a dict (dicts pass through).    #
+# Return: dictionary                                                         #
+##############################################################################
+def decode_doc(doc):
+    if isinstance(doc, RawBSONDocument):
+        return BSON(doc.raw).decode()
+    return doc
+
+#### upsert_seats(table, legs, shared = None) ################################
+# This function writes legislators over whoever holds the same seat in the   #
+# table, inserting them when the seat is empty. Seats are matched on level,  #
+# state and district, or level, state and name for fed-upper; seats shared   #
+# by several legislators (see shared_seats) are also matched on name. The    #
+# writes go out as ReplaceOne upserts through scheduled_write.               #
+# Return: dict of matched, modified and upserted counts                      #
+##############################################################################
+def upsert_seats(table, legs, shared = None):
+    if shared is None:
+        seen        = set()
+        shared      = set()
+        for each in legs:
+            key     = seat_tuple(each)
+            if key in seen:
+                shared.add(key)
+            seen.add(key)
+    
+    requests        = []
+    seats           = []
+    for each in legs:
+        doc         = add_name_keys(dict(each))
+        doc.pop('_id', None)
+        seats.append(seat_filter(doc, shared))
+        requests.append(ReplaceOne(seats[-1], doc, upsert = True))
+    result          = scheduled_write(table, requests, quiet = True, \
+                                                            strict = True)
+    notify_write(table, 'update', seats)
+    counts          = {'matched': result['nMatched'], 
+                        'modified': result['nModified'], 
+                        'upserted': result['nUpserted']}
+    
+    print 'Seats matched: %i, modified: %i, inserted: %i' % \
+                    (counts['matched'], counts['modified'], counts['upserted'])
+    return counts
+
+#### seat_filter(doc, shared = ()) ###########################################
+# This function builds the query that finds a legislator's seat.             #
+# Return: dictionary                                                         #
+##############################################################################
+def seat_filter(doc, shared = ()):
+    crit                    = {}
+    crit['level']           = doc['level']
+    crit['state']           = doc['state']
+    if doc['level'] == 'fed-upper':
+        crit['name']        = doc['name']
+    else:
+        crit['district']    = doc.get('district', '')
+        if seat_tuple(doc) in shared:
+            crit['name']    = doc['name']
+    return crit
 
-#### move_task() #############################################################
-# This function prompts the user for two databases and a filter. It then     #
-# moves all documents matching the filter from one database to the other     #
-# Return: none                                                               #
+#### seat_tuple(doc) #########################################################
+# This function returns the (level, state, district) a legislator sits in.   #
+# Return: tuple                                                              #
 ##############################################################################
-def move_task():
-    print 'Pick the database to move files from (DB A).'
-    sourceTable     = pick_db()
-    print 'Pick the database to move files to (DB B)'
-    destTable       = pick_db()
+def seat_tuple(doc):
+    return (doc['level'], doc['state'], doc.get('district', ''))
 
-    filters     = create_filters()
-                
-    move_menu       = ['Add A to B', 'Add A when no B', 'Clear B then add A']
-    finished        = False
-    while not finished:
-        task        = list_menu(move_menu, 'Choose your move type: ')
-        if task == 'Merge A into B':
-            legA    = pull_entries(sourceTable, filters)
-            legB    = pull_entries(destTable, filters)
-            legislators = [x for x in legA if x not in legB]
-            bulk_insert(destTable, legislators)
-            finished = True
-        elif task == 'Add A to B':
-            legislators = pull_entries(sourceTable, filters)
-            bulk_insert(destTable, legislators)
-            finished = True
-        elif task == 'Clear B then add A':
-            bulk_delete(destTable, filters)
-            legislators = pull_entries(sourceTable, filters)
-            bulk_insert(destTable, legislators)
-            finished = True
+#### shared_seats(table, query) ##############################################
+# This function finds the seats held by more than one legislator among the   #
+# documents matching query (multi-member districts).                         #
+# Return: set of (level, state, district) tuples                             #
+##############################################################################
+def shared_seats(table, query):
+    pipeline        = [
+        {'$match': query},
+        {'$group': {'_id': {'level': '$level', 'state': '$state', 
+                            'district': {'$ifNull': ['$district', '']}},
+                    'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}]
+    shared          = set()
+    for each in table.aggregate(pipeline):
+        shared.add(seat_tuple(each['_id']))
+    return shared
 
 #### del_task() ##############################################################
-# This function handles the deletion of documents from a database            #
+# This function handles the deletion of documents from a database. Deletes   #
+# run as journaled jobs (see run_del_job) and can be resumed; merging        #
+# duplicates goes through dedupe_task.                                       #
 # Return: none                                                               #
 ##############################################################################
 def del_task():
-    legTable        = pick_db() 
-    del_menu        = ['Delete by Criteria', 'Delete from List']
+    job             = resume_job('delete')
+    if job is not None:
+        run_del_job(job)
+        return
+    
+    database        = pick_db_name()
+    legTable        = open_db(database)
+    del_menu        = ['Delete by Criteria', 'Delete from List', 
+                        'Merge Duplicates']
     
     finished        = False
     while not finished:
         task            = list_menu(del_menu, 'How would you like to delete: ')
-        if task == 'Delete by Criteria':
+        if task == 'Merge Duplicates':
+            dedupe_task(legTable, create_filters())
+            return
+        elif task == 'Delete by Criteria':
             filters     = create_filters()
             finished    = True
         elif task == 'Delete from List':
             filters     = del_file(legTable)
             finished    = True
     
-    bulk_delete(legTable, filters)
+    if len(filters) > 0 and filters[0] == 'Error':
+        print filters[1]
+        return
+    job             = new_job('delete', filters)
+    job['dest']     = database
+    job['done_filters'] = 0
+    job['deleted']  = 0
+    save_job(job)
+    run_del_job(job)
+
+#### dedupe_task(table, criteria) ############################################
+# This function merges the duplicates among legislators matching criteria:   #
+# exact name duplicates first (remove_dups), then each near-duplicate        #
+# cluster from find_near_dups that the operator confirms (merge_groups).     #
+# Return: none                                                               #
+##############################################################################
+def dedupe_task(table, criteria):
+    remove_dups(table, criteria)
+    clusters        = find_near_dups(table, criteria)
+    id_groups       = []
+    for cluster in clusters:
+        first       = cluster[0]
+        print '\n%s %s district %s' % (first['level'], first['state'], \
+                                                first.get('district', ''))
+        for each in cluster:
+            print '     %s' % each['name']
+        task        = list_menu(['Merge', 'Skip'], 'Merge into %s: ' % \
+                                                                first['name'])
+        if task == 'Merge':
+            id_groups.append([x['_id'] for x in cluster])
+    if len(id_groups) > 0:
+        merge_groups(table, id_groups)
+    else:
+        print 'No near duplicates merged'
+
+#### run_del_job(job) ########################################################
+# This function runs (or resumes) a journaled delete, sending the filters    #
+# job_chunk at a time through scheduled_write and saving the journal after   #
+# each.                                                                      #
+# Return: none                                                               #
+##############################################################################
+def run_del_job(job):
+    if not job_runnable(job):
+        return
+    legTable        = connect_db(job['dest'])
+    filters         = job['filters']
+    while job['done_filters'] < len(filters):
+        chunk       = filters[job['done_filters']:job['done_filters'] + job_chunk]
+        result      = scheduled_write(legTable, [DeleteMany(x) for x in chunk], \
+                                                quiet = True, strict = True)
+        notify_write(legTable, 'delete', chunk)
+        job['done_filters'] += len(chunk)
+        job['deleted']      += result['nRemoved']
+        save_job(job)
+        print 'Deleted %i legislators' % job['deleted']
+    
+    job['done']     = True
+    save_job(job)
+
+#### new_job(task, filters) ##################################################
+# This function starts a journal entry for a bulk job.                       #
+# Return: dictionary                                                         #
+##############################################################################
+def new_job(task, filters):
+    job             = {}
+    job['id']       = '%s-%s' % (task, \
+                        datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+    job['task']     = task
+    job['filters']  = filters
+    job['done']     = False
+    job['dry_run']  = sandbox_mode
+    return job
+
+#### save_job(job) ###########################################################
+# This function writes a job's journal to job_dir, replacing the previous    #
+# checkpoint atomically.                                                     #
+# Return: none                                                               #
+##############################################################################
+def save_job(job):
+    path            = job_dir()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    filename        = os.path.join(path, job['id'] + '.json')
+    f               = open(filename + '.tmp', 'w')
+    f.write(json_util.dumps(job))
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+#### job_dir() ###############################################################
+# This function names the folder of the job journals: job_path, or its       #
+# dry-run subfolder in a dry run, so simulated jobs stay apart from live     #
+# ones.                                                                      #
+# Return: string                                                             #
+##############################################################################
+def job_dir():
+    path            = config.get('job_path', './jobs/')
+    if sandbox_mode:
+        path        = os.path.join(path, 'dry-run')
+    return path
+
+#### job_runnable(job) #######################################################
+# This function refuses to run a dry-run job live (its progress was made on  #
+# in-memory copies) or a live job in a dry run.                              #
+# Return: boolean                                                            #
+##############################################################################
+def job_runnable(job):
+    if job.get('dry_run', False) == sandbox_mode:
+        return True
+    print 'Job %s was journaled %s; it cannot be resumed here.' % (job['id'], \
+                        'in a dry run' if job.get('dry_run') else 'live')
+    return False
+
+#### resume_job(task) ########################################################
+# This function looks for unfinished jobs of one kind in job_dir and asks    #
+# whether to resume one of them. Dry-run jobs are only offered in dry runs,  #
+# and live jobs only live.                                                   #
+# Return: dictionary or None to start a new job                              #
+##############################################################################
+def resume_job(task):
+    path            = job_dir()
+    if not os.path.isdir(path):
+        return None
+    jobs            = {}
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.json'):
+            f       = open(os.path.join(path, filename), 'r')
+            job     = json_util.loads(f.read())
+            f.close()
+            if job.get('dry_run', False) != sandbox_mode:
+                continue
+            if job['task'] == task and not job['done']:
+                if task == 'move':
+                    label   = '%s: %s from %s to %s (%i copied)' % (job['id'], \
+                            job['mode'], job['source'], job['dest'], job['copied'])
+                else:
+                    label   = '%s: delete from %s (%i/%i filters done)' % \
+                            (job['id'], job['dest'], job['done_filters'], \
+                            len(job['filters']))
+                jobs[label] = job
+    if len(jobs) < 1:
+        return None
     
+    choice          = list_menu(sorted(jobs) + ['Start new'], \
+                                        'Resume an unfinished job? ')
+    if choice == 'Start new':
+        return None
+    return jobs[choice]
 
 ########### del_file(legTable) function ######################################
 # This function prompts the user for a csv list of legislators to delete. It #
@@ -422,6 +3136,7 @@ def del_task():
 # corrections need to be made), before returning this as a list of filters.  #
 # Return: list of dictionaries to be used as a filter                        #
 ##############################################################################
+@profiled
 def del_file(legTable):
     
     # Pick file to gather delete information from
@@ -443,50 +3158,41 @@ def del_file(legTable):
                 print 'Bad file name.'
                 
     # Read file
-    del_list                = []
-    value_range             = {}
-    for head in headers:
-        value_range[head]   = []
-    index                   = 0
-    accept_values           = {}
-    accept_values['level']  = level_list
-    accept_values['state']  = states.keys()
-    for row in reader:
-        index               += 1
-        entry               = {}
-        entry['id']         = index
-        for i in range(0, len(headers)):
-            entry[headers[i]]  = row[i]
-            if row[i] not in value_range[headers[i]]:
-                value_range[headers[i]].append(row[i])
-                if headers[i] in ['level','state']:
-                    if row[i] not in accept_values[headers[i]]:
-                        error_msg       = 'Bad %s on row %i' % (headers[i], index)
-                        error_list      = ['Error', error_msg]
-                        return error_list
-                        
-        del_list.append(entry)
-    f.close()    
+    with phase('read file'):
+        result              = read_rows(reader, headers)
+    f.close()
+    if result[0] == 'Error':
+        return result
+    del_list, value_range   = result
     
     # Check for district matched - fix when off
     update_list = []
-    if set(['level', 'state', 'district']) <= set(headers):
-        for level in value_range['level']:
-            if level != 'fed-upper':
-                list_level      = filter_dict(del_list, 'level', level)
-                for state in value_range['state']:
-                    list_state  = filter_dict(list_level, 'state', state)
-                    if len(list_state) > 1:
-                        districts   = load_districts(level, state)
-                        for entry in list_state:
-                            if entry['district'] not in districts:
-                                if (len(entry['district']) > 3):
-                                    no_match = len([i for i, x in \
-                                        enumerate(districts) \
-                                        if re.match(entry['district'] + r'^', x)])
-                                    if no_match != 1:
-                                        update_list.append(unmatched(entry, \
-                                                        'district', districts))
+    with phase('district check'):
+        checks      = []
+        if set(['level', 'state', 'district']) <= set(headers):
+            for level in value_range['level']:
+                if level != 'fed-upper':
+                    list_level      = filter_dict(del_list, 'level', level)
+                    for state in value_range['state']:
+                        list_state  = filter_dict(list_level, 'state', state)
+                        if len(list_state) > 1:
+                            districts   = load_districts(level, state)
+                            for entry in list_state:
+                                if entry['district'] not in districts:
+                                    if (len(entry['district']) > 3):
+                                        no_match = len([i for i, x in \
+                                            enumerate(districts) \
+                                            if re.match(entry['district'] + r'^', x)])
+                                        if no_match != 1:
+                                            checks.append([entry, 'district', \
+                                                                    districts])
+        
+        # Score the next rows while the operator answers this one
+        for check, found in prefetch(checks, lambda x: \
+                                                unmatched_candidates(*x)):
+            with phase('interactive fixes'):
+                update_list.append(unmatched_prompt(check[0], check[1], \
+                                                            check[2], found))
 
     # Clean del_list
     for entry in update_list:
@@ -501,21 +3207,27 @@ def del_file(legTable):
     update_list             = []
     
     # Check for name matched - fix when off
-    if set(['level', 'state', 'name']) <= set(headers):
-        crit                    = {}
-        for level in value_range['level']:
-            list_level          = filter_dict(del_list, 'level', level)
-            crit['level']       = level
-            for state in value_range['state']:
-                list_state      = filter_dict(list_level, 'state', state)
-                crit['state']   = state
-                if len(list_state) > 1:
-                    leg_list    = pull_entries(legTable, crit)
-                    names       = [d['name'] for d in leg_list]
-                    for entry in list_state:
-                        if 'district' not in entry:
-                            update_list.append(unmatched(entry, 'name', names))
-                            
+    with phase('name check'):
+        checks                  = []
+        if set(['level', 'state', 'name']) <= set(headers):
+            for level in value_range['level']:
+                list_level          = filter_dict(del_list, 'level', level)
+                for state in value_range['state']:
+                    list_state      = filter_dict(list_level, 'state', state)
+                    if len(list_state) > 1:
+                        crit        = {'level': level, 'state': state}
+                        for entry in list_state:
+                            if 'district' not in entry:
+                                checks.append([entry, crit])
+        
+        # Pull candidates, score the next rows while the operator answers
+        ensure_name_keys(legTable)
+        for check, found in prefetch(checks, lambda x: \
+                                            roster_candidates(legTable, x)):
+            with phase('interactive fixes'):
+                update_list.append(unmatched_prompt(check[0], 'name', \
+                                                        found[0], found[1]))
+
     # Clean del_list again
     for entry in update_list:
         leg                 = filter_dict(del_list, 'id', entry[0])
@@ -537,43 +3249,306 @@ def del_file(legTable):
     
     return filters
 
+#### notify_write(table, action, items) ######################################
+# This function tells every function in write_hooks about a write to a       #
+# table. action is 'insert' (items are the inserted documents), 'update' or  #
+# 'delete' (items are queries selecting the documents touched). Hooks run    #
+# one write at a time, so writers on several threads are safe.               #
+# Return: none                                                               #
+##############################################################################
+def notify_write(table, action, items):
+    with hook_lock:
+        for hook in write_hooks:
+            hook(table, action, items)
+
+#### query_ids(query) ########################################################
+# This function pulls the _ids out of a query that only selects by _id       #
+# (equality or $in).                                                         #
+# Return: list of _ids, or None when the query selects by anything else      #
+##############################################################################
+def query_ids(query):
+    if query.keys() != ['_id']:
+        return None
+    if isinstance(query['_id'], dict):
+        if query['_id'].keys() != ['$in']:
+            return None
+        return list(query['_id']['$in'])
+    return [query['_id']]
+
 #### bulk_insert(table, records) #############################################
 # This function takes a pymongo table and a list of dictionaries, and adds   #
-# those dictionaries to the table via bulk method.                           #
+# those dictionaries to the table through the write scheduler (see           #
+# scheduled_write). Only the records that landed are passed to the write     #
+# hooks; any write errors are raised after that.                             #
 # Return: none                                                               #
 ##############################################################################   
 def bulk_insert(table, records):
-    # Do the delete
-    bulk    = table.initialize_ordered_bulk_op()
-    for item in records:
-        bulk.insert(item)  
-    result = bulk.execute()
+    # Do the insert
+    requests    = [InsertOne(add_name_keys(item)) for item in records]
+    result      = scheduled_write(table, requests, 'Inserted')
+    notify_write(table, 'insert', landed(records, result))
+    if len(result['writeErrors']) > 0:
+        raise BulkWriteError(result)
     print
     print result
     print
     
 #### bulk_delete(table, filters) #############################################
-# This function takes a pymongo table and a set of filters and uses bulk     #
-# process to delete any matching entries from the table.                     #
+# This function takes a pymongo table and a set of filters and deletes any   #
+# matching entries from the table through the write scheduler (see           #
+# scheduled_write). Only the filters that went through are passed to the     #
+# write hooks; any write errors are raised after that.                       #
 # Return: none                                                               #
 ##############################################################################   
 def bulk_delete(table, filters):
     # Do the delete
-    bulk    = table.initialize_ordered_bulk_op()
-    for f in filters:
-        bulk.find(f).remove()  
-    result = bulk.execute()
+    requests    = [DeleteMany(f) for f in filters]
+    result      = scheduled_write(table, requests, 'Deleted')
+    notify_write(table, 'delete', landed(filters, result))
+    if len(result['writeErrors']) > 0:
+        raise BulkWriteError(result)
     print
     print result
     print
+
+#### landed(items, result) ###################################################
+# This function drops from items (the list a scheduled_write was built from) #
+# the ones whose request is among the result's writeErrors.                  #
+# Return: list                                                               #
+##############################################################################
+def landed(items, result):
+    failed      = set(x['index'] for x in result['writeErrors'])
+    return [x for i, x in enumerate(items) if i not in failed]
+    
+#### scheduled_write(table, requests, label, quiet, strict, dups_landed) #####
+# This function runs pymongo write requests as unordered batches on up to    #
+# write_workers threads, adapting to what the cluster sustains (AIMD): the   #
+# batch size grows by write_min_batch and the batches in flight by one while #
+# batches finish within write_latency seconds, and both are halved when a    #
+# batch takes over twice that or the server throttles or drops the           #
+# connection. The batch size and batches in flight carry over between calls  #
+# on the same table for the session (write_controls), so chunked jobs keep   #
+# what earlier chunks learned. Throttled and transient failures              #
+# (write_retry_codes, AutoReconnect) are retried with jittered exponential   #
+# backoff, up to write_retries times; unless dups_landed is off, a duplicate #
+# key on a retried insert means the earlier attempt landed and counts as     #
+# done.                                                                      #
+# Progress is shown as it goes unless quiet and kept in write_stats; strict  #
+# raises a BulkWriteError for the writeErrors left at the end.               #
+# Return: dictionary of write counts and the writeErrors that were not       #
+# retried (indexed into requests)                                            #
+##############################################################################
+def scheduled_write(table, requests, label = 'Wrote', quiet = False, 
+                    strict = False, dups_landed = True):
+    sched               = {'pending': deque([x, 0, i] for i, x in \
+                                                    enumerate(requests)), 
+                            'total': len(requests), 'label': label, 
+                            'quiet': quiet, 'dups_landed': dups_landed, 
+                            'batch': min(write_batch, write_max_batch), 
+                            'limit': write_start, 'active': 0, 'streak': 0, 
+                            'done': 0, 'retries': 0, 'throttled': 0, 
+                            'start': time.time(), 'shown': 0, 
+                            'cond': threading.Condition()}
+    sched['result']     = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 
+                            'nModified': 0, 'nRemoved': 0, 'writeErrors': []}
+    if sched['total'] == 0:
+        return sched['result']
+    workers             = int(config.get('write_workers', write_workers))
+    sched['workers']    = max(1, workers)
+    with job_lock:
+        sched.update(write_controls.get(table.full_name, {}))
+    sched['limit']      = min(sched['limit'], sched['workers'])
+    
+    # No more threads than there can be batches at the smallest size
+    threads             = []
+    batches             = (sched['total'] - 1) // write_min_batch + 1
+    for i in range(min(sched['workers'], batches)):
+        thread          = threading.Thread(target = write_worker, \
+                                                    args = (table, sched))
+        thread.daemon   = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    with job_lock:
+        write_controls[table.full_name] = {'batch': sched['batch'], 
+                                'limit': sched['limit'], 
+                                'streak': sched['streak']}
+    
+    show_write_progress(sched, True)
+    if strict and len(sched['result']['writeErrors']) > 0:
+        raise BulkWriteError(sched['result'])
+    return sched['result']
+
+#### write_worker(table, sched) ##############################################
+# This function is one scheduled_write thread: it takes the next batch while #
+# fewer than the current limit are in flight, writes it, waits out the       #
+# backoff of any requests to retry and puts those back at the front.         #
+# Return: none                                                               #
+##############################################################################
+def write_worker(table, sched):
+    cond                = sched['cond']
+    while True:
+        with cond:
+            while len(sched['pending']) == 0 or \
+                                        sched['active'] >= sched['limit']:
+                if len(sched['pending']) == 0 and sched['active'] == 0:
+                    cond.notify_all()
+                    return
+                cond.wait(1)
+            size        = min(sched['batch'], len(sched['pending']))
+            batch       = [sched['pending'].popleft() for i in range(size)]
+            sched['active']     += 1
+        
+        started         = time.time()
+        try:
+            outcome     = write_requests(table, batch, sched['dups_landed'])
+        except Exception as e:
+            # Not retryable: give the batch up rather than stall the others
+            outcome     = {'counts': {}, 'retry': [], 'throttled': False, 
+                            'failed': [{'index': x[2], 'code': None, 
+                                        'errmsg': str(e)} for x in batch]}
+        elapsed         = time.time() - started
+        retry           = []
+        for item in outcome['retry']:
+            if item[1] >= write_retries:
+                outcome['failed'].append({'index': item[2], 'code': None, 
+                        'errmsg': 'gave up after %i retries' % write_retries})
+            else:
+                retry.append([item[0], item[1] + 1, item[2]])
+        if len(retry) > 0:
+            attempt     = max(x[1] for x in retry)
+            time.sleep(random.uniform(0, min(write_backoff_max, \
+                                            write_backoff * 2 ** attempt)))
+        
+        with cond:
+            sched['active']     -= 1
+            adjust_writes(sched, elapsed, size, outcome['throttled'])
+            sched['pending'].extendleft(reversed(retry))
+            sched['retries']    += len(retry)
+            sched['done']       += size - len(retry)
+            for key in outcome['counts']:
+                sched['result'][key]    += outcome['counts'][key]
+            sched['result']['writeErrors']  += outcome['failed']
+            show_write_progress(sched)
+            cond.notify_all()
+
+#### write_requests(table, batch, dups_landed = True) ########################
+# This function writes one batch of [request, attempt, index] items as an    #
+# unordered bulk write and sorts out what went wrong: retryable errors,      #
+# duplicate keys on retried requests (already written, if dups_landed) and   #
+# the rest, whose index is put back to the request's place in the list       #
+# given to scheduled_write. Raises anything that is neither a bulk write     #
+# error nor transient.                                                       #
+# Return: dictionary with counts, retry (items), failed (writeErrors) and    #
+# throttled (boolean)                                                        #
+##############################################################################
+def write_requests(table, batch, dups_landed = True):
+    outcome             = {'counts': {}, 'retry': [], 'failed': [], 
+                            'throttled': False}
+    try:
+        details         = table.bulk_write([x[0] for x in batch], \
+                                        ordered = False).bulk_api_result
+    except BulkWriteError as e:
+        details         = e.details
+        for error in details.get('writeErrors', []):
+            item        = batch[error['index']]
+            if error['code'] == 11000 and item[1] > 0 and dups_landed:
+                continue
+            elif error['code'] in write_retry_codes:
+                outcome['retry'].append(item)
+            else:
+                outcome['failed'].append(dict(error, index = item[2]))
+        outcome['throttled']    = len(outcome['retry']) > 0
+    except AutoReconnect:
+        outcome['retry']        = batch
+        outcome['throttled']    = True
+        return outcome
+    except OperationFailure as e:
+        if e.code not in write_retry_codes:
+            raise
+        outcome['retry']        = batch
+        outcome['throttled']    = True
+        return outcome
     
+    for key in ['nInserted', 'nUpserted', 'nMatched', 'nModified', 'nRemoved']:
+        outcome['counts'][key]  = details.get(key, 0)
+    return outcome
+
+#### adjust_writes(sched, elapsed, size, throttled) ##########################
+# This function is the AIMD step of scheduled_write after a batch of size    #
+# took elapsed seconds: halve the batch size and the batches in flight on    #
+# throttling or a slow batch, grow them after fast full batches, and hold    #
+# them in between. Called with the scheduler's condition held.               #
+# Return: none                                                               #
+##############################################################################
+def adjust_writes(sched, elapsed, size, throttled):
+    target              = float(config.get('write_latency', write_latency))
+    if throttled or elapsed > 2 * target:
+        sched['batch']  = max(write_min_batch, sched['batch'] // 2)
+        sched['limit']  = max(1, sched['limit'] // 2)
+        sched['streak'] = 0
+        if throttled:
+            sched['throttled']  += 1
+    elif elapsed <= target and size >= sched['batch']:
+        sched['batch']  = min(write_max_batch, sched['batch'] + write_min_batch)
+        sched['streak'] += 1
+        if sched['streak'] >= sched['limit']:
+            sched['limit']  = min(sched['workers'], sched['limit'] + 1)
+            sched['streak'] = 0
+
+#### show_write_progress(sched, final = False) ###############################
+# This function updates write_stats and, at most once a second (and at the   #
+# end), the progress line of a scheduled_write: requests done, throughput,   #
+# batch size, batches in flight, retries and throttling events.              #
+# Return: none                                                               #
+##############################################################################
+def show_write_progress(sched, final = False):
+    now                 = time.time()
+    elapsed             = max(now - sched['start'], 0.001)
+    write_stats.update({'label': sched['label'], 'done': sched['done'], 
+                        'total': sched['total'], 'rate': sched['done'] / elapsed, 
+                        'batch': sched['batch'], 'limit': sched['limit'], 
+                        'retries': sched['retries'], 
+                        'throttled': sched['throttled']})
+    if sched['quiet']:
+        return
+    if not final and (now - sched['shown'] < 1 or \
+                                        sched['done'] == sched['total']):
+        return
+    sched['shown']      = now
+    sys.stdout.write('\r%s %i/%i (%.0f/s), batch %i x %i in flight, ' \
+                        '%i retried, %i throttled' % (sched['label'], 
+                        sched['done'], sched['total'], write_stats['rate'], 
+                        sched['batch'], sched['limit'], sched['retries'], 
+                        sched['throttled']))
+    if final:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
 
 #### load_districts(level, state = 'ALL') ####################################
-# This function loads district file form the reference folder and returns it #
-# as a list of strings.                                                      #
+# This function returns the reference districts for a level and state from   #
+# the district index, which reads the district file in the reference folder  #
+# once per run.                                                              #
 # Return: list of strings                                                    #
 ##############################################################################   
 def load_districts(level, state):
+    entry           = load_district_index().get((level, state))
+    if entry is None:
+        return []
+    return list(entry['districts'])
+
+#### load_district_index() ###################################################
+# This function builds district_index from the district file in the          #
+# reference folder the first time it is called and returns the cached index  #
+# afterwards. Keys are (level, state); values come from index_districts.     #
+# Return: dictionary                                                         #
+##############################################################################
+def load_district_index():
+    if len(district_index) > 0:
+        return district_index
+    
     filename        = config['ref_path'] + 'districts.csv'
     df              = open(filename, 'r')
     r               = unicodecsv.reader(df, encoding='utf-8')
@@ -583,17 +3558,81 @@ def load_districts(level, state):
     scol            = headers.index('state')
     dcol            = headers.index('district')
     
-    districts       = []
+    found           = {}
     for row in r:
-        if (row[scol] == state) and (row[lcol] == level):
-            districts.append(str(row[dcol]))
-    
+        found.setdefault((row[lcol], row[scol]), []).append(str(row[dcol]))
     df.close()
     
-    districts.sort()
-    return districts
-    
+    for key in found:
+        district_index[key] = index_districts(found[key])
+        district_index[key]['seats']    = {}
+        for district in found[key]:
+            seats           = district_index[key]['seats']
+            seats[district] = seats.get(district, 0) + 1
+    return district_index
+
+#### index_districts(districts) ##############################################
+# This function indexes a list of district names for fuzzy lookups. Each     #
+# district gets a canonical form (leading number dropped, lowercased), its   #
+# numeric prefix and its tokens, with reverse maps from prefix, token and    #
+# character n-gram back to the districts.                                    #
+# Return: dictionary                                                         #
+##############################################################################
+def index_districts(districts):
+    entry               = {}
+    entry['districts']  = sorted(set(districts))
+    entry['canon']      = {}
+    entry['prefix']     = {}
+    entry['by_prefix']  = {}
+    entry['by_token']   = {}
+    entry['by_gram']    = {}
+    for each in entry['districts']:
+        prefix, canon           = split_district(each)
+        entry['canon'][each]    = canon
+        entry['prefix'][each]   = prefix
+        if prefix != '':
+            entry['by_prefix'].setdefault(prefix, set()).add(each)
+        for token in canon.split():
+            entry['by_token'].setdefault(token, set()).add(each)
+        for gram in name_grams(canon):
+            entry['by_gram'].setdefault(gram, set()).add(each)
+    return entry
 
+#### split_district(district) ################################################
+# This function splits a leading number off a district name, so that         #
+# "12 Middlesex" becomes ['12', 'middlesex']. Plain numbers are kept whole.  #
+# Return: list [numeric prefix or '', canonical name]                        #
+##############################################################################
+def split_district(district):
+    temp            = district.lower().split()
+    if len(temp) > 1 and temp[0].isdigit():
+        return [temp[0], ' '.join(temp[1:])]
+    return ['', ' '.join(temp)]
+
+#### district_candidates(lz, entry, allowed, limit = 20) #####################
+# This function picks the districts from an index entry worth scoring        #
+# against lz: those sharing its numeric prefix, a token or n-grams with it,  #
+# ranked by how much they share. Only districts in allowed are returned.     #
+# Return: list of strings                                                    #
+##############################################################################
+def district_candidates(lz, entry, allowed, limit = 20):
+    prefix, canon   = split_district(lz)
+    shared          = {}
+    for gram in name_grams(canon):
+        for each in entry['by_gram'].get(gram, ()):
+            shared[each]    = shared.get(each, 0) + 1
+    for token in canon.split():
+        for each in entry['by_token'].get(token, ()):
+            shared[each]    = shared.get(each, 0) + 10
+    for each in entry['by_prefix'].get(prefix, ()):
+        shared[each]        = shared.get(each, 0) + 100
+    
+    ranked          = [x for x in shared if x in allowed]
+    ranked.sort(key = lambda x: -shared[x])
+    if len(ranked) < 1:
+        ranked      = [x for x in entry['districts'] if x in allowed]
+    return ranked[:limit]
+    
 #### filter_dict(source, key, valuelist)  ####################################
 # This function filters a list of dictionaries by a given key.               #
 # Return: list of dictionaries                                               #
@@ -602,14 +3641,230 @@ def filter_dict(source, key, valuelist):
     return [dictio for dictio in source if dictio[key] in valuelist]
 
 
+#### fuzzy_score(a, b, scorer = 'ratio') #####################################
+# This function scores two strings with a fuzzywuzzy scorer (by name), as    #
+# given, so scores match the scorer's own. Scores are kept in a bounded LRU  #
+# cache keyed by scorer and string pair and, when config has a score_cache   #
+# path, in a shelve file that survives between runs.                         #
+# Return: int                                                                #
+##############################################################################
+def fuzzy_score(a, b, scorer = 'ratio'):
+    key             = (u'%s\x00%s\x00%s' % (scorer, a, b)).encode('utf-8')
+    
+    with score_lock:
+        if key in score_cache:
+            score               = score_cache.pop(key)
+            score_cache[key]    = score
+            score_stats['hits'] += 1
+            return score
+        store       = open_score_store()
+        if store is not None and key in store:
+            score                       = store[key]
+            score_stats['store_hits']   += 1
+        else:
+            score                       = getattr(fuzz, scorer)(a, b)
+            score_stats['misses']       += 1
+            if store is not None:
+                store[key]              = score
+        score_cache[key]    = score
+        if len(score_cache) > score_cache_max:
+            score_cache.popitem(last = False)
+    return score
+
+#### open_score_store() ######################################################
+# This function opens the on-disk score store named by score_cache in config #
+# the first time it is needed.                                               #
+# Return: shelve or None when scores are not persisted                       #
+##############################################################################
+def open_score_store():
+    global score_store
+    if score_store is None and config.get('score_cache', '') != '':
+        score_store     = shelve.open(config['score_cache'])
+    return score_store
+
+#### close_score_store() #####################################################
+# This function flushes and closes the on-disk score store, if one is open.  #
+# Return: none                                                               #
+##############################################################################
+def close_score_store():
+    global score_store
+    with score_lock:
+        if score_store is not None:
+            score_store.close()
+            score_store     = None
+
+#### score_cache_stats() #####################################################
+# This function reports how often fuzzy_score was answered from memory, from #
+# the on-disk store, or had to score the pair.                               #
+# Return: dictionary                                                         #
+##############################################################################
+def score_cache_stats():
+    stats               = dict(score_stats)
+    total               = stats['hits'] + stats['store_hits'] + stats['misses']
+    stats['size']       = len(score_cache)
+    if total > 0:
+        stats['hit_rate']   = float(stats['hits'] + stats['store_hits']) / total
+    else:
+        stats['hit_rate']   = 0.0
+    return stats
+
+#### print_score_stats() #####################################################
+# This function prints the score cache hit rate when fuzzy_score has been    #
+# called since the last time it was printed.                                 #
+# Return: none                                                               #
+##############################################################################
+def print_score_stats():
+    stats               = score_cache_stats()
+    total               = stats['hits'] + stats['store_hits'] + stats['misses']
+    if total == score_stats_shown[0]:
+        return
+    score_stats_shown[0]    = total
+    print 'Fuzzy scores: %i cached, %i from disk, %i scored (%.0f%% hit rate)' % \
+                (stats['hits'], stats['store_hits'], stats['misses'], 
+                 100 * stats['hit_rate'])
+
+
+#### ingest_rows(reader, headers, workers = None) ############################
+# This function streams the rows of an opened csv reader through a worker    #
+# pool in chunks of ingest_chunk rows. Every chunk is validated and          #
+# normalized by normalize_chunk; at most ingest_depth chunks per worker are  #
+# in flight, so the pipeline itself holds a bounded number of rows. What the #
+# caller keeps is up to the caller.                                          #
+# Return: generator of lists [entries, errors], one per chunk, in file order #
+##############################################################################
+def ingest_rows(reader, headers, workers = None):
+    if workers is None:
+        workers         = multiprocessing.cpu_count()
+    load_district_index()
+    slots               = threading.Semaphore(workers * ingest_depth)
+    
+    def chunks():
+        start           = 0
+        rows            = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) >= ingest_chunk:
+                slots.acquire()
+                yield [start, headers, rows]
+                start   += len(rows)
+                rows    = []
+        if len(rows) > 0:
+            slots.acquire()
+            yield [start, headers, rows]
+    
+    pool                = None
+    if workers > 1:
+        pool            = multiprocessing.Pool(workers)
+        results         = pool.imap(normalize_chunk, chunks())
+    else:
+        results         = itertools.imap(normalize_chunk, chunks())
+    try:
+        for batch in results:
+            slots.release()
+            yield batch
+    finally:
+        if pool is not None:
+            slots.release()
+            pool.terminate()
+            pool.join()
+
+#### normalize_chunk(chunk) ##################################################
+# This function is the worker body for ingest_rows. It turns raw rows into   #
+# entries keyed by header (with the 1-based row number as 'id'), checks      #
+# level and state, tidies name whitespace and case and maps districts onto   #
+# the reference index with district_lookup.                                  #
+# Return: list [entries, error messages]                                     #
+##############################################################################
+def normalize_chunk(chunk):
+    start, headers, rows    = chunk
+    entries                 = []
+    errors                  = []
+    for i in range(0, len(rows)):
+        row                 = rows[i]
+        index               = start + i + 1
+        if len(row) < len(headers):
+            errors.append('Short row %i' % index)
+            continue
+        entry               = {}
+        entry['id']         = index
+        for j in range(0, len(headers)):
+            entry[headers[j]]   = row[j]
+        
+        if 'level' in entry and entry['level'] not in level_set:
+            errors.append('Bad level on row %i' % index)
+        if 'state' in entry and entry['state'] not in state_set:
+            errors.append('Bad state on row %i' % index)
+        if 'name' in entry:
+            name            = ' '.join(entry['name'].split())
+            if name.isupper() or name.islower():
+                name        = name.title()
+            entry['name']   = name
+        if set(['level', 'state', 'district']) <= set(entry):
+            entry['district']   = district_lookup(entry['level'], \
+                                        entry['state'], entry['district'])
+        entries.append(entry)
+    return [entries, errors]
+
+#### district_lookup(level, state, district) #################################
+# This function maps a district onto the reference spelling when it matches  #
+# exactly one reference district once case, spacing and a leading number     #
+# are ignored. Anything else is returned unchanged for the interactive       #
+# district check.                                                            #
+# Return: string                                                             #
+##############################################################################
+def district_lookup(level, state, district):
+    entry           = district_index.get((level, state))
+    district        = district.strip()
+    if entry is None or district in entry['canon']:
+        return district
+    prefix, canon   = split_district(district)
+    found           = []
+    if canon != '':
+        for each in entry['by_token'].get(canon.split()[0], ()):
+            if entry['canon'][each] == canon and \
+                                    prefix in ['', entry['prefix'][each]]:
+                found.append(each)
+    if len(found) == 1:
+        return found[0]
+    if prefix == '' and canon.isdigit():
+        found       = list(entry['by_prefix'].get(canon, ()))
+        if len(found) == 1:
+            return found[0]
+    return district
+
+#### read_rows(reader, headers) ##############################################
+# This function collects every entry from ingest_rows along with the set of  #
+# values seen in each column. The whole file ends up in memory, since the    #
+# add and delete checks need every entry before prompting.                   #
+# Return: list [entries, value_range] or ['Error', message]                  #
+##############################################################################
+def read_rows(reader, headers):
+    entries                 = []
+    value_range             = {}
+    for head in headers:
+        value_range[head]   = set()
+    for batch, errors in ingest_rows(reader, headers):
+        if len(errors) > 0:
+            return ['Error', errors[0]]
+        for entry in batch:
+            for head in headers:
+                value_range[head].add(entry[head])
+        entries             += batch
+    for head in headers:
+        value_range[head]   = sorted(value_range[head])
+    return [entries, value_range]
+
+
 ########### add_file(legTable) function ######################################
 # This function prompts the user for a csv list of legislators to add. It    #
 # then checks these entries for district matching when present (prompting    #
 # when  corrections need to be made). This list of legislators is then       #
-# fleshed with details from the legTable, and sent to bulk_insert to add.    #
+# fleshed with details from the legTable, and sent to bulk_insert to add (or #
+# to upsert_seats to overwrite matching seats).                              #
 # Return: list of dictionaries to be used as a filter                        #
 ##############################################################################
-def add_file(legTable, merge = False):
+@profiled
+def add_file(legTable, merge = False, overwrite = False):
     # Pick file to gather add information from
     finished        = False
     while not finished:
@@ -629,51 +3884,41 @@ def add_file(legTable, merge = False):
                 print 'Bad file name.'
                 
     # Read file
-    add_list                = []
-    value_range             = {}
-    for head in headers:
-        value_range[head]   = []
-    index                   = 0
-    accept_values           = {}
-    accept_values['level']  = level_list
-    accept_values['state']  = states.keys()
-    for row in reader:
-        index               += 1
-        entry               = {}
-        entry['id']         = index
-        for i in range(0, len(headers)):
-            entry[headers[i]]  = row[i]
-            if row[i] not in value_range[headers[i]]:
-                value_range[headers[i]].append(row[i])
-                if headers[i] in ['level','state']:
-                    if row[i] not in accept_values[headers[i]]:
-                        error_msg       = 'Bad %s on row %i' % (headers[i], index)
-                        error_list      = ['Error', error_msg]
-                        return error_list
-                        
-        add_list.append(entry)
-    f.close()    
+    with phase('read file'):
+        result              = read_rows(reader, headers)
+    f.close()
+    if result[0] == 'Error':
+        return result
+    add_list, value_range   = result
     
     # Check for district matched - fix when off
     update_list = []
-    if set(['level', 'state', 'district']) <= set(headers):
-        for level in value_range['level']:
-            if level != 'fed-upper':
-                list_level      = filter_dict(add_list, 'level', level)
-                for state in value_range['state']:
-                    list_state  = filter_dict(list_level, 'state', state)
-                    if len(list_state) > 1:
-                        districts   = load_districts(level, state)
-                        for entry in list_state:
-                            if entry['district'] not in districts:
-                                if (len(entry['district']) > 3):
-                                    no_match = len([i for i, x in \
-                                        enumerate(districts) \
-                                        if re.match(entry['district'] + r'^', x)])
-                                    if no_match != 1:
-                                        update_list.append(unmatched(entry, \
-                                                        'district', districts))
-
+    with phase('district check'):
+        checks      = []
+        if set(['level', 'state', 'district']) <= set(headers):
+            for level in value_range['level']:
+                if level != 'fed-upper':
+                    list_level      = filter_dict(add_list, 'level', level)
+                    for state in value_range['state']:
+                        list_state  = filter_dict(list_level, 'state', state)
+                        if len(list_state) > 1:
+                            districts   = load_districts(level, state)
+                            for entry in list_state:
+                                if entry['district'] not in districts:
+                                    if (len(entry['district']) > 3):
+                                        no_match = len([i for i, x in \
+                                            enumerate(districts) \
+                                            if re.match(entry['district'] + r'^', x)])
+                                        if no_match != 1:
+                                            checks.append([entry, 'district', \
+                                                                    districts])
+        
+        # Score the next rows while the operator answers this one
+        for check, found in prefetch(checks, lambda x: \
+                                                unmatched_candidates(*x)):
+            with phase('interactive fixes'):
+                update_list.append(unmatched_prompt(check[0], check[1], \
+                                                            check[2], found))
 
     # Clean add_list
     for entry in update_list:
@@ -692,59 +3937,71 @@ def add_file(legTable, merge = False):
             item['district'] = ''
 
     if merge:
-        add_list            = merge_list(legTable, add_list)
+        with phase('merge'):
+            add_list        = merge_list(legTable, add_list)
     
-    legislators             = template_fill(legTable, value_range['state'], \
+    with phase('template fill'):
+        legislators         = template_fill(legTable, value_range['state'], \
                                                 value_range['level'], add_list)
 
-    bulk_insert(legTable, legislators)
+    with phase('insert'):
+        if overwrite:
+            upsert_seats(legTable, legislators)
+        else:
+            bulk_insert(legTable, legislators)
     
 #### merge_list(table, legs) #################################################
 # This function filters a existing matches out of a list of legislators.     #
+# The lookups and scoring for upcoming legislators run ahead in the          #
+# background (see merge_candidates) while the operator answers a prompt.     #
 # Return: list of dictionaries as a legislator files                         #
 ##############################################################################
 def merge_list(table, legs):
     combined_list           = []
-    for doc in legs:
-        crit                = {}
-        cont                = True
-        crit['district']    = doc['district']
-        crit['level']       = doc['level']
-        crit['state']       = doc['state']
-        crit['name']        = doc['name']
-        poss = pull_entries(table, crit)
-        if len(poss) == 1:
-            cont = False
-
-        if cont:
-            crit            = {}
-            crit['level']   = doc['level']
-            crit['state']   = doc['state']
-            crit['name']    = doc['name']
-            poss = pull_entries(table, crit)
-            if len(poss) == 1:
-                cont = False
-            elif len(poss) > 1:
-                choice      = unmatched(doc, 'name', poss, 0, True)
-                if choice:
-                    combined_list.append(doc)
-                cont = False
-
-        if cont:
-            crit            = {}
-            crit['level']   = doc['level']
-            crit['state']   = doc['state']
-            poss            = pull_entries(table, crit)
-            if len(poss) > 0:
-                choice      = unmatched(doc, 'name', poss, merge_floor, True)
-            else:
-                choice      = True
-            if choice:
-                combined_list.append(doc)
-            cont = False
+    ensure_name_keys(table)
+    for doc, found in prefetch(legs, lambda x: merge_candidates(table, x)):
+        choice              = unmatched_prompt(doc, 'name', None, found, True)
+        if choice:
+            combined_list.append(doc)
             
     return combined_list
 
+#### merge_candidates(table, doc) ############################################
+# This function is the computing half of merge_list for one legislator: it   #
+# looks for existing matches by seat and name, then by name_key, then among  #
+# the level and state candidates from name_candidates, and                   #
+# builds the menu when it takes a decision.                                  #
+# Return: list [done, value] as from unmatched_candidates (value is True to  #
+# add the legislator when done)                                              #
+##############################################################################
+def merge_candidates(table, doc):
+    crit                = {}
+    crit['district']    = doc['district']
+    crit['level']       = doc['level']
+    crit['state']       = doc['state']
+    crit['name']        = doc['name']
+    poss = pull_entries(table, crit)
+    if len(poss) == 1:
+        return [True, False]
+
+    crit                = {}
+    crit['level']       = doc['level']
+    crit['state']       = doc['state']
+    crit['name_key']    = name_keys(doc['name'])['name_key']
+    poss = pull_entries(table, crit)
+    if len(poss) == 1:
+        return [True, False]
+    elif len(poss) > 1:
+        return unmatched_candidates(doc, 'name', poss, 0, True)
+
+    crit                = {}
+    crit['level']       = doc['level']
+    crit['state']       = doc['state']
+    poss                = name_candidates(table, doc, crit)
+    if len(poss) > 0:
+        return unmatched_candidates(doc, 'name', poss, merge_floor, True)
+    return [True, True]
+
 #### template_fill(table, level_list, state_list, legs) ######################
 # This function creates a fills out a list of legislators to include data    #
 # from a template created from values of like documents in the legTable.     #
@@ -799,13 +4056,21 @@ def template_fill(table, state_sublist, level_sublist, legs):
 # Return: list [id, field, fixed value]                                      #
 ##############################################################################    
 def unmatched(legislator, field, possibiles, floor = 0, merge = False):
+    found           = unmatched_candidates(legislator, field, possibiles, floor, \
+                                                                        merge)
+    return unmatched_prompt(legislator, field, possibiles, found, merge)
+
+#### unmatched_candidates(legislator, field, possibiles, floor, merge) #######
+# This function is the computing half of unmatched: it scores the            #
+# possibilities and picks the ones to offer, without prompting, so it can    #
+# run ahead of the operator (see prefetch).                                  #
+# Return: list [done, value] (value is the final answer when done, else the  #
+# menu of potentials)                                                        #
+##############################################################################
+def unmatched_candidates(legislator, field, possibiles, floor = 0, merge = False):
     result          = []
     if merge:
-        leg_list    = possibiles
-        name_list   = []
-        for each in possibiles:
-            name_list.append(each['name'])
-        possibiles   = name_list
+        possibiles  = [x['name'] for x in possibiles]
     else:
         result.append(legislator['id'])
     result.append(field)
@@ -815,23 +4080,38 @@ def unmatched(legislator, field, possibiles, floor = 0, merge = False):
     
     if len(possibiles) == 0:
         if merge:
-            return True
+            return [True, True]
         else:
             result.append('delete')
-            return result
+            return [True, result]
     if len(possibiles) <= 5:
-        potentials  = possibiles
+        potentials  = list(possibiles)
     else:
         while len(potentials) < 5:
             conf            += -5
             if conf == floor:
-                return True
+                return [True, True]
             potentials      = []
             for each in possibiles:
-                if fuzz.ratio(legislator['field'], each) >= conf:
+                if fuzzy_score(legislator[field], each) >= conf:
                     potentials.append(str(each))
                 
     potentials.append('Skip')
+    return [False, potentials]
+
+#### unmatched_prompt(legislator, field, possibiles, found, merge) ###########
+# This function is the interactive half of unmatched: it shows the menu that #
+# unmatched_candidates built and returns the operator's answer.              #
+# Return: list [id, field, fixed value], or boolean when merging             #
+##############################################################################
+def unmatched_prompt(legislator, field, possibiles, found, merge = False):
+    if found[0]:
+        return found[1]
+    potentials      = found[1]
+    result          = []
+    if not merge:
+        result.append(legislator['id'])
+    result.append(field)
     
     try:
         lname   = legislator['name']
@@ -865,12 +4145,68 @@ def unmatched(legislator, field, possibiles, floor = 0, merge = False):
         else:
             print 'Bad entry'
 
+#### roster_candidates(table, check) #########################################
+# This function pulls the candidates for a name check's entry ([entry,       #
+# criteria], see name_candidates) and runs unmatched_candidates on the       #
+# entry's name against them.                                                 #
+# Return: list [names, [done, value]]                                        #
+##############################################################################
+def roster_candidates(table, check):
+    poss            = name_candidates(table, check[0], check[1])
+    names           = [d['name'] for d in poss]
+    return [names, unmatched_candidates(check[0], 'name', names)]
+
+#### prefetch(items, compute, depth = prefetch_depth) ########################
+# This generator pipelines an interactive loop: a background thread runs     #
+# compute on the items in order, up to depth items ahead, while the caller   #
+# is busy with the operator. An error in compute is raised when its item is  #
+# reached; closing the generator stops the thread.                           #
+# Return: generator of [item, compute(item)]                                 #
+##############################################################################
+def prefetch(items, compute, depth = prefetch_depth):
+    results         = Queue.Queue(maxsize = depth)
+    stop            = threading.Event()
+    
+    def offer(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def worker():
+        for item in items:
+            try:
+                value   = [item, compute(item), None]
+            except Exception as e:
+                value   = [item, None, e]
+            if not offer(value):
+                return
+        offer(None)
+    
+    thread          = threading.Thread(target = worker)
+    thread.daemon   = True
+    thread.start()
+    try:
+        while True:
+            value   = results.get()
+            if value is None:
+                return
+            if value[2] is not None:
+                raise value[2]
+            yield value[:2]
+    finally:
+        stop.set()
+
 #### insert() ################################################################
 # This function uses add_file to insert a list of legislators.               #
 # Return: none                                                               #
 ##############################################################################
 def dup_check():
-    insert_menu = ['Merge', 'No Merge']
+    insert_menu = ['Merge', 'No Merge', 'Overwrite when seats match']
+    overwrite   = False
     finished    = False
     while not finished:
         task    = list_menu(insert_menu, 'Would you like to merge?')
@@ -880,120 +4216,462 @@ def dup_check():
         elif task == 'No Merge':
             merge       = False
             finished    = True
+        elif task == 'Overwrite when seats match':
+            merge       = False
+            overwrite   = True
+            finished    = True
     
     legTable    = pick_db()
-    add_file(legTable, merge)
-#### main() ##################################################################
-# This function check for duplicate legislators and then exports a list      #
+    add_file(legTable, merge, overwrite)
+#### seat_check() ############################################################
+# This function audits seat occupancy for a filter from the seats collection #
+# (see seat_audit) and exports the seats that are empty, over-filled or not  #
+# in the reference districts.                                                #
 # Return: none                                                               #
 ##############################################################################
+@profiled
 def seat_check():
     table           = pick_db()
     filters         = create_filters()
-    state_list      = []
-    level_list      = []
+    
+    groups          = set()
+    for each in filters:
+        for state in ([each['state']] if 'state' in each else states.keys()):
+            groups.add((each['level'], state))
+    groups          = sorted(groups)
+    with phase('seat audit'):
+        results, new    = run_audit(table, 'seats', groups, seat_findings)
+    
+    title_dict      = { 'fed-upper': 'United States Senate',
+                        'fed-lower': '%s Federal House', 
+                        'state-upper': '%s Senate', 
+                        'state-lower': '%s House'}
     output          = []
+    titles          = []
+    count           = 0
+    for group in groups:
+        title       = title_dict[group[0]]
+        if '%s' in title:
+            title   = title % states.get(group[1], group[1])
+        if len(results[group]) > 0 and title not in titles:
+            titles.append(title)
+            output.append('')
+            output.append(title)
+        output      += results[group]
+        count       += len(results[group])
+    if len(output) > 0:
+        output.pop(0)
+    print '%i seats need attention' % count
+    print_new_findings(new, lambda x: x)
+                    
+    finished        = False
+    while not finished:
+        outfile     = raw_input('Enter filename for output: ')
+        if len(outfile) < 1:
+            print 'File name too short.'
+        else:
+            try:
+                f           = open(outfile, 'w')
+                finished    = True
+            except:
+                print 'Bad file name.'
+    
+    for line in output:
+        f.write("%s\n" % str(line))           
+    f.close()
+    
+#### seat_list(table, state, level) ##########################################
+# This function lists the seats of one chamber in a state whose occupancy    #
+# does not match the reference districts, from the seats collection.         #
+# Return: list of strings                                                    #
+##############################################################################
+def seat_list(table, state, level):
+    rows                    = seat_audit(table, [{'level': level, 'state': state}])
+    return seat_lines(table, rows)
+
+#### seat_lines(table, rows) #################################################
+# This function formats seat rows as 'State District (count/expected):       #
+# names' lines, looking every occupant's name up in one query.               #
+# Return: list of strings                                                    #
+##############################################################################
+def seat_lines(table, rows):
+    ids                     = []
+    for row in rows:
+        ids                 += row['occupants']
+    names                   = {}
+    for each in table.find({'_id': {'$in': ids}}, {'name': 1}):
+        names[each['_id']]  = each.get('name', '')
+    
+    output                  = []
+    for row in rows:
+        label               = states.get(row['state'], row['state'])
+        if row['district'] != '':
+            label           += ' %s' % row['district']
+        line                = '%s (%i/%i): ' % (label, row['count'], \
+                                                            row['expected'])
+        if row['count'] == 0:
+            line            += 'Empty'
+        else:
+            line            += ', '.join(str(names.get(x, x)) \
+                                                    for x in row['occupants'])
+        if not row['reference']:
+            line            += ' - not in reference districts'
+        output.append(line)
+    return output
+
+#### seat_audit(table, filters) ##############################################
+# This function returns the seats whose occupant count differs from the      #
+# expected count (empty, over-filled or not a reference district) for a      #
+# create_filters filter list, as one indexed query on the seats collection.  #
+# The collection is built first when it is missing or stale.                 #
+# Return: list of dictionaries (seat rows)                                   #
+##############################################################################
+def seat_audit(table, filters):
+    if not seats_ready(table):
+        build_seats(table)
+    query           = {'mismatch': True}
+    groups          = [dict((k, x[k]) for k in ['level', 'state'] if k in x) \
+                                                            for x in filters]
+    if len(groups) > 0 and {} not in groups:
+        query['$or']    = groups
+    rows            = seat_table(table).find(query)
+    return sorted(rows, key = lambda x: (x['level'], x['state'], \
+                                            district_order(x['district'])))
+
+#### seat_findings(table, groups) ############################################
+# This function is seat_check's audit for run_audit: the seat_lines of the   #
+# seats needing attention in each (level, state) group.                      #
+# Return: dict of {group: list of strings}                                   #
+##############################################################################
+def seat_findings(table, groups):
+    rows            = seat_audit(table, [{'level': x[0], 'state': x[1]} \
+                                                            for x in groups])
+    results         = dict((x, []) for x in groups)
+    for row, line in zip(rows, seat_lines(table, rows)):
+        results[(row['level'], row['state'])].append(line)
+    return results
+
+#### district_order(district) ################################################
+# This function gives a sort key putting numbered districts first, in        #
+# numeric order, and named ones after them (as mix_sort does).               #
+# Return: tuple                                                              #
+##############################################################################
+def district_order(district):
+    try:
+        return (0, float(district), district)
+    except ValueError:
+        return (1, 0, district)
+
+#### seat_table(table) #######################################################
+# This function returns the seats collection next to a legislator table.     #
+# Each row is one seat (level, state, district; one per state for            #
+# fed-upper) with its occupants' _ids, count, expected count, whether it is  #
+# a reference district and whether count and expected differ.                #
+# Return: pymongo table                                                      #
+##############################################################################
+def seat_table(table):
+    return table.database['seats']
+
+#### seats_ready(table) ######################################################
+# This function checks whether a table's seats collection has been built     #
+# and is not stale. The answer is cached in seat_states.                     #
+# Return: boolean                                                            #
+##############################################################################
+def seats_ready(table):
+    name            = table.full_name
+    if name not in seat_states:
+        meta        = seat_table(table).find_one({'_id': '_meta'})
+        seat_states[name]   = 'missing' if meta is None else \
+                                ('stale' if meta.get('stale') else 'ready')
+    return seat_states[name] == 'ready'
+
+#### reference_seats() #######################################################
+# This function lists the seats the reference districts call for: every      #
+# district in the district file, plus two fed-upper seats per state.         #
+# Return: dict of {(level, state, district): expected count}                 #
+##############################################################################
+def reference_seats():
+    seats           = {}
+    index           = load_district_index()
+    for key in index:
+        for district in index[key]['districts']:
+            seats[(key[0], key[1], district)]   = index[key]['seats'][district]
+    for state in states:
+        seats[('fed-upper', state, '')]         = 2
+    return seats
+
+#### seat_of(doc) ############################################################
+# This function returns the seat a legislator counts toward (fed-upper       #
+# seats are per state, so their district is always '').                      #
+# Return: tuple (level, state, district)                                     #
+##############################################################################
+def seat_of(doc):
+    if doc.get('level') == 'fed-upper':
+        return ('fed-upper', doc.get('state'), '')
+    return (doc.get('level'), doc.get('state'), doc.get('district', ''))
+
+#### seat_id(seat) ###########################################################
+# This function gives the _id of a seat's row in the seats collection.       #
+# Return: string                                                             #
+##############################################################################
+def seat_id(seat):
+    return '|'.join(str(x) for x in seat)
+
+#### seat_rows(legs, reference, groups = None) ###############################
+# This function builds seat rows from legislators (level, state, district    #
+# and _id) and the reference seats, limited to the (level, state) groups     #
+# given.                                                                     #
+# Return: list of dictionaries                                               #
+##############################################################################
+def seat_rows(legs, reference, groups = None):
+    occupants       = {}
+    for each in legs:
+        occupants.setdefault(seat_of(each), []).append(each['_id'])
+    keys            = set(occupants)
+    keys            |= set(x for x in reference if groups is None or \
+                                                        x[:2] in groups)
+    rows            = []
+    for key in keys:
+        ids         = occupants.get(key, [])
+        expected    = reference.get(key, 0)
+        rows.append({'_id': seat_id(key), 'level': key[0], 
+                    'state': key[1], 'district': key[2], 'occupants': ids, 
+                    'count': len(ids), 'expected': expected, 
+                    'reference': key in reference, 
+                    'mismatch': len(ids) != expected})
+    return rows
+
+#### build_seats(table) ######################################################
+# This function rebuilds a table's seats collection from scratch with one    #
+# scan of the legislators, and indexes it for audits and maintenance.        #
+# Return: number of seat rows                                                #
+##############################################################################
+def build_seats(table):
+    seats           = seat_table(table)
+    fields          = {'level': 1, 'state': 1, 'district': 1}
+    rows            = seat_rows(table.find({}, fields), reference_seats())
+    seats.delete_many({})
+    scheduled_write(seats, [InsertOne(x) for x in rows], 'Seats', \
+                                                            strict = True)
+    seats.create_index([('mismatch', 1), ('level', 1), ('state', 1)])
+    seats.create_index([('level', 1), ('state', 1)])
+    seats.create_index('occupants')
+    seats.insert_one({'_id': '_meta', 'built': datetime.datetime.utcnow(), 
+                        'stale': False})
+    seat_states[table.full_name]    = 'ready'
+    print 'Built %i seats, %i need attention' % (len(rows), \
+                                        len([x for x in rows if x['mismatch']]))
+    return len(rows)
+
+#### seat_hook(table, action, items) #########################################
+# This write hook keeps built seats collections current seat by seat: the    #
+# legislators a write touched (see seat_write_ids) are pulled from the seats #
+# they were in and added to the ones they are in now (see place_occupants).  #
+# A delete that cannot be narrowed to seats marks the seats stale, so they   #
+# are rebuilt before the next audit.                                         #
+# Return: none                                                               #
+##############################################################################
+def seat_hook(table, action, items):
+    if table.name != 'legislators' or not seats_ready(table):
+        return
+    if action == 'insert' and all('_id' in x for x in items):
+        placed      = dict((x['_id'], seat_of(x)) for x in items)
+    else:
+        ids         = seat_write_ids(table, action, items)
+        if ids is None:
+            seat_table(table).update_one({'_id': '_meta'}, \
+                                            {'$set': {'stale': True}})
+            seat_states[table.full_name]    = 'stale'
+            return
+        placed      = dict((x, None) for x in ids)
+        fields      = {'level': 1, 'state': 1, 'district': 1}
+        for each in table.find({'_id': {'$in': ids}}, fields):
+            placed[each['_id']] = seat_of(each)
+    with seat_lock:
+        place_occupants(table, placed)
+
+#### seat_write_ids(table, action, items) ####################################
+# This function lists the legislator _ids a write may have moved between     #
+# seats: the _ids of _id queries, the occupants of the seats a filter names  #
+# (see seat_terms) and, for updates, the legislators a filter matches now.   #
+# Return: list of _ids, or None for a delete that cannot be narrowed         #
+##############################################################################
+def seat_write_ids(table, action, items):
+    ids             = []
+    terms           = []
+    queries         = []
+    for query in items:
+        found       = query_ids(query)
+        if found is not None:
+            ids     += found
+            continue
+        term        = seat_terms(query)
+        if term is None and action != 'update':
+            return None
+        if term is not None:
+            terms.append(term)
+        queries.append(query)
+    if len(terms) > 0:
+        for row in seat_table(table).find({'$or': terms}, {'occupants': 1}):
+            ids     += row['occupants']
+    if action == 'update' and len(queries) > 0:
+        for each in table.find({'$or': queries}, {'_id': 1}):
+            ids.append(each['_id'])
+    return ids
+
+#### seat_terms(query) #######################################################
+# This function turns a legislator query into the seats collection query for #
+# the seats it can touch, from equality or $in conditions on level, state    #
+# and district (through $and and $or). fed-upper seats have no district, so  #
+# district only narrows a single level other than fed-upper.                 #
+# Return: dictionary, or None when the query names no seat fields            #
+##############################################################################
+def seat_terms(query):
+    terms           = {}
+    for field in ['level', 'state', 'district']:
+        cond        = query.get(field)
+        if isinstance(cond, basestring) or (isinstance(cond, dict) and \
+                                                    cond.keys() == ['$in']):
+            terms[field]    = cond
+    if 'district' in terms and (not isinstance(terms.get('level'), \
+                            basestring) or terms['level'] == 'fed-upper'):
+        terms.pop('district')
+    if len(terms) > 0:
+        return terms
+    
+    for part in query.get('$and', []):
+        found       = seat_terms(part)
+        if found is not None:
+            return found
+    if '$or' in query:
+        parts       = [seat_terms(x) for x in query['$or']]
+        if None not in parts:
+            return {'$or': parts}
+    return None
+
+#### place_occupants(table, placed) ##########################################
+# This function moves legislators between seat rows: placed maps each _id to #
+# the seat it is in now (None when it is gone). _ids are $pulled from the    #
+# row that held them and $addToSet into their new row (created when it is    #
+# not a reference seat), and only the rows that changed get their count and  #
+# mismatch recomputed; emptied rows outside the reference seats are dropped. #
+# Called with seat_lock held.                                                #
+# Return: none                                                               #
+##############################################################################
+def place_occupants(table, placed):
+    seats           = seat_table(table)
+    held            = {}
+    for row in seats.find({'occupants': {'$in': list(placed)}}, \
+                                                        {'occupants': 1}):
+        for each in row['occupants']:
+            if each in placed:
+                held[each]  = row['_id']
     
-    for each in filters:
-        if 'state' in each:
-            if each['state'] not in state_list:
-                state_list.append(each['state'])
-        if each['level'] not in level_list:
-            level_list.append(each['level'])
-    if 'state' not in filters[0]:
-        state_list  = states.keys()
-        
-    level_list.sort()
-    state_list.sort()
-
-    if 'fed-upper' in level_list:
-        output.append('United States Senate')
-        for state in state_list:
-            crit            = {}
-            crit['level']   = 'fed-upper'
-            crit['state']   = state
-            legs            = pull_entries(table, crit)
-            
-            if len(legs) != 2:
-                line        = '%s (%i): ' % (states[state], len(legs))
-                if len(legs) == 0:
-                    line    += 'Empty'
-                else:
-                    line    += str(legs[0]['name'])
-                if len(legs) > 1:
-                    for i in range(1,len(legs)):
-                        line    += ', %s' % str(legs[i]['name'])
-                output.append(line)
-                
-    title_dict      = { 'fed-lower': '%s Federal House', 
-                        'state-upper': '%s Senate', 
-                        'state-lower': '%s House'}
+    pulls           = {}
+    pushes          = {}
+    for each, seat in placed.items():
+        if held.get(each) == (None if seat is None else seat_id(seat)):
+            continue
+        if each in held:
+            pulls.setdefault(held[each], []).append(each)
+        if seat is not None:
+            pushes.setdefault(seat, []).append(each)
+    if len(pulls) + len(pushes) == 0:
+        return
     
-    for crit in filters:
-        if crit['level'] != 'fed-upper':
-            if 'state' in crit:
-                level               = str(crit['level'])
-                level_name          = level.split('-')[0].title()
-                state               = str(crit['state'])
-                state_name          = states[state].title()
-                title               = title_dict[level] % states[state]
-                output.append('')
-                output.append(title)
-                output              += seat_list(table, state, level)
-            else:
-                level               = str(crit['level'])
-                level_name          = level.split('-')[0].title()
-                for state in state_list:  
-                    state_name      = states[state].title()
-                    title           = title_dict[level] % states[state]
-                    output.append('')
-                    output.append(title)
-                    output          += seat_list(table, state, level)
-                    
-    finished        = False
-    while not finished:
-        outfile     = raw_input('Enter filename for output: ')
-        if len(outfile) < 1:
-            print 'File name too short.'
-        else:
-            try:
-                f           = open(outfile, 'w')
-                finished    = True
-            except:
-                print 'Bad file name.'
+    reference       = reference_seats()
+    requests        = []
+    for key in pulls:
+        pull        = {'occupants': {'$in': pulls[key]}}
+        requests.append(UpdateOne({'_id': key}, {'$pull': pull}))
+    for seat in pushes:
+        requests.append(UpdateOne({'_id': seat_id(seat)}, 
+                        {'$addToSet': {'occupants': {'$each': pushes[seat]}}, 
+                         '$set': {'level': seat[0], 'state': seat[1], 
+                                'district': seat[2], 
+                                'expected': reference.get(seat, 0), 
+                                'reference': seat in reference}}, 
+                        upsert = True))
+    seats.bulk_write(requests, ordered = False)
     
-    for line in output:
-        f.write("%s\n" % str(line))           
-    f.close()
+    keys            = set(pulls) | set(seat_id(x) for x in pushes)
+    requests        = []
+    for row in seats.find({'_id': {'$in': list(keys)}}):
+        count       = len(row['occupants'])
+        if count == 0 and not row['reference']:
+            requests.append(DeleteOne({'_id': row['_id']}))
+        else:
+            counts  = {'count': count, 'mismatch': count != row['expected']}
+            requests.append(UpdateOne({'_id': row['_id']}, {'$set': counts}))
+    seats.bulk_write(requests, ordered = False)
+
+#### touched_groups(table, action, items) ####################################
+# This function works out the (level, state) groups a write touched: those   #
+# of inserted documents, of the seats holding updated or deleted _ids (when  #
+# the seats collection is built) and of the updated documents' new values,   #
+# or the groups a filter is limited to.                                      #
+# Return: set of (level, state) tuples, or None when it is not limited       #
+##############################################################################
+def touched_groups(table, action, items):
+    groups          = set()
+    if action == 'insert':
+        groups      = set(seat_of(x)[:2] for x in items)
+    for query in ([] if action == 'insert' else items):
+        ids         = query_ids(query)
+        if ids is not None:
+            if seats_ready(table):
+                for each in seat_table(table).find({'occupants': {'$in': ids}}):
+                    groups.add((each['level'], each['state']))
+            if action == 'update':
+                for each in table.find({'_id': {'$in': ids}}, \
+                                                {'level': 1, 'state': 1}):
+                    groups.add(seat_of(each)[:2])
+            continue
+        found       = query_groups(query)
+        if found is None:
+            return None
+        groups      |= found
+    return groups
+
+#### query_groups(query) #####################################################
+# This function works out which (level, state) groups a query can match,     #
+# from equality or $in conditions on level and state (through $and and $or). #
+# Return: set of (level, state) tuples, or None when it is not limited       #
+##############################################################################
+def query_groups(query):
+    values          = {}
+    for field, choices in [['level', level_list], ['state', states.keys()]]:
+        cond        = query.get(field)
+        if isinstance(cond, basestring):
+            values[field]   = [cond]
+        elif isinstance(cond, dict) and cond.keys() == ['$in']:
+            values[field]   = list(cond['$in'])
+    if len(values) > 0:
+        return set(itertools.product(values.get('level', level_list), 
+                                        values.get('state', states.keys())))
     
-def seat_list(table, state, level):
-    districts               = load_districts(level, state)
-    districts.sort()
-    output                  = []
-    working                 = True
-    for each in districts:
-        while working:
-            filt                = {}
-            filt['district']    = each
-            filt['state']       = state
-            filt['level']       = level
-            legs                = pull_entries(table, filt)
-            if len(legs) < len(districts):
-                fix_filt        = dict(filt)
-                fix_filt.pop('district', None)                
-            line                = '%s %s (%i): ' % (states[state], each, len(legs))
-            if len(legs) == 0:
-                line            += 'Empty'
-            else:
-                line            += str(legs[0]['name'])
-            if len(legs) > 1:
-                for i in range(1,len(legs)):
-                    line        += ', %s' % str(legs[i]['name'])
-            output.append(line)
-            print output
-            sys.exit()
-        
-    return output
+    for part in query.get('$and', []):
+        found       = query_groups(part)
+        if found is not None:
+            return found
+    if '$or' in query:
+        groups      = set()
+        for part in query['$or']:
+            found   = query_groups(part)
+            if found is None:
+                return None
+            groups  |= found
+        return groups
+    return None
+
+#### seats_task() ############################################################
+# This function rebuilds the seats collection of a chosen database.          #
+# Return: none                                                               #
+##############################################################################
+def seats_task():
+    table           = pick_db()
+    build_seats(table)
+
 def update_one(table, target, id_field, field, value):
     bullseye            = {}
     try:
@@ -1003,10 +4681,13 @@ def update_one(table, target, id_field, field, value):
         
     changes             = {}
     changes[field]      = value
+    if field == 'name':
+        changes.update(name_keys(value))
     set_dict            = {}
     set_dict['$set']    = changes
     
     table.update(bullseye, set_dict)
+    notify_write(table, 'update', [bullseye])
 def delete_one(table, target, id_field):
     bullseye            = {}
     try:
@@ -1015,30 +4696,35 @@ def delete_one(table, target, id_field):
         bullseye[id_field]  = target[0][id_field]
     
     table.remove(bullseye)
+    notify_write(table, 'delete', [bullseye])
     
+#### dist_compare(table, criteria) ###########################################
+# This function prints the districts of a chamber (criteria level and state) #
+# that are in the DB but not in the reference districts and the other way    #
+# around, as found by chamber_audit.                                         #
+# Return: list of dictionaries (the chamber's legislators)                   #
+##############################################################################
 def dist_compare(table, criteria):
-    legs                = pull_entries(table, criteria)
-    dist_list           = value_list(legs, 'district')
-    dist_calling        = load_districts(criteria['level'], criteria['state'])
-    dist_calling.sort()
+    group               = (criteria['level'], criteria['state'])
+    findings            = chamber_audit(table, [group])[group]
 
     print 'In DB but not in Calling: '
-    temp                = set(dist_list) - set(dist_calling)
-    if temp == None:
+    temp                = [x[0] for x in findings if x[1] == 'unknown']
+    if len(temp) == 0:
         print '     NONE'
     else:
         for item in temp:
             print '     %s' % str(item)
     print
     print 'In Calling but not in DB: '
-    temp                = set(dist_calling) - set(dist_list)
-    if temp == None:
+    temp                = [x[0] for x in findings if x[1] == 'empty']
+    if len(temp) == 0:
         print '     NONE'
     else:
         for item in temp:
             print '     %s' % str(item)
         
-    return legs
+    return pull_entries(table, criteria)
         
 def value_list(list_of_dict, key_val, sort = True):
     a_list           = []
@@ -1071,6 +4757,315 @@ def dmatch(x, y):
     else:
         return x in y
         
+#### run_audit(table, name, groups, evaluate) ################################
+# This function runs an audit incrementally. Findings are kept per (level,   #
+# state) group in the table's audit state with a fingerprint of the group    #
+# (latest date_modified and legislator count); only groups whose             #
+# fingerprint changed, or that audit_hook saw this module write to, are      #
+# handed to evaluate(table, groups), which returns {group: findings}. A      #
+# change to the district file resets every audit. Findings must be JSON      #
+# values.                                                                    #
+# Return: dict of {group: findings}, list of [group, finding] new since the  #
+# last audit                                                                 #
+##############################################################################
+def run_audit(table, name, groups, evaluate):
+    state           = load_audit_state(table)
+    digest          = districts_digest()
+    if state['districts'] != digest:
+        state['districts']  = digest
+        state['audits']     = {}
+    cached          = state['audits'].setdefault(name, {})
+    prints          = group_fingerprints(table, groups)
+    changed         = [x for x in groups if cached.get('|'.join(x), \
+                                    {}).get('fingerprint') != prints[x]]
+    fresh           = evaluate(table, changed) if len(changed) > 0 else {}
+    
+    results         = {}
+    new             = []
+    for group in groups:
+        key         = '|'.join(group)
+        if group in changed:
+            old     = cached.get(key, {}).get('findings')
+            found   = fresh.get(group, [])
+            if old is not None:
+                new += [[group, x] for x in found if x not in old]
+            cached[key]     = {'fingerprint': prints[group], 'findings': found}
+        results[group]  = cached[key]['findings']
+    save_audit_state(table)
+    print 'Re-audited %i of %i partitions' % (len(changed), len(groups))
+    return results, new
+
+#### group_fingerprints(table, groups) #######################################
+# This function fingerprints (level, state) groups of legislators with one   #
+# aggregation: the latest date_modified and the number of legislators.       #
+# Return: dict of {group: [latest date_modified, count]}                     #
+##############################################################################
+def group_fingerprints(table, groups):
+    prints          = dict((x, [None, 0]) for x in groups)
+    if len(groups) < 1:
+        return prints
+    pipeline        = [
+        {'$match': {'$or': [{'level': x[0], 'state': x[1]} for x in groups]}},
+        {'$group': {'_id': {'level': '$level', 'state': '$state'}, 
+                    'latest': {'$max': '$date_modified'}, 
+                    'count': {'$sum': 1}}}]
+    for each in table.aggregate(pipeline):
+        latest      = each['latest']
+        if isinstance(latest, datetime.datetime):
+            latest  = latest.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        prints[(each['_id']['level'], each['_id']['state'])] = \
+                                                    [latest, each['count']]
+    return prints
+
+#### districts_digest() ######################################################
+# This function hashes the reference district file.                          #
+# Return: string                                                             #
+##############################################################################
+def districts_digest():
+    f               = open(config['ref_path'] + 'districts.csv', 'rb')
+    digest          = hashlib.md5(f.read()).hexdigest()
+    f.close()
+    return digest
+
+#### load_audit_state(table) #################################################
+# This function returns a table's audit state (district file digest and the  #
+# cached findings of every audit), reading it from audit_path the first time.#
+# Return: dictionary                                                         #
+##############################################################################
+def load_audit_state(table):
+    name            = table.full_name
+    if name not in audit_states:
+        state       = {'districts': None, 'audits': {}}
+        filename    = audit_file(table)
+        if os.path.isfile(filename):
+            f       = open(filename, 'r')
+            state   = json_util.loads(f.read())
+            f.close()
+        audit_states[name]  = state
+    return audit_states[name]
+
+#### save_audit_state(table) #################################################
+# This function writes a table's audit state to audit_path, replacing the    #
+# previous copy atomically.                                                  #
+# Return: none                                                               #
+##############################################################################
+def save_audit_state(table):
+    filename        = audit_file(table)
+    folder          = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    f               = open(filename + '.tmp', 'w')
+    f.write(json_util.dumps(audit_states[table.full_name]))
+    f.close()
+    os.rename(filename + '.tmp', filename)
+    audit_dirty.pop(table.full_name, None)
+
+#### save_dirty_audits() #####################################################
+# This function saves the audit states audit_hook changed since they were    #
+# last saved.                                                                #
+# Return: none                                                               #
+##############################################################################
+def save_dirty_audits():
+    for table in audit_dirty.values():
+        save_audit_state(table)
+
+#### audit_file(table) #######################################################
+# This function names the audit state file of a table. Dry runs keep their   #
+# own file, since their findings come from the in-memory copies.             #
+# Return: string                                                             #
+##############################################################################
+def audit_file(table):
+    name            = table.full_name + ('.dry-run' if sandbox_mode else '')
+    return os.path.join(config.get('audit_path', './audits/'), name + '.json')
+
+#### audit_hook(table, action, items) ########################################
+# This write hook forgets the audit fingerprints of the groups this module   #
+# writes to, since its own updates do not always move date_modified or the   #
+# count. Writes that cannot be narrowed to groups forget every fingerprint.  #
+# The state is only marked dirty here; save_dirty_audits writes it once per  #
+# task.                                                                      #
+# Return: none                                                               #
+##############################################################################
+def audit_hook(table, action, items):
+    if table.name != 'legislators':
+        return
+    if table.full_name not in audit_states and \
+                                        not os.path.isfile(audit_file(table)):
+        return
+    state           = load_audit_state(table)
+    groups          = touched_groups(table, action, items)
+    for audit in state['audits'].values():
+        for key in audit:
+            if groups is None or tuple(key.split('|')) in groups:
+                audit[key]['fingerprint']   = None
+    audit_dirty[table.full_name]    = table
+
+#### print_new_findings(new, describe) #######################################
+# This function prints the findings that are new since the last audit.       #
+# Return: none                                                               #
+##############################################################################
+def print_new_findings(new, describe):
+    if len(new) < 1:
+        return
+    print '\nNew since last audit:'
+    for group, finding in new:
+        print '%s %s - %s' % (group[0], group[1], describe(finding))
+
+#### chamber_audit(table, groups) ############################################
+# This function compares the districts of (level, state) chambers in a table #
+# with the reference districts. When the database holds the current          #
+# ref_districts the comparison runs on the server (see ref_chamber_audit);   #
+# otherwise, or on servers without $unionWith, it is done here.              #
+# Return: dict of {group: list of [district, problem, names]} with problem   #
+# 'empty', 'unknown' (not a reference district) or 'multiple'                #
+##############################################################################
+def chamber_audit(table, groups):
+    if ref_ready(table):
+        try:
+            return ref_chamber_audit(table, groups)
+        except OperationFailure as e:
+            print 'Server-side audit failed, comparing here (%s)' % e
+    results             = {}
+    for level, state in groups:
+        # Read past the query cache: the group is known to have changed
+        legs                = list(table.find({'level': level, 'state': state}))
+        dist_calling        = load_districts(level, state)
+        dist_lz             = value_list(legs, 'district')
+        ext_calling         = set(dist_calling)-set(dist_lz)
+        ext_lz              = set(dist_lz)-set(dist_calling)
+        all_dist            = sorted(set(dist_calling)|set(dist_lz), \
+                                                        key = district_order)
+        findings            = []
+        for dist in all_dist:
+            names           = value_list(filter_dict(legs, 'district', dist), \
+                                                                    'name')
+            if dist in ext_calling:
+                findings.append([dist, 'empty', []])
+            elif dist in ext_lz:
+                findings.append([dist, 'unknown', names])
+            if dist not in ext_calling and dist not in ext_lz and \
+                                                        dist_lz.count(dist) > 1:
+                findings.append([dist, 'multiple', names])
+        results[(level, state)] = findings
+    return results
+
+#### ref_chamber_audit(table, groups) ########################################
+# This function is chamber_audit as one aggregation: the legislators of the  #
+# groups are counted per district, unioned with the groups' ref_districts    #
+# and grouped again, and only districts that are empty, unknown or held by   #
+# several legislators come back.                                             #
+# Return: dict of {group: list of [district, problem, names]}                #
+##############################################################################
+def ref_chamber_audit(table, groups):
+    results         = dict((x, []) for x in groups)
+    if len(groups) < 1:
+        return results
+    match           = {'$or': [{'level': x[0], 'state': x[1]} for x in groups]}
+    seat            = {'level': '$level', 'state': '$state', 
+                        'district': {'$ifNull': ['$district', '']}}
+    pipeline        = [
+        {'$match': match},
+        {'$group': {'_id': seat, 'names': {'$push': '$name'}, 
+                    'count': {'$sum': 1}}},
+        {'$unionWith': {'coll': ref_table(table).name, 'pipeline': [
+            {'$match': match},
+            {'$group': {'_id': seat, 'ref': {'$sum': 1}}}]}},
+        {'$group': {'_id': '$_id', 'names': {'$push': '$names'}, 
+                    'count': {'$sum': '$count'}, 'ref': {'$sum': '$ref'}}},
+        {'$match': {'$or': [{'count': 0}, {'ref': 0}, 
+                            {'count': {'$gt': 1}}]}}]
+    for each in table.aggregate(pipeline):
+        group       = (each['_id']['level'], each['_id']['state'])
+        names       = sorted(x for part in each['names'] for x in part)
+        if each['count'] == 0:
+            problem = 'empty'
+        elif each['ref'] == 0:
+            problem = 'unknown'
+        else:
+            problem = 'multiple'
+        results[group].append([each['_id']['district'], problem, names])
+    for group in results:
+        results[group].sort(key = lambda x: district_order(x[0]))
+    return results
+
+#### ref_table(table) ########################################################
+# This function returns the ref_districts collection next to a legislator    #
+# table: one row per reference district (level, state, district, seats and   #
+# the district file version it came from) and a _meta row with the version   #
+# loaded.                                                                    #
+# Return: pymongo table                                                      #
+##############################################################################
+def ref_table(table):
+    return table.database['ref_districts']
+
+#### ref_ready(table) ########################################################
+# This function checks whether a table's ref_districts holds the current     #
+# district file. The loaded version is cached in ref_versions.               #
+# Return: boolean                                                            #
+##############################################################################
+def ref_ready(table):
+    name            = table.full_name
+    if name not in ref_versions:
+        try:
+            meta    = ref_table(table).find_one({'_id': '_meta'})
+        except PyMongoError:
+            meta    = None
+        ref_versions[name]  = None if meta is None else meta.get('version')
+    return ref_versions[name] == districts_digest()
+
+#### load_ref_districts(table) ###############################################
+# This function loads the district file into a table's ref_districts,        #
+# tagging the rows with the file's digest as version, dropping rows of       #
+# older versions and indexing them for the audits.                           #
+# Return: number of reference districts                                      #
+##############################################################################
+def load_ref_districts(table):
+    refs            = ref_table(table)
+    version         = districts_digest()
+    index           = load_district_index()
+    requests        = []
+    for key in sorted(index):
+        for district in index[key]['districts']:
+            row     = {'_id': '|'.join([key[0], key[1], district]), 
+                        'level': key[0], 'state': key[1], 'district': district, 
+                        'seats': index[key]['seats'][district], 
+                        'version': version}
+            requests.append(ReplaceOne({'_id': row['_id']}, row, upsert = True))
+    scheduled_write(refs, requests, 'Districts', strict = True)
+    refs.delete_many({'_id': {'$ne': '_meta'}, 'version': {'$ne': version}})
+    refs.create_index([('level', 1), ('state', 1), ('district', 1)])
+    refs.replace_one({'_id': '_meta'}, {'_id': '_meta', 'version': version, 
+                        'loaded': datetime.datetime.utcnow(), 
+                        'count': len(requests)}, upsert = True)
+    ref_versions[table.full_name]   = version
+    return len(requests)
+
+#### ref_task() ##############################################################
+# This function loads the reference districts into every configured          #
+# database, skipping those that cannot be reached.                           #
+# Return: none                                                               #
+##############################################################################
+def ref_task():
+    for database in sorted(config['db']):
+        try:
+            count   = load_ref_districts(connect_db(database))
+            print 'Loaded %i reference districts into %s' % (count, database)
+        except PyMongoError as e:
+            print 'Could not load reference districts into %s (%s)' % \
+                                                                (database, e)
+
+#### describe_chamber(finding) ###############################################
+# This function words a chamber_audit finding.                               #
+# Return: string                                                             #
+##############################################################################
+def describe_chamber(finding):
+    dist, problem, names    = finding
+    if problem == 'empty':
+        return 'District %s: Not filled in LZ' % dist
+    if problem == 'unknown':
+        return 'District %s: No match in calling' % dist
+    return 'District %s: Multiple Legislators - %s' % (dist, ', '.join(names))
+
 def check_senate(table):
     criteria                = {}
     criteria['level']       = 'fed-upper'
@@ -1086,32 +5081,29 @@ def check_senate(table):
             s               += (', ').join(names)
             print s
             
+#### check_house(table, fix = False) #########################################
+# This function audits the federal house districts of every state against    #
+# the reference districts, re-evaluating only the states changed since the   #
+# last audit (see run_audit). With fix it prompts to fill empty districts    #
+# and to pick the one legislator to keep where a district has several.       #
+# Return: none                                                               #
+##############################################################################
 def check_house(table, fix = False):
-    criteria                = {}
-    criteria['level']       = 'fed-lower'
-    for state in states.keys():
-        criteria['state']   = state
-        legs                = pull_entries(table, criteria)
-        dist_calling        = load_districts('fed-lower', state)
-        dist_lz             = value_list(legs, 'district')
-        both_dist           = list(set(dist_calling)&set(dist_lz))
-        ext_calling         = list(set(dist_calling)-set(dist_lz))
-        ext_lz              = list(set(dist_lz)-set(dist_calling))
-        all_dist            = list(set(dist_calling)|set(dist_lz))
-        ext_leg             = []
-        for dist in both_dist:
-            if dist_lz.count(dist) > 1:
-                ext_leg.append(dist)
-        dist_desc           = {}
-        header              = '\n%s Federal House of Representatives' % states[state]
-        line                = '\nDistrict %s %s: %s'
-        headered            = False
-        all_dist.sort(key=float)
-        for dist in all_dist:
-            if dist in ext_calling:
-                if not(headered):
-                    print header
-                    headered    = True
+    groups                  = [('fed-lower', x) for x in sorted(states)]
+    if fix:
+        results             = chamber_audit(table, groups)
+        new                 = []
+    else:
+        results, new        = run_audit(table, 'chambers', groups, chamber_audit)
+    line                    = '\nDistrict %s %s: %s'
+    for group in groups:
+        state               = group[1]
+        header              = '\n%s Federal House of Representatives' % \
+                                                                states[state]
+        if len(results[group]) > 0:
+            print header
+        for dist, problem, names in results[group]:
+            if problem == 'empty':
                 print line % (states[state], dist, 'Not filled in LZ')
                 if fix:
                     finished        = False
@@ -1127,25 +5119,21 @@ def check_house(table, fix = False):
                             new_leg['state']    = state
                             new_leg['title']    = 'Representative'
                             new_leg['district'] = dist
+                            add_name_keys(new_leg)
                             new_id              = table.insert(new_leg)
+                            notify_write(table, 'insert', [new_leg])
                             print 'Added %s' % selection
                             finished    = True
-            elif dist in ext_lz:
-                if not(headered):
-                    print header
-                    headered    = True
+            elif problem == 'unknown':
                 print line % (states[state], dist, 'No match in calling')
-            if dist in ext_leg:
-                if not(headered):
-                    print header
-                    headered    = True
-                name_dict       = filter_dict(legs, 'district', dist)
-                names           = value_list(name_dict, 'name')
-                s               = 'Multiple Legislators'
+            else:
+                s           = 'Multiple Legislators'
                 if fix:
                     print line % (states[state], dist, s)
+                    name_dict       = pull_entries(table, {'level': 'fed-lower', 
+                                            'state': state, 'district': dist})
                     finished        = False
-                    choices         = names
+                    choices         = value_list(name_dict, 'name')
                     choices.append('None of the above.')
                     while not finished:  
                         task        = list_menu(choices, 'Choose the legislator: ')
@@ -1158,51 +5146,28 @@ def check_house(table, fix = False):
                     s           += ' - '
                     s           += (', ').join(names)
                     print line % (states[state], dist, s) 
+    print_new_findings(new, describe_chamber)
+
+#### check_state(table, state) ###############################################
+# This function audits a state's upper and lower chambers against the        #
+# reference districts, re-evaluating only the chambers changed since the     #
+# last audit (see run_audit).                                                #
+# Return: none                                                               #
+##############################################################################
 def check_state(table, state):
-    criteria            = {}
-    criteria['state']   = state
-    levels              = ['state-upper', 'state-lower']
-    for level in levels:
-        criteria['level']   = level
-        if level == 'state-upper':
+    groups              = [('state-upper', state), ('state-lower', state)]
+    results, new        = run_audit(table, 'chambers', groups, chamber_audit)
+    for group in groups:
+        if group[0] == 'state-upper':
             header          = '\n%s Upper Legislation' % states[state]
         else:
             header          = '\n%s Lower Legislation' % states[state]
-        line                = 'District %s: %s'
-        legs                = pull_entries(table, criteria)
-        dist_calling        = load_districts(level, state)
-        dist_lz             = value_list(legs, 'district')
-        both_dist           = list(set(dist_calling)&set(dist_lz))
-        ext_calling         = list(set(dist_calling)-set(dist_lz))
-        ext_lz              = list(set(dist_lz)-set(dist_calling))
-        all_dist            = list(set(dist_calling)|set(dist_lz))
-        ext_leg             = []
-        for dist in both_dist:
-            if dist_lz.count(dist) > 1:
-                ext_leg.append(dist)
-        dist_desc           = {}
-        headered            = False
-        all_dist            = mix_sort(all_dist)
-        for dist in all_dist:
-            if dist in ext_calling:
-                if not(headered):
-                    print header
-                    headered    = True
-                print line % (dist, 'Not filled in LZ')
-            elif dist in ext_lz:
-                if not(headered):
-                    print header
-                    headered    = True
-                print line % (dist, 'No match in calling')
-            if dist in ext_leg:
-                if not(headered):
-                    print header
-                    headered    = True
-                name_dict       = filter_dict(legs, 'district', dist)
-                names           = value_list(name_dict, 'name')
-                s               = 'Multiple Legislators - '
-                s               += (', ').join(names)
-                print line % (dist, s)
+        if len(results[group]) > 0:
+            print header
+        for finding in results[group]:
+            print describe_chamber(finding)
+    print_new_findings(new, describe_chamber)
+
 def mix_sort(a_list):
     numbers         = []
     strings         = []
@@ -1222,6 +5187,8 @@ def fuzzy_district_match(table, state):
     criteria            = {}
     criteria['state']   = state
     levels              = ['state-upper', 'state-lower']
+    # Only the districts that are not reference districts come back
+    results             = chamber_audit(table, [(x, state) for x in levels])
     for level in levels:
         criteria['level']   = level
         if level == 'state-upper':
@@ -1229,66 +5196,76 @@ def fuzzy_district_match(table, state):
         else:
             header          = '\n%s Lower Legislation' % states[state]
         line                = 'District %s: %s'
-        legs                = pull_entries(table, criteria)
         dist_calling        = load_districts(level, state)
-        dist_lz             = value_list(legs, 'district')
-        both_dist           = list(set(dist_calling)&set(dist_lz))
-        ext_calling         = list(set(dist_calling)-set(dist_lz))
-        ext_lz              = list(set(dist_lz)-set(dist_calling))
-        all_dist            = list(set(dist_calling)|set(dist_lz))
-        ext_calling         = mix_sort(ext_calling)
-        ext_lz              = mix_sort(ext_lz)
+        ext_lz              = mix_sort([x[0] for x in results[(level, state)] \
+                                                        if x[1] == 'unknown'])
         headered            = False
-        for dist in ext_lz:
+        scored              = prefetch(ext_lz, lambda x: fuzz_dist_candidates(x, \
+                                                dist_calling, level, state))
+        for dist, menu in scored:
             print header
-            correct             = fuzz_dist(dist, dist_calling)
+            correct             = fuzz_dist_prompt(dist, menu, dist_calling)
             if correct == 'no match':
                 print 'Cant match District %s' % dist
             else:
                 print 'Replacing %s with %s in LZ' % (dist, correct)
                 dist_calling.remove(correct)
-                target              = criteria
+                target              = dict(criteria)
                 target['district']  = dist
                 changes             = {}
                 changes['district'] = correct
                 set_dict            = {}
                 set_dict['$set']    = changes
                 table.update(target, set_dict)
+                notify_write(table, 'update', [target])
                 if not(headered):
                     print header
                     headered    = True
-def fuzz_dist(lz, calling):
-    potentials      = []
-    temp            = []
-    for each in calling:
-        if each not in temp:
-            temp.append(each)
-
-    calling         = temp
+#### fuzz_dist(lz, calling, level = None, state = None) ######################
+# This function asks the user to pick the calling district matching the LZ   #
+# district lz. Only the short list from district_candidates is scored; the   #
+# cached reference index is used when level and state are given.             #
+# Return: string (district or 'no match')                                    #
+##############################################################################
+def fuzz_dist(lz, calling, level = None, state = None):
+    menu            = fuzz_dist_candidates(lz, calling, level, state)
+    return fuzz_dist_prompt(lz, menu, calling)
 
-    try:
-        int(calling[0])
-    except:
-        not_number  = True
-        
+#### fuzz_dist_candidates(lz, calling, level = None, state = None) ###########
+# This function is the computing half of fuzz_dist: the calling districts    #
+# to offer for lz, best score first.                                         #
+# Return: list of strings                                                    #
+##############################################################################
+def fuzz_dist_candidates(lz, calling, level = None, state = None):
+    allowed         = set(calling)
+    calling         = sorted(allowed)
     if len(calling) == 0:
-        return calling[0]
-    else:
-        potentials  = calling
-        
-    options         = []
-    for each in calling:
-        temp        = each.split(' ')
-        try:
-            assert len(temp) > 1
-            int(temp[0])
-            temp    = (' ').join(temp[1:])
-            options.append([each, temp])
-        except:
-            options.append([each, each])
+        return []
+    
+    entry           = None
+    if level is not None and state is not None:
+        entry       = load_district_index().get((level, state))
+    if entry is None or not allowed <= set(entry['districts']):
+        entry       = index_districts(calling)
     
-    potentials = process.extract(lz, options, processor = lambda x: x[1], limit=20)
-    menu         = [x[0] for x,y in potentials]
+    canon           = split_district(lz)[1]
+    potentials      = []
+    for each in district_candidates(lz, entry, allowed):
+        potentials.append([fuzzy_score(canon, entry['canon'][each], 'WRatio'), 
+                            each])
+    potentials.sort(key = lambda x: -x[0])
+    return [x[1] for x in potentials]
+
+#### fuzz_dist_prompt(lz, menu, calling) #####################################
+# This function is the interactive half of fuzz_dist. Districts no longer in #
+# calling (taken since the menu was built) are left out.                     #
+# Return: string (district or 'no match')                                    #
+##############################################################################
+def fuzz_dist_prompt(lz, menu, calling):
+    allowed         = set(calling)
+    menu            = [x for x in menu if x in allowed]
+    if len(menu) == 0:
+        return 'no match'
     menu.append('No Match')
     
     print '\n\n\nLooking to match %s' % lz
@@ -1297,43 +5274,30 @@ def fuzz_dist(lz, calling):
         task    = list_menu(menu, 'Choose the correct match: ')
         if task == 'No Match':
             return 'no match'
-        elif task in calling:
+        elif task in allowed:
             return task
         else:
             print 'Bad entry'
-def snowball(table, target):
-    legTable        = {}
+def snowball(table, target, requests = None):
     changes         = {}
-    for db in config['db'].keys():
-        database        = db
-        DBclient        = MongoClient(config['db'][database]['url'])
-        activeDB        = DBclient[config['db'][database]['name']]
-        legTable[db]    = activeDB['legislators']
     no_audio            = not(has_audio(target))
     criteria            = {}
-    criteria['name']    = target['name']
+    criteria['$or']     = [{'name': target['name']}, 
+                            {'name_key': name_keys(target['name'])['name_key']}]
     if no_audio:
         criteria['title']   = target['title']
-        finished        = False
-        while not finished:
-            for db in legTable:
-                candidates  = pull_entries(legTable[db], criteria)
-                if len(candidates) > 0:
-                    for each in candidates:
-                        if has_audio(each):
-                            try:
-                                changes['audio_path']   = each['audio_path']
-                            except:
-                                changes['filename']     = each['filename']
-                            
-                            finished    = True
-                            break
-                if finished:
-                    criteria.pop('title')
-                    break
-            break
+        candidates, failed  = federated_query(criteria)
+        for each in candidates:
+            if has_audio(each):
+                try:
+                    changes['audio_path']   = each['audio_path']
+                except:
+                    changes['filename']     = each['filename']
+                criteria.pop('title')
+                break
 
     criteria['level']   = target['level']
+    candidates, failed  = federated_query(criteria)
     
     combined_emails     = target['emails']
     just_emails         = []
@@ -1345,14 +5309,11 @@ def snowball(table, target):
             dup_list.append(each)
     for each in dup_list:
         combined_emails.remove(each)
-    for db in legTable:
-        candidates  = pull_entries(legTable[db], criteria)
-        if len(candidates) > 0:
-            for leg in candidates:
-                for each in leg['emails']:
-                    if each['address'] not in just_emails:
-                        combined_emails.append(each)
-                        just_emails.append(each['address'])
+    for leg in candidates:
+        for each in leg['emails']:
+            if each['address'] not in just_emails:
+                combined_emails.append(each)
+                just_emails.append(each['address'])
     if combined_emails != target['emails']:
         changes['emails'] = combined_emails
     
@@ -1366,14 +5327,11 @@ def snowball(table, target):
             dup_list.append(each)
     for each in dup_list:
         combined_phones.remove(each)
-    for db in legTable:
-        candidates  = pull_entries(legTable[db], criteria)
-        if len(candidates) > 0:
-            for leg in candidates:
-                for each in leg['phones']:
-                    if each['number'] not in just_phones:
-                        combined_phones.append(each)
-                        just_phones.append(each['number'])
+    for leg in candidates:
+        for each in leg['phones']:
+            if each['number'] not in just_phones:
+                combined_phones.append(each)
+                just_phones.append(each['number'])
     if combined_phones != target['phones']:
         changes['phones'] = combined_phones
         
@@ -1387,19 +5345,22 @@ def snowball(table, target):
             dup_list.append(each)
     for each in dup_list:
         combined_networks.remove(each)
-    for db in legTable:
-        candidates  = pull_entries(legTable[db], criteria)
-        if len(candidates) > 0:
-            for leg in candidates:
-                for each in leg['networks']:
-                    if each['url'] not in just_networks:
-                        combined_networks.append(each)
-                        just_networks.append(each['url'])
+    for leg in candidates:
+        for each in leg['networks']:
+            if each['url'] not in just_networks:
+                combined_networks.append(each)
+                just_networks.append(each['url'])
     if combined_networks != target['networks']:
         changes['networks'] = combined_networks
         
-    for each in changes:
-        update_one(table, target, '_id', each, changes[each])
+    if len(changes) < 1:
+        return
+    request             = UpdateOne({'_id': target['_id']}, {'$set': changes})
+    if requests is not None:
+        requests.append(request)
+        return
+    table.bulk_write([request])
+    notify_write(table, 'update', [{'_id': target['_id']}])
     
 def has_audio(target):
     try:
@@ -1413,83 +5374,450 @@ def has_audio(target):
     result              = path or filename
     return result
 def audio_list(legislators):
-    drop_list = []
-    for each in legislators:
-        if has_audio(each):
-            drop_list.append(each)
-    for each in drop_list:
-        legislators.remove(each)
-    result      = []
-    for each in legislators:
-        try:
-            p       = each['prounciation']
-            assert  p != ''
-            s       = '%s %s (' + p + ')' % (each['title'], each['name'])
-        except:
-            s       = '%s %s' % (each['title'], each['name'])
-        result.append(s)
+    legislators[:]  = [x for x in legislators if not has_audio(x)]
+    result          = [audio_line(x, False) for x in legislators]
     result.sort()
     return result
 def rich_list(legislators):
-    drop_list = []
-    for each in legislators:
-        if has_audio(each):
-            drop_list.append(each)
-    for each in drop_list:
-        legislators.remove(each)
-    result      = []
-    for each in legislators:
-        try:
-            p       = each['prounciation']
-            assert  p != ''
-            s       = '%s %s (' + p + ')' % (each['title'], each['name'])
-        except:
-            s       = '%s %s' % (each['title'], each['name'])
-        try:
-            d       = each['district']
-            assert d != ''
-            s           = each['state'] + ' (' + d + ') - ' + s
-        except:
-            s           = each['state'] + ' - ' + s
-        result.append(s)
+    legislators[:]  = [x for x in legislators if not has_audio(x)]
+    result          = [audio_line(x) for x in legislators]
     result.sort()
     return result
+
+#### audio_line(each, rich = True) ###########################################
+# This function formats a legislator for the audio lists as "Title Name      #
+# (pronunciation)", prefixed with "State (District) - " when rich.           #
+# Return: string                                                             #
+##############################################################################
+def audio_line(each, rich = True):
+    s               = '%s %s' % (each.get('title', ''), each['name'])
+    p               = each.get('pronunciation', '')
+    if p != '':
+        s           += ' (%s)' % p
+    if rich:
+        d           = each.get('district', '')
+        if d != '':
+            s       = '%s (%s) - %s' % (each['state'], d, s)
+        else:
+            s       = '%s - %s' % (each['state'], s)
+    return s
+
+#### audio_coverage(table, criteria) #########################################
+# This function computes audio coverage per (level, state) on the server in  #
+# one aggregation pass. Only the legislators missing audio are pushed into   #
+# the groups, with just the fields needed to print them, and the pass may    #
+# spill to disk on large collections.                                        #
+# Return: list of dictionaries with level, state, total, with_audio,         #
+# percent and missing (list of strings)                                      #
+##############################################################################
+def audio_coverage(table, criteria):
+    pipeline        = [
+        {'$match': criteria_query(criteria)},
+        {'$project': {'level': 1, 'state': 1, 'district': 1, 'title': 1, 
+                    'name': 1, 'pronunciation': 1, 'audio': has_audio_expr}},
+        {'$group': {'_id': {'level': '$level', 'state': '$state'},
+                    'total': {'$sum': 1},
+                    'with_audio': {'$sum': {'$cond': ['$audio', 1, 0]}},
+                    'missing': {'$push': {'$cond': ['$audio', '$$REMOVE', 
+                                        {'district': '$district', 
+                                        'state': '$state',
+                                        'title': '$title', 
+                                        'name': '$name', 
+                                        'pronunciation': '$pronunciation'}]}}}},
+        {'$sort': {'_id.level': 1, '_id.state': 1}}]
+    
+    coverage        = []
+    for group in table.aggregate(pipeline, allowDiskUse = True):
+        row                 = {}
+        row['level']        = group['_id']['level']
+        row['state']        = group['_id']['state']
+        row['total']        = group['total']
+        row['with_audio']   = group['with_audio']
+        row['percent']      = 100.0 * group['with_audio'] / group['total']
+        row['missing']      = sorted(audio_line(x) for x in group['missing'])
+        coverage.append(row)
+    return coverage
+
+#### coverage_task() #########################################################
+# This function prompts for a database and filter, then writes the audio     #
+# coverage summary followed by the legislators still missing audio.          #
+# Return: none                                                               #
+##############################################################################
+def coverage_task():
+    table           = pick_db()
+    filters         = create_filters()
+    coverage        = audio_coverage(table, filters)
+    output          = []
+    for row in coverage:
+        output.append('%s %s: %i/%i (%.1f%%)' % (row['level'], row['state'], \
+                        row['with_audio'], row['total'], row['percent']))
+    for row in coverage:
+        if len(row['missing']) > 0:
+            output.append('')
+            output.append('%s %s missing audio' % (row['level'], row['state']))
+            output          += row['missing']
+    write_report(output)
+
+#### write_report(output) ####################################################
+# This function prompts for a filename and writes a list of lines to it.     #
+# Return: none                                                               #
+##############################################################################
+def write_report(output):
+    finished        = False
+    while not finished:
+        outfile     = raw_input('Enter filename for output: ')
+        if len(outfile) < 1:
+            print 'File name too short.'
+        else:
+            try:
+                f           = open(outfile, 'w')
+                finished    = True
+            except:
+                print 'Bad file name.'
+    
+    for line in output:
+        f.write("%s\n" % line.encode('utf-8'))
+    f.close()
+#### remove_dups(table, criteria) ############################################
+# This function finds legislators sharing level, state and normalized name   #
+# with find_dups, snowballs the first of each group and then deletes the     #
+# rest of every group (see merge_groups). Pass {} to dedupe the whole        #
+# collection.                                                                #
+# Return: number of documents deleted                                        #
+##############################################################################
+@profiled
 def remove_dups(table, criteria):
-    legislators     = pull_entries(table, criteria)
-    names           = value_list(legislators, 'name')
-    for each in names:
-        one_name    = filter_dict(legislators, 'name', each)
-        if len(one_name) > 1:
-            snowball(table, one_name[0])
-            for i in range(1, len(one_name)):
-                delete_one(table, one_name[i], '_id')
-def clean_audio_flags(table, criteria):
-    legs = pull_entries(table, criteria)
-    update_list = []
-    for each in legs:
-        if has_audio(each):
-            if 'audio_path' not in each.keys():
-                s       = 'http://cdn.ledgezeppelin.com/' + each['filename']
-                update = [each, 'audio_path', s]
-                update_list.append(update)
-            elif 'filename' not in each.keys():
-                s       = str(each['audio_path'])
-                i   = s.rfind('/')
-                s   = s[i+1:]
-                update = [each, 'filename', s]  
-                update_list.append(update)
-            elif each['audio_path'] == '':
-                s       = 'http://cdn.ledgezeppelin.com/' + each['filename']
-                update = [each, 'audio_path', s]
-                update_list.append(update)
-            elif each['filename'] == '':
-                s       = str(each['audio_path'])
-                i   = s.rfind('/')
-                s   = s[i+1:]
-                update = [each, 'filename', s]  
-                update_list.append(update)  
-    for each in update_list:
-        update_one(table, each[0], '_id', each[1], each[2])
+    with phase('find'):
+        groups      = find_dups(table, criteria)
+    if len(groups) < 1:
+        return 0
+    with phase('merge'):
+        return merge_groups(table, [x['ids'] for x in groups])
+
+#### merge_groups(table, id_groups) ##########################################
+# This function takes lists of _ids that are the same legislator, snowballs  #
+# the first _id of each list and deletes the rest of every list, sending     #
+# the merged updates and the deletes through scheduled_write.                #
+# Return: number of documents deleted                                        #
+##############################################################################
+def merge_groups(table, id_groups):
+    keep_ids        = [x[0] for x in id_groups]
+    drop_ids        = []
+    for group in id_groups:
+        drop_ids    += group[1:]
+    updates         = []
+    for each in table.find({'_id': {'$in': keep_ids}}):
+        snowball(table, each, updates)
+    scheduled_write(table, updates, 'Merged', strict = True)
+    notify_write(table, 'update', [{'_id': {'$in': keep_ids}}])
+    
+    requests        = []
+    for i in range(0, len(drop_ids), write_batch):
+        requests.append(DeleteMany({'_id': {'$in': drop_ids[i:i+write_batch]}}))
+    if len(requests) < 1:
+        return 0
+    result          = scheduled_write(table, requests, 'Deleted', strict = True)
+    notify_write(table, 'delete', [{'_id': {'$in': drop_ids}}])
+    print 'Merged %i duplicate groups, deleted %i legislators' % \
+                                        (len(id_groups), result['nRemoved'])
+    return result['nRemoved']
+
+#### find_near_dups(table, criteria, floor = near_dup_floor) #################
+# This function finds legislators that are probably the same person under    #
+# different names ("Bob Smith" and "Robert Smith"). Legislators are blocked  #
+# by level, state and district, candidate pairs inside a block come from an  #
+# inverted index of name n-grams, and only those pairs are scored with       #
+# fuzzy_score. Pairs scoring at least floor are joined into clusters.        #
+# Return: list of lists of dictionaries (_id, level, state, district and     #
+# name), oldest first; pass [x['_id'] for x in cluster] to merge_groups      #
+##############################################################################
+def find_near_dups(table, criteria, floor = near_dup_floor):
+    fields          = {'level': 1, 'state': 1, 'district': 1, 'name': 1}
+    blocks          = {}
+    for each in table.find(criteria_query(criteria), fields):
+        if each.get('name', '') == '':
+            continue
+        key         = (each['level'], each['state'], each.get('district', ''))
+        blocks.setdefault(key, []).append(each)
+    
+    clusters        = []
+    for key in blocks:
+        block       = blocks[key]
+        if len(block) < 2:
+            continue
+        
+        # Count shared n-grams for every pair that has any
+        index       = {}
+        for i in range(0, len(block)):
+            for gram in name_grams(block[i]['name']):
+                index.setdefault(gram, []).append(i)
+        shared      = {}
+        for members in index.values():
+            for a in range(0, len(members)):
+                for b in range(a + 1, len(members)):
+                    pair            = (members[a], members[b])
+                    shared[pair]    = shared.get(pair, 0) + 1
+        
+        # Score candidates and union the matches
+        parent      = range(0, len(block))
+        def root(i):
+            while parent[i] != i:
+                parent[i]   = parent[parent[i]]
+                i           = parent[i]
+            return i
+        for a, b in shared:
+            if shared[(a, b)] < near_dup_grams:
+                continue
+            if fuzzy_score(block[a]['name'], block[b]['name']) >= floor:
+                parent[root(a)] = root(b)
+        
+        found       = {}
+        for i in range(0, len(block)):
+            found.setdefault(root(i), []).append(block[i])
+        for group in found.values():
+            if len(group) > 1:
+                group.sort(key = lambda x: x['_id'])
+                clusters.append(group)
+    
+    return clusters
+
+#### name_grams(name, size = 3) ##############################################
+# This function breaks a lowercased, space padded name into its character    #
+# n-grams.                                                                   #
+# Return: set of strings                                                     #
+##############################################################################
+def name_grams(name, size = 3):
+    s               = ' %s ' % ' '.join(name.lower().split())
+    return set(s[i:i+size] for i in range(0, len(s) - size + 1))
+
+#### name_keys(name) #########################################################
+# This function computes the normalized keys stored on legislators for       #
+# indexed name lookups, from the name in "First Last" order ("Last, First"   #
+# is turned around) with suffixes like Jr. dropped: name_key (lowercased,    #
+# accents, spaces and punctuation removed), last_key (the same for the last  #
+# name) and, when the metaphone package is installed, name_codes (the Double #
+# Metaphone codes of the last name). key_version marks how the keys were     #
+# made, so older keys are recomputed (see name_keys_missing).                #
+# Return: dictionary                                                         #
+##############################################################################
+def name_keys(name):
+    if not isinstance(name, unicode):
+        name        = str(name).decode('utf-8', 'replace')
+    name            = unicodedata.normalize('NFKD', name)
+    name            = u''.join(x for x in name if not unicodedata.combining(x))
+    parts           = [[x for x in name_words(part) if x not in name_suffixes] \
+                                            for part in name.lower().split(',')]
+    parts           = [x for x in parts if len(x) > 0]
+    # "Last, First": the last name is before the comma
+    words           = [x for part in parts[1:] + parts[:1] for x in part]
+    keys            = {}
+    keys['name_key']    = u''.join(words)
+    if keys['name_key'] == u'':
+        keys['name_key']    = u''.join(name_words(name.lower()))
+    keys['last_key']    = words[-1] if len(words) > 0 else keys['name_key']
+    keys['key_version'] = name_key_version
+    if doublemetaphone is not None:
+        codes       = doublemetaphone(keys['last_key'])
+        keys['name_codes']  = sorted(set(x for x in codes if x))
+    return keys
+
+#### name_words(text) ########################################################
+# This function splits text into words with punctuation removed.             #
+# Return: list of strings                                                    #
+##############################################################################
+def name_words(text):
+    words           = [re.sub(r'[\W_]+', '', x, flags = re.U) \
+                                                        for x in text.split()]
+    return [x for x in words if x != '']
+
+#### add_name_keys(doc) ######################################################
+# This function sets the name keys on a legislator document that has a name. #
+# Return: dictionary (the same document)                                     #
+##############################################################################
+def add_name_keys(doc):
+    if isinstance(doc, dict) and doc.get('name'):
+        doc.update(name_keys(doc['name']))
+    return doc
+
+#### name_query(doc, crit = {}) ##############################################
+# This function builds the indexed query for legislators that may be the     #
+# same person as doc: same name_key, last_key or (with metaphone) a shared   #
+# Double Metaphone code, within crit.                                        #
+# Return: dictionary                                                         #
+##############################################################################
+def name_query(doc, crit = {}):
+    keys            = name_keys(doc['name'])
+    options         = [{'name_key': keys['name_key']}, 
+                        {'last_key': keys['last_key']}]
+    if len(keys.get('name_codes', [])) > 0:
+        options.append({'name_codes': {'$in': keys['name_codes']}})
+    query           = dict(crit)
+    query['$or']    = options
+    return query
+
+#### name_candidates(table, doc, crit) #######################################
+# This function pulls the legislators within crit that may be doc: those     #
+# sharing a name key (see name_query), or the whole crit roster when none    #
+# do, so that misspelled names still reach the fuzzy scoring.                #
+# Return: list of dictionaries                                               #
+##############################################################################
+def name_candidates(table, doc, crit):
+    poss            = pull_entries(table, name_query(doc, crit))
+    if len(poss) < 1:
+        poss        = pull_entries(table, crit)
+    return poss
+
+#### name_keys_missing() #####################################################
+# This function builds the query for legislators with a name but without     #
+# current name keys (none, or made by an older key_version; with metaphone,  #
+# also without name_codes).                                                  #
+# Return: dictionary                                                         #
+##############################################################################
+def name_keys_missing():
+    missing         = {'name': {'$nin': ['', None]}, 
+                        'key_version': {'$ne': name_key_version}}
+    if doublemetaphone is not None:
+        missing     = {'$or': [missing, {'name': {'$nin': ['', None]}, 
+                                    'name_codes': {'$exists': False}}]}
+    return missing
+
+#### ensure_name_keys(table) #################################################
+# This function makes sure a table's legislators carry the name keys, once   #
+# per session: the key indexes are created and documents without keys are    #
+# backfilled (see backfill_name_keys).                                       #
+# Return: none                                                               #
+##############################################################################
+def ensure_name_keys(table):
+    if table.full_name in name_keys_ready:
+        return
+    table.create_index([('level', 1), ('state', 1), ('name_key', 1)])
+    table.create_index([('level', 1), ('state', 1), ('last_key', 1)])
+    if doublemetaphone is not None:
+        table.create_index([('level', 1), ('state', 1), ('name_codes', 1)])
+    missing         = name_keys_missing()
+    if table.find_one(missing, {'_id': 1}) is not None:
+        backfill_name_keys(table, missing)
+    name_keys_ready.add(table.full_name)
+
+#### backfill_name_keys(table, query = {}, quiet = False) ####################
+# This function (re)computes the name keys of the legislators matching query #
+# and writes them through scheduled_write (without progress when quiet).     #
+# Return: number of documents updated                                        #
+##############################################################################
+def backfill_name_keys(table, query = {}, quiet = False):
+    requests        = []
+    ids             = []
+    for each in table.find(query, {'name': 1}):
+        if not each.get('name'):
+            continue
+        requests.append(UpdateOne({'_id': each['_id']}, \
+                                    {'$set': name_keys(each['name'])}))
+        ids.append(each['_id'])
+    if len(requests) < 1:
+        return 0
+    result          = scheduled_write(table, requests, 'Keyed', quiet, \
+                                                            strict = True)
+    notify_write(table, 'update', [{'_id': {'$in': ids}}])
+    count           = result['nModified']
+    if count > 0:
+        print 'Backfilled name keys on %i legislators' % count
+    return count
+
+#### find_dups(table, criteria) ##############################################
+# This function groups legislators matching criteria on the server by level, #
+# state and trimmed, lowercased name and keeps only groups with more than    #
+# one member.                                                                #
+# Return: list of dictionaries with _id (level, state, name), count and ids  #
+##############################################################################
+def find_dups(table, criteria):
+    pipeline        = [
+        {'$match': criteria_query(criteria)},
+        {'$sort': {'_id': 1}},
+        {'$group': {'_id': {'level': '$level', 'state': '$state', 
+                            'name': {'$toLower': {'$trim': {'input': '$name'}}}},
+                    'count': {'$sum': 1},
+                    'ids': {'$push': '$_id'}}},
+        {'$match': {'count': {'$gt': 1}}}]
+    return list(table.aggregate(pipeline, allowDiskUse = True))
+    
+#### clean_audio_flags(table, criteria, server = True, dry_run = False) ######
+# This function fills in audio_path from filename (CDN prefix) and filename  #
+# from audio_path (after the last /) for legislators matching criteria. The  #
+# server mode does each derivation as one pipeline update_many; servers that #
+# reject pipeline updates fall back to client-computed fixes sent through    #
+# scheduled_write. dry_run only counts the documents needing repair.         #
+# Return: dict of {field: number of documents}                               #
+##############################################################################
+@profiled
+def clean_audio_flags(table, criteria, server = True, dry_run = False):
+    query           = criteria_query(criteria)
+    repairs         = {}
+    repairs['audio_path']   = [{'$and': [query, 
+                                    {'filename': {'$nin': ['', None]}}, 
+                                    {'audio_path': {'$in': ['', None]}}]}, 
+                                [{'$set': {'audio_path': 
+                                    {'$concat': [cdn_prefix, '$filename']}}}]]
+    repairs['filename']     = [{'$and': [query, 
+                                    {'audio_path': {'$nin': ['', None]}}, 
+                                    {'filename': {'$in': ['', None]}}]}, 
+                                [{'$set': {'filename': {'$arrayElemAt': 
+                                    [{'$split': ['$audio_path', '/']}, -1]}}}]]
+    
+    counts          = {}
+    if dry_run:
+        for field in repairs:
+            with phase('count'):
+                counts[field]   = table.count_documents(repairs[field][0])
+            print '%i legislators need %s' % (counts[field], field)
+        return counts
+    
+    if server:
+        try:
+            for field in repairs:
+                with phase('server update'):
+                    result      = table.update_many(repairs[field][0], \
+                                                    repairs[field][1])
+                counts[field]   = result.modified_count
+                notify_write(table, 'update', [repairs[field][0]])
+        except (OperationFailure, TypeError):
+            print 'Pipeline updates unsupported, using bulk writes.'
+            server          = False
+    
+    if not server:
+        for field in repairs:
+            with phase('read'):
+                legs        = list(table.find(repairs[field][0], \
+                                        {'audio_path': 1, 'filename': 1}))
+            requests        = []
+            for each in legs:
+                if field == 'audio_path':
+                    s       = cdn_prefix + each['filename']
+                else:
+                    s       = str(each['audio_path'])
+                    s       = s[s.rfind('/')+1:]
+                requests.append(UpdateOne({'_id': each['_id']}, \
+                                            {'$set': {field: s}}))
+            with phase('bulk write'):
+                result      = scheduled_write(table, requests, \
+                                    'Repairing %s' % field, strict = True)
+            counts[field]   = result['nModified']
+            notify_write(table, 'update', [repairs[field][0]])
+    
+    for field in counts:
+        print 'Repaired %s on %i legislators' % (field, counts[field])
+    return counts
+    
+#### criteria_query(criteria) ################################################
+# This function turns a filter dict or a list of filter dicts (as made by    #
+# create_filters) into a single mongo query.                                 #
+# Return: dictionary                                                         #
+##############################################################################
+def criteria_query(criteria):
+    if type(criteria) is list:
+        if len(criteria) == 1:
+            return criteria[0]
+        return {'$or': criteria}
+    return criteria
     
     
 #### main() ##################################################################
@@ -1497,12 +5825,32 @@ def clean_audio_flags(table, criteria):
 # Return: none                                                               #
 ##############################################################################
 def main():
+    global local_mode, sandbox_mode, profile_mode
+    
+    # Read from the local mirrors instead of the remote databases
+    if '--local' in sys.argv:
+        local_mode  = True
+    # Work on in-memory copies of the databases; nothing is written back
+    if '--dry-run' in sys.argv:
+        sandbox_mode    = True
+        print 'Dry run: changes are made to in-memory copies only'
+    # Time the phases of every workflow and write a report per run
+    if '--profile' in sys.argv:
+        profile_mode    = 'time'
+    if '--profile=cprofile' in sys.argv:
+        profile_mode    = 'cprofile'
 
     # Pick Task
     task_menu   = ['Create List from Menu', 'Create List from Manual', 
-                    'Insert', 'Seat Audit', 'Move', 'Delete', 'Exit']
+                    'Insert', 'Seat Audit', 'Rebuild Seats', 'Load Districts', 
+                    'Audio Coverage', 'Season Compare', 'Move', 'Delete', 
+                    'Exit']
         # Create List: Create a List of legislators who have a blank field
         # Update: Update a batch of legislators
+        # Rebuild Seats: Rebuild the seats collection used by Seat Audit
+        # Load Districts: Load the reference districts into every DB
+        # Audio Coverage: Report audio coverage and who is missing audio
+        # Season Compare: Diff a batch of legislators across every DB
         # Move: Move a batch of legislators from one DB to another
         # Delete: Delete a batch of legislators from one DB
         # Exit: Leave the program
@@ -1515,13 +5863,31 @@ def main():
         elif task == 'Create List from Manual':
             create_list_man()
         elif task == 'Insert':
-            insert()
+            dup_check()
         elif task == 'Seat Audit':
             seat_check()
+        elif task == 'Rebuild Seats':
+            seats_task()
+        elif task == 'Load Districts':
+            ref_task()
+        elif task == 'Audio Coverage':
+            coverage_task()
+        elif task == 'Season Compare':
+            season_task()
         elif task == 'Move':
             move_task()
         elif task == 'Delete':
             del_task()
         elif task == 'Exit':            
+            close_score_store()
             finished    = True
+        # Merge, delete and district workflows score names and districts
+        print_score_stats()
+        save_dirty_audits()
+
+# Keep the derived indexes current on every write made through this module
+write_hooks     += [bitmap_hook, cache_hook, mirror_hook, audit_hook, 
+                    seat_hook]
 
+if __name__ == '__main__':
+    main()
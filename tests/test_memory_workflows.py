@@ -0,0 +1,263 @@
+#### test_memory_workflows.py ################################################
+# Runs the workflows against the in-memory engine (--dry-run's backend), so  #
+# they can be checked without a server:                                      #
+#   python -m unittest discover tests                                        #
+##############################################################################
+import copy, os, shutil, sys, tempfile, unittest
+
+root            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import main
+
+
+def legislator(_id, name, level = 'state-upper', state = 'CA', district = '1'):
+    doc             = copy.deepcopy(main.template)
+    doc.update({'_id': _id, 'name': name, 'level': level, 'state': state, 
+                'district': district, 'title': 'Senator'})
+    return doc
+
+
+class MemoryWorkflowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp        = tempfile.mkdtemp()
+        self.saved      = [main.config, main.sandbox_mode, main.local_mode]
+        main.config     = {'db': {'A': {'url': 'unused', 'name': 'A'}, 
+                                  'B': {'url': 'unused', 'name': 'B'}}, 
+                           'job_path': os.path.join(self.tmp, 'jobs'), 
+                           'audit_path': os.path.join(self.tmp, 'audits'), 
+                           'mirror_path': os.path.join(self.tmp, 'mirror'), 
+                           'ref_path': os.path.join(root, 'ref') + os.sep}
+        main.sandbox_mode   = True
+        for cache in [main.memory_dbs, main.query_cache, main.seat_states, 
+                      main.audit_states, main.audit_dirty, main.ref_versions, 
+                      main.bitmap_indexes, main.write_controls, 
+                      main.mirror_ready]:
+            cache.clear()
+        main.query_cache_stats['docs']  = 0
+        main.name_keys_ready.clear()
+        main.memory_dbs['A']    = main.memory_db('A')
+        main.memory_dbs['B']    = main.memory_db('B')
+    
+    def tearDown(self):
+        main.config, main.sandbox_mode, main.local_mode = self.saved
+        for conn in main.mirrors.values():
+            conn.close()
+        main.mirrors.clear()
+        shutil.rmtree(self.tmp)
+    
+    def test_remove_dups(self):
+        table           = main.connect_db('A')
+        table.insert_many([legislator(1, 'Ann Lee'), legislator(2, 'ann lee '), 
+                           legislator(3, 'Bob Ray', district = '2')])
+        self.assertEqual(main.remove_dups(table, {}), 1)
+        self.assertEqual(sorted(x['_id'] for x in table.find()), [1, 3])
+    
+    def test_near_dups_merge(self):
+        table           = main.connect_db('A')
+        table.insert_many([legislator(1, 'Robert Smith'), 
+                           legislator(2, 'Robert Smyth'), 
+                           legislator(3, 'Robert Smyth', district = '2')])
+        clusters        = main.find_near_dups(table, {})
+        self.assertEqual([[x['_id'] for x in y] for y in clusters], [[1, 2]])
+        main.merge_groups(table, [[x['_id'] for x in y] for y in clusters])
+        self.assertEqual(sorted(x['_id'] for x in table.find()), [1, 3])
+    
+    def test_move_job(self):
+        source          = main.connect_db('A')
+        source.insert_many([legislator(i, 'Name %i' % i, district = str(i)) \
+                                                        for i in range(5)])
+        source.insert_one(legislator(9, 'Other', state = 'NY'))
+        job             = main.new_job('move', [{'level': 'state-upper', 
+                                                 'state': 'CA'}])
+        job.update({'source': 'A', 'dest': 'B', 'mode': 'Add A to B', 
+                    'raw': True, 'cleared': False, 'last_id': None, 
+                    'copied': 0})
+        main.save_job(job)
+        main.run_move_job(job)
+        
+        dest            = main.connect_db('B')
+        self.assertEqual(sorted(x['_id'] for x in dest.find()), range(5))
+        self.assertEqual(dest.count_documents(main.name_keys_missing()), 0)
+        self.assertTrue(job['done'] and job['dry_run'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'jobs', 'dry-run')), 
+                         [job['id'] + '.json'])
+    
+    def test_dry_run_job_not_resumed_live(self):
+        job             = main.new_job('delete', [{'state': 'CA'}])
+        job.update({'dest': 'A', 'done_filters': 0, 'deleted': 0})
+        main.save_job(job)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'jobs', 
+                                        'dry-run', job['id'] + '.json')))
+        main.sandbox_mode   = False
+        self.assertEqual(main.resume_job('delete'), None)
+        main.run_del_job(job)
+        self.assertFalse(job['done'])
+    
+    def test_chamber_audit(self):
+        table           = main.connect_db('A')
+        dists           = main.load_districts('state-upper', 'VT')
+        table.insert_many([legislator(i, 'Name %i' % i, state = 'VT', 
+                            district = x) for i, x in enumerate(dists[1:])])
+        table.insert_many([legislator(100, 'Extra', state = 'VT', 
+                                        district = dists[2]), 
+                           legislator(101, 'Lost', state = 'VT', 
+                                        district = 'Nowhere')])
+        groups          = [('state-upper', 'VT')]
+        local           = main.chamber_audit(table, groups)
+        main.load_ref_districts(table)
+        self.assertTrue(main.ref_ready(table))
+        server          = main.chamber_audit(table, groups)
+        
+        self.assertEqual(local, server)
+        found           = dict((x[0], x[1]) for x in server[groups[0]])
+        self.assertEqual(found, {dists[0]: 'empty', dists[2]: 'multiple', 
+                                 'Nowhere': 'unknown'})
+
+    
+    def test_audit_state_dry_run(self):
+        table           = main.connect_db('A')
+        table.insert_one(legislator(1, 'Name', state = 'VT', district = 'X'))
+        main.check_state(table, 'VT')
+        folder          = os.path.join(self.tmp, 'audits')
+        self.assertEqual(os.listdir(folder), ['A.legislators.dry-run.json'])
+        
+        # Hook writes only mark the state; it is saved once per task
+        main.update_one(table, {'_id': 1}, '_id', 'district', 'Y')
+        self.assertIn('A.legislators', main.audit_dirty)
+        main.save_dirty_audits()
+        self.assertEqual(main.audit_dirty, {})
+    
+    def test_copy_raw_replaces_existing(self):
+        table           = main.connect_db('B')
+        table.insert_one(legislator(1, 'Old Name'))
+        main.copy_raw(table, [legislator(1, 'Ann Lee'), legislator(2, 'Bob Ray')])
+        found           = dict((x['_id'], x) for x in table.find())
+        self.assertEqual(found[1]['name'], 'Ann Lee')
+        self.assertEqual(found[2]['name'], 'Bob Ray')
+    
+    def test_scheduled_write_retries(self):
+        table           = main.connect_db('A')
+        calls           = []
+        real            = table.bulk_write
+        def flaky(requests, ordered = True):
+            calls.append(len(requests))
+            if len(calls) == 1:
+                raise main.AutoReconnect('dropped')
+            return real(requests, ordered = ordered)
+        table.bulk_write    = flaky
+        result          = main.scheduled_write(table, [main.InsertOne(
+                            legislator(i, 'Name %i' % i)) for i in range(3)], 
+                            quiet = True, strict = True)
+        self.assertEqual(result['nInserted'], 3)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(main.write_stats['retries'], 3)
+        
+        # The next call on the table starts from the halved batch size
+        main.scheduled_write(table, [main.InsertOne(legislator(i, 'N')) \
+                            for i in range(10, 610)], quiet = True)
+        self.assertEqual(calls[2:], [500, 100])
+    
+    def test_bulk_insert_notifies_landed(self):
+        table           = main.connect_db('A')
+        table.insert_one(legislator(1, 'Ann Lee'))
+        seen            = []
+        hook            = lambda t, action, items: seen.extend(items)
+        main.write_hooks.append(hook)
+        try:
+            with self.assertRaises(main.BulkWriteError):
+                main.bulk_insert(table, [legislator(1, 'Ann Lee'), 
+                                         legislator(2, 'Bob Ray')])
+        finally:
+            main.write_hooks.remove(hook)
+        self.assertEqual([x['_id'] for x in seen], [2])
+    
+    def test_seat_hook_incremental(self):
+        table           = main.connect_db('A')
+        dists           = main.load_districts('state-upper', 'VT')
+        table.insert_many([legislator(i, 'Name %i' % i, state = 'VT', 
+                            district = x) for i, x in enumerate(dists[:3])])
+        main.build_seats(table)
+        
+        def check():
+            rows        = main.seat_rows(table.find(), main.reference_seats())
+            built       = dict((x['_id'], x) for x in rows)
+            found       = dict((x['_id'], x) for x in \
+                            main.seat_table(table).find({'_id': {'$ne': '_meta'}}))
+            for row in built.values() + found.values():
+                row['occupants']    = sorted(row['occupants'])
+            self.assertEqual(found, built)
+        
+        reads           = []
+        find            = table.find
+        table.find      = lambda *args, **kwargs: reads.append(args) or \
+                                                        find(*args, **kwargs)
+        main.bulk_insert(table, [legislator(10, 'New', state = 'VT', 
+                                            district = dists[0])])
+        self.assertEqual(reads, [])
+        check()
+        main.update_one(table, {'_id': 1}, '_id', 'district', 'Nowhere')
+        check()
+        main.bulk_delete(table, [{'state': 'VT', 'district': dists[0]}])
+        check()
+        main.upsert_seats(table, [legislator(None, 'Seated', state = 'VT', 
+                                                district = dists[2])])
+        check()
+    
+    def test_bitmap_index_catches_outside_writes(self):
+        table           = main.connect_db('A')
+        old             = main.datetime.datetime(2020, 1, 1)
+        docs            = [legislator(i, 'Name %i' % i) for i in range(3)]
+        for doc in docs:
+            doc.update({'audio_path': 'a.mp3', 'date_modified': old})
+        table.insert_many(docs)
+        index           = main.get_bitmap_index(table)
+        crit            = [{'state': 'CA'}]
+        self.assertEqual(main.bitmap_select(index, crit, 'audio'), 0)
+        
+        # Written by someone else: no write hooks run
+        table.update_one({'_id': 1}, {'$set': {'audio_path': '', 
+                        'date_modified': main.datetime.datetime(2021, 1, 1)}})
+        table.insert_one(dict(legislator(5, 'New'), 
+                        date_modified = main.datetime.datetime(2021, 1, 1)))
+        index           = main.get_bitmap_index(table)
+        bits            = main.bitmap_select(index, crit, 'audio')
+        self.assertEqual(main.bitmap_ids(index, bits), [1, 5])
+        
+        table.delete_one({'_id': 5})
+        index           = main.get_bitmap_index(table)
+        bits            = main.bitmap_select(index, crit, 'audio')
+        self.assertEqual(main.bitmap_ids(index, bits), [1])
+    
+    def test_name_keys_word_order(self):
+        keys            = main.name_keys('John Smith')
+        for name in ['Smith, John', 'Smith, Jr., John', 'John Smith Jr.']:
+            found       = main.name_keys(name)
+            self.assertEqual((found['name_key'], found['last_key']), 
+                             (keys['name_key'], keys['last_key']))
+    
+    def test_add_when_no_b(self):
+        main.connect_db('A').insert_many([legislator(i, 'A %i' % i, 
+                            district = str(i)) for i in range(3)])
+        main.connect_db('B').insert_one(legislator(100, 'B 1', district = '1'))
+        names           = ['A', 'B']
+        saved           = [main.pick_db_name, main.create_filters, 
+                           main.list_menu]
+        main.pick_db_name   = lambda: names.pop(0)
+        main.create_filters = lambda: [{'state': 'CA'}]
+        main.list_menu      = lambda menu, prompt: 'Add A when no B'
+        try:
+            main.move_task()
+        finally:
+            main.pick_db_name, main.create_filters, main.list_menu  = saved
+        found           = main.connect_db('B').find()
+        self.assertEqual(sorted(x['_id'] for x in found), [0, 2, 100])
+    
+    def test_local_mode_mirrors_on_first_use(self):
+        table           = main.connect_db('B')
+        table.insert_one(legislator(1, 'Ann Lee'))
+        main.local_mode = True
+        found           = main.pull_entries(table, {'state': 'CA'})
+        self.assertEqual([x['_id'] for x in found], [1])
+
+if __name__ == '__main__':
+    unittest.main()